@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+import os
+import time
+import fcntl
+
+class BandwidthLimiter:
+
+    def __init__(self,state_dir,link,route):
+
+        # Set to 1 or more to enable printout of bandwidth reservations
+        self.debug = 0
+
+        # Default profiles: maximum bandwidth in MB/s (0 = no limit) and number of parallel copies
+        # (0 = keep caller's default) while a run is on-going on the DAQ servers and while DAQ is idle.
+        # Route-specific profiles ("source_destination") are used first, then the profile of any
+        # site at one end of the route. Copies from/to the DAQ data servers compete with data
+        # taking for disks and network: throttle them during runs and go full speed between runs.
+        self.profiles_default = {
+            "DAQ": { "ongoing": (50,2), "idle": (0,0) }
+        }
+        self.route = route
+        (src_site,dst_site) = route.split("_",1)
+        profiles = self.profiles_default.get(route,
+                   self.profiles_default.get(src_site,
+                   self.profiles_default.get(dst_site,{ "ongoing": (0,0), "idle": (0,0) })))
+        self.profiles = dict(profiles)
+
+        # Token bucket shared by all processes copying on the same link (e.g. the CDR server and
+        # TransferRun jobs reading from the same DAQ data server)
+        self.bucket_file = "%s/bandwidth_%s.bucket"%(state_dir,link)
+
+        # Bucket can hold burst_time seconds of transfer at full rate
+        self.burst_time = 10
+
+        # Size debited when the size of the file is not known (2GB)
+        self.file_size = 2*1024**3
+
+        # Parallel copies on the link are limited across all processes with one lock file per
+        # copy slot. While waiting for a free slot, check again every slot_poll_interval seconds.
+        self.slot_prefix = "%s/bandwidth_%s.slot"%(state_dir,link)
+        self.slot_poll_interval = 1
+
+        # Start with idle profile
+        self.profile = "idle"
+        (rate,self.jobs) = self.profiles["idle"]
+        self.rate = rate*1024**2
+
+    def set_limit(self,profile,rate,jobs=None):
+
+        # Override default bandwidth (MB/s) and, optionally, number of parallel copies of a profile
+        if jobs is None: jobs = self.profiles[profile][1]
+        self.profiles[profile] = (rate,jobs)
+        if profile == self.profile:
+            self.profile = ""
+            self.set_profile(profile)
+
+    def set_profile(self,profile):
+
+        # Select "ongoing" or "idle" profile
+        if profile == self.profile: return
+        self.profile = profile
+        (rate,self.jobs) = self.profiles[profile]
+        self.rate = rate*1024**2
+        if rate:
+            print "BandwidthLimiter - Route %s - Using %s profile: %d MB/s"%(self.route,profile,rate)
+        else:
+            print "BandwidthLimiter - Route %s - Using %s profile: no bandwidth limit"%(self.route,profile)
+
+    def get_jobs(self,default):
+
+        # Number of parallel copies to use with current profile
+        if self.jobs: return self.jobs
+        return default
+
+    def try_slot(self,jobs):
+
+        # Lock one of the first jobs copy slots of the link. Return its descriptor or None if all are busy.
+        for n in range(jobs):
+            fd = os.open("%s%d"%(self.slot_prefix,n),os.O_RDWR|os.O_CREAT,0664)
+            try:
+                fcntl.flock(fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+                return fd
+            except IOError:
+                os.close(fd)
+        return None
+
+    def acquire_slot(self,jobs=0,check=None):
+
+        # Wait for a free copy slot on the link if current profile limits parallel copies
+        # (jobs slots can be used, profile value if 0). While waiting, call check function (if any).
+        # Return slot to be given back with release_slot (None if copies are not limited).
+        if not self.jobs: return None
+        if not jobs: jobs = self.jobs
+        waiting = False
+        while True:
+            fd = self.try_slot(jobs)
+            if fd is not None: break
+            if self.debug and not waiting: print "BandwidthLimiter - Route %s - Waiting for a free copy slot"%self.route
+            waiting = True
+            if check: check()
+            time.sleep(self.slot_poll_interval)
+        return fd
+
+    def release_slot(self,fd):
+
+        # Give back copy slot returned by acquire_slot
+        if fd is None: return
+        fcntl.flock(fd,fcntl.LOCK_UN)
+        os.close(fd)
+
+    def take(self,size):
+
+        # Take size bytes from the bucket if it is not empty. The level may go below zero:
+        # following copies then wait until it is refilled. Return time to wait (0 if taken).
+        if not self.rate: return 0.
+        max_level = self.rate*self.burst_time
+        fd = os.open(self.bucket_file,os.O_RDWR|os.O_CREAT,0664)
+        try:
+            fcntl.flock(fd,fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                (level,last) = [ float(v) for v in os.read(fd,64).split() ]
+                level = min(level+self.rate*(now-last),max_level)
+            except ValueError:
+                level = max_level
+            wait = 0.
+            if level >= 0:
+                level -= size
+            else:
+                wait = -level/self.rate
+            os.lseek(fd,0,os.SEEK_SET)
+            os.ftruncate(fd,0)
+            os.write(fd,"%.0f %.3f"%(level,now))
+        finally:
+            os.close(fd)
+        return wait
+
+    def acquire(self,size=0,check=None):
+
+        # Wait until file of given size (expected size if not known) can be sent without going
+        # above the bandwidth of current profile. While waiting, call check function (if any).
+        if not self.rate: return
+        if not size: size = self.file_size
+        waiting = False
+        while True:
+            wait = self.take(size)
+            if not wait: break
+            if self.debug and not waiting: print "BandwidthLimiter - Route %s - Waiting %.0fs for bandwidth"%(self.route,wait)
+            waiting = True
+            end_time = time.time()+wait
+            while time.time() < end_time:
+                if check: check()
+                time.sleep(min(1.,max(0.,end_time-time.time())))
+        if self.debug: print "BandwidthLimiter - Route %s - Sending %d bytes"%(self.route,size)
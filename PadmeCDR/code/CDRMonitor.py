@@ -12,6 +12,7 @@ import daemon.pidfile
 
 from Logger import Logger
 from ProxyHandler import ProxyHandler
+from SSHHandler import SSHHandler
 
 # Get position of CDR main directory from PADME_CDR_DIR environment variable
 # Default to current dir if not set
@@ -291,8 +292,8 @@ kloe_server = "fibm15"
 kloe_user = "pdm"
 kloe_keyfile = "/home/%s/.ssh/id_rsa_cdr"%cdr_user
 
-# SSH syntax to execute a command on KLOE front end
-kloe_ssh = "ssh -i %s -l %s %s"%(kloe_keyfile,kloe_user,kloe_server)
+# SSH handler (created when monitor starts): all commands to the same remote account share one connection
+SH = None
 
 # Path to top padme directory on KLOE front end
 kloe_path = "/pdm"
@@ -357,6 +358,19 @@ def get_transfer_status(src,dst):
                 return ("ON",proc.pid,proc.username())
         except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
             pass
+    if dst != "": return get_route_status(src,dst)
+    return ("OFF",-1,"")
+
+def get_route_status(src,dst):
+    # Routes served by a multi-route PadmeCDR daemon are found through the lock file of the route
+    route_id = "%s_%s"%(re.sub("^DAQ-","DAQ_",src),dst)
+    lock_file = "%s/run/PadmeCDRServer_%s.lock"%(cdr_dir,route_id)
+    try:
+        with open(lock_file,"r") as lf: pid = int(lf.read().split()[-1])
+        proc = psutil.Process(pid)
+        if re.match("^.*PadmeCDR .*$"," ".join(proc.cmdline())): return ("ON",proc.pid,proc.username())
+    except (IOError, ValueError, IndexError, psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+        pass
     return ("OFF",-1,"")
 
 def get_network_info(network):
@@ -366,7 +380,7 @@ def get_network_info(network):
     if network["Host"] == "localhost":
         cmd = "/usr/sbin/ifconfig %s"%network["Interface"]
     else:
-        daq_ssh = "ssh -i %s -l %s %s"%(daq_keyfile,network["User"],network["Host"])
+        daq_ssh = SH.get_ssh(daq_keyfile,network["User"],network["Host"])
         cmd = "%s /usr/sbin/ifconfig %s"%(daq_ssh,network["Interface"])
     for line in run_command(cmd):
         rc = re.match("^\s*RX packets.*bytes\s+(\d+).*$",line)
@@ -386,7 +400,7 @@ def get_disk_info(disk):
         #cmd = "/bin/df -BG --output=size,used,avail,pcent %s"%disk["Area"]
         cmd = "/bin/df -BM --output=size,used,avail,pcent %s"%disk["Area"]
     else:
-        daq_ssh = "ssh -i %s -l %s %s"%(daq_keyfile,disk["User"],disk["Host"])
+        daq_ssh = SH.get_ssh(daq_keyfile,disk["User"],disk["Host"])
         #cmd = "%s /bin/df -BG --output=size,used,avail,pcent %s"%(daq_ssh,disk["Area"])
         cmd = "%s /bin/df -BM --output=size,used,avail,pcent %s"%(daq_ssh,disk["Area"])
     for line in run_command(cmd):
@@ -419,6 +433,7 @@ def get_tape_info(tape):
 
 def get_kloetape_info():
     tape_occ = 0.
+    kloe_ssh = SH.get_ssh(kloe_keyfile,kloe_user,kloe_server)
     cmd = "%s %s"%(kloe_ssh,kloe_tape_app)
     for line in run_command(cmd):
         rc = re.match("^\S+\s+/pdm\s+(\S+)\s*$",line.rstrip())
@@ -427,6 +442,7 @@ def get_kloetape_info():
 
 def get_kloedisk_info():
     disk_occ = 0.
+    kloe_ssh = SH.get_ssh(kloe_keyfile,kloe_user,kloe_server)
     cmd = "%s df -g %s"%(kloe_ssh,kloe_path)
     for line in run_command(cmd):
         rc = re.match("^\S+\s+(\S+)\s+(\S+)\s+.*%s\s*$"%kloe_path,line.rstrip())
@@ -683,8 +699,10 @@ def get_formatted_list(item_list,fmt,period):
 
 def run_command(command):
     print "> %s"%command
-    p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
-    return iter(p.stdout.readline,b'')
+    with SH.session(command):
+        p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
+        for line in iter(p.stdout.readline,b''): yield line
+        p.wait()
 
 def start_monitor():
 
@@ -697,6 +715,11 @@ def start_monitor():
     PH = ProxyHandler()
     PH.long_proxy_file = long_proxy_file
     PH.debug = 1
+    PH.start_renewal_thread()
+
+    # Define ssh handler. Master connections are kept open during the pause between checks
+    global SH
+    SH = SSHHandler(2*monitor_pause)
 
     print "=== Starting CDRMonitor ==="
 
@@ -1107,7 +1130,8 @@ def start_monitor():
 
         mh.close()
 
-        cmd = "scp -i %s /tmp/%s %s@%s:%s/%s"%(monitor_keyfile,monitor_file,monitor_user,monitor_server,monitor_dir,monitor_file)
+        monitor_scp = SH.get_scp(monitor_keyfile,monitor_user,monitor_server)
+        cmd = "%s /tmp/%s %s@%s:%s/%s"%(monitor_scp,monitor_file,monitor_user,monitor_server,monitor_dir,monitor_file)
         for line in run_command(cmd): print line.rstrip()
 
         # Pause monitor_pause seconds while checking every 10sec for stop file
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+import os
+import time
+import fcntl
+import hashlib
+import sqlite3
+import threading
+
+class ChecksumCache:
+
+    def __init__(self,cache_dir):
+
+        # Checksums are stored in a SQLite file shared by the CDR servers and by all tools
+        self.cache_dir = cache_dir
+        self.db_file = "%s/PadmeCDRChecksum.db"%self.cache_dir
+
+        # One lock file per file being checksummed: processes asking for the same checksum
+        # wait for the first one to compute it instead of computing it again
+        self.lock_dir = "%s/checksum_locks"%self.cache_dir
+        if not os.path.isdir(self.lock_dir): os.makedirs(self.lock_dir)
+
+        # Maximum number of files locked at the same time by a single call to get_checksums
+        self.group_size = 200
+
+        # Connection is shared by all threads of the process: serialize access
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_file,timeout=60,check_same_thread=False)
+
+        self.create_tables()
+
+    def create_tables(self):
+
+        with self.lock:
+            c = self.conn.cursor()
+
+            # Last known checksum of each file (stored as run/file) at each site. Size and
+            # mtime, when known, are used to detect files which changed after the checksum.
+            c.execute("""
+CREATE TABLE IF NOT EXISTS checksum (
+    site        TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    size        INTEGER,
+    mtime       INTEGER,
+    adler32     TEXT NOT NULL,
+    checked_at  REAL,
+    PRIMARY KEY (site,path)
+)""")
+            self.conn.commit()
+
+    def lookup(self,site,path,size=None,mtime=None,not_before=0):
+
+        # Return cached checksum of path at site or "" if it is not known, if it was computed
+        # before not_before, or if size or mtime are known and do not match
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT size,mtime,adler32,checked_at FROM checksum WHERE site=? AND path=?",(site,path))
+            res = c.fetchone()
+        if res is None: return ""
+        (c_size,c_mtime,a32,checked_at) = res
+        if checked_at < not_before: return ""
+        if size is not None and c_size is not None and c_size != size: return ""
+        if mtime is not None and c_mtime is not None and c_mtime != mtime: return ""
+        return a32
+
+    def store(self,site,path,adler32,size=None,mtime=None):
+
+        if not adler32: return
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT OR REPLACE INTO checksum (site,path,size,mtime,adler32,checked_at) VALUES (?,?,?,?,?,?)",
+                      (site,path,size,mtime,adler32,time.time()))
+            self.conn.commit()
+
+    def get_not_before(self,max_age):
+
+        # Cached values are trusted if younger than max_age seconds. With max_age=None only
+        # values computed from now on (e.g. by a concurrent process) are accepted.
+        if max_age is None: return time.time()
+        return time.time()-max_age
+
+    def get_checksum(self,site,path,function,args=(),max_age=None,size=None,mtime=None):
+
+        # Return checksum of path at site, calling function(*args,path) only if it is not in
+        # the cache and no other process is already computing it
+        sizes = {}
+        mtimes = {}
+        if size is not None: sizes[path] = size
+        if mtime is not None: mtimes[path] = mtime
+        checksums = self.get_checksums(site,[path],self.call_single,(function,args),max_age,sizes,mtimes)
+        return checksums.get(path,"")
+
+    def call_single(self,function,args,path_list):
+
+        checksums = {}
+        for path in path_list:
+            a32 = function(*(args+(path,)))
+            if a32: checksums[path] = a32
+        return checksums
+
+    def get_checksums(self,site,path_list,function,args=(),max_age=None,sizes={},mtimes={}):
+
+        # Return dictionary path -> checksum for all files in path_list. Missing checksums
+        # are computed with a single call to function(*args,missing_list) for each group.
+        not_before = self.get_not_before(max_age)
+        checksums = {}
+        for i in range(0,len(path_list),self.group_size):
+            self.get_checksums_group(site,path_list[i:i+self.group_size],function,args,not_before,sizes,mtimes,checksums)
+        return checksums
+
+    def get_checksums_group(self,site,path_list,function,args,not_before,sizes,mtimes,checksums):
+
+        # Lock all files not in cache which are not being computed by someone else
+        locks = {}
+        busy_list = []
+        try:
+            for path in path_list:
+                a32 = self.lookup(site,path,sizes.get(path),mtimes.get(path),not_before)
+                if a32:
+                    checksums[path] = a32
+                    continue
+                lock_fd = self.acquire(site,path,False)
+                if lock_fd is None:
+                    busy_list.append(path)
+                    continue
+                # Checksum may have been stored while we were acquiring the lock
+                a32 = self.lookup(site,path,sizes.get(path),mtimes.get(path),not_before)
+                if a32:
+                    checksums[path] = a32
+                    self.release(site,path,lock_fd)
+                else:
+                    locks[path] = lock_fd
+
+            # Compute all missing checksums at once and store them
+            if locks:
+                result = function(*(args+(sorted(locks.keys()),)))
+                for path in locks.keys():
+                    a32 = result.get(path,"")
+                    if a32:
+                        self.store(site,path,a32,sizes.get(path),mtimes.get(path))
+                        checksums[path] = a32
+        finally:
+            for path in locks.keys(): self.release(site,path,locks[path])
+
+        # Wait for files computed by other processes. If they failed, try again here.
+        for path in busy_list:
+            lock_fd = self.acquire(site,path,True)
+            try:
+                a32 = self.lookup(site,path,sizes.get(path),mtimes.get(path),not_before)
+                if not a32:
+                    a32 = function(*(args+([path],))).get(path,"")
+                    self.store(site,path,a32,sizes.get(path),mtimes.get(path))
+                if a32: checksums[path] = a32
+            finally:
+                self.release(site,path,lock_fd)
+
+    def lock_file(self,site,path):
+        return "%s/%s.lock"%(self.lock_dir,hashlib.md5("%s %s"%(site,path)).hexdigest())
+
+    def acquire(self,site,path,wait):
+
+        # Lock file used to compute checksum of path at site. Return file descriptor of the
+        # lock file or None if wait is False and the file is locked by someone else.
+        lock_file = self.lock_file(site,path)
+        while True:
+            fd = os.open(lock_file,os.O_RDWR|os.O_CREAT,0664)
+            try:
+                if wait:
+                    fcntl.flock(fd,fcntl.LOCK_EX)
+                else:
+                    fcntl.flock(fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except IOError:
+                os.close(fd)
+                return None
+            # Lock file may have been removed by its previous owner while we were waiting
+            try:
+                if os.fstat(fd).st_ino == os.stat(lock_file).st_ino: return fd
+            except OSError:
+                pass
+            os.close(fd)
+
+    def release(self,site,path,fd):
+
+        # Remove lock file before unlocking it: processes waiting on it will create a new one
+        try:
+            os.unlink(self.lock_file(site,path))
+        except OSError:
+            pass
+        os.close(fd)
+
+    def close(self):
+
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
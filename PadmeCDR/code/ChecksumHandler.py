@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+import re
+import shlex
+import Queue
+import threading
+import subprocess
+
+from Logger import start_thread
+
+class ChecksumHandler:
+
+    def __init__(self,SH=None):
+
+        # Set to 1 or more to enable printout of executed commands
+        self.debug = 0
+
+        # SSH handler used to run remote commands (optional)
+        self.SH = SH
+
+        # Maximum number of files handled by a single remote command
+        self.batch_size = 200
+
+        # Number of adler32 processes running in parallel on the remote host
+        self.remote_jobs = 4
+
+        # Number of gfal-sum commands running in parallel for SRM sites
+        self.srm_jobs = 8
+
+        # Timeout for gfal-sum commands (in seconds)
+        self.gfal_timeout = 600
+
+    def iter_checksums_ssh(self,ssh,adler32_cmd,top_dir,file_list,jobs=0):
+
+        # Compute adler32 checksum of a list of files (paths relative to top_dir) with one
+        # remote command for each batch of files. Return (file,checksum) pairs as they arrive.
+        if not jobs: jobs = self.remote_jobs
+        if jobs > 1:
+            xargs = "xargs -n 1 -P %d"%jobs
+        else:
+            xargs = "xargs -n 1"
+        for i in range(0,len(file_list),self.batch_size):
+            batch = file_list[i:i+self.batch_size]
+            # Output of each adler32 process is written with a single echo so that lines from
+            # processes running in parallel do not get mixed
+            cmd = "%s \'( cd %s && printf \"%%s\\n\" %s | %s sh -c \"echo \\$(%s \\$0)\" )\'"%(ssh,top_dir," ".join(batch),xargs,adler32_cmd)
+            for line in self.run_command(cmd):
+                if not line.strip(): continue
+                m = re.match("^\s*(\S+)\s+(\S+)\s*$",line)
+                if m and (m.group(2) in batch):
+                    yield (m.group(2),m.group(1))
+                else:
+                    print "- WARNING - Unexpected output from adler32: %s"%line.rstrip()
+
+    def get_checksums_ssh(self,ssh,adler32_cmd,top_dir,file_list,jobs=0):
+
+        # Return dictionary file -> adler32 checksum. Files with errors are not included.
+        checksums = {}
+        for (path,a32) in self.iter_checksums_ssh(ssh,adler32_cmd,top_dir,file_list,jobs):
+            checksums[path] = a32
+        return checksums
+
+    def get_checksum_srm(self,url):
+
+        a32 = ""
+        cmd = "gfal-sum -t %d %s adler32"%(self.gfal_timeout,url)
+        for line in self.run_command(cmd):
+            m = re.match("^\s*\S+\s+(\S+)\s*$",line)
+            if m:
+                a32 = m.group(1)
+            else:
+                print "- WARNING - Unexpected output from gfal-sum: %s"%line.rstrip()
+        return a32
+
+    def get_checksums_srm(self,srm_dir,file_list,jobs=0):
+
+        # Get checksum of a list of files (paths relative to srm_dir) running several
+        # gfal-sum commands in parallel. Return dictionary file -> adler32 checksum.
+        if not jobs: jobs = self.srm_jobs
+        checksums = {}
+        lock = threading.Lock()
+        files = Queue.Queue()
+        for path in file_list: files.put(path)
+        threads = []
+        for i in range(min(jobs,len(file_list))):
+            threads.append(start_thread(self.srm_worker,(srm_dir,files,checksums,lock)))
+        for t in threads: t.join()
+        return checksums
+
+    def srm_worker(self,srm_dir,files,checksums,lock):
+
+        while True:
+            try:
+                path = files.get_nowait()
+            except Queue.Empty:
+                return
+            a32 = self.get_checksum_srm("%s/%s"%(srm_dir,path))
+            if a32:
+                with lock: checksums[path] = a32
+
+    def run_command(self,command):
+
+        # Run command and return its output (stdout and stderr) one line at a time
+        if self.debug: print "> %s"%command
+        if self.SH:
+            with self.SH.session(command):
+                for line in self.read_command(command): yield line
+        else:
+            for line in self.read_command(command): yield line
+
+    def read_command(self,command):
+
+        p = subprocess.Popen(shlex.split(command),stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        for line in iter(p.stdout.readline,b''): yield line
+        p.wait()
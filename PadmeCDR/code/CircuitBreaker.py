@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+import time
+import threading
+
+class CircuitBreaker:
+
+    def __init__(self,site,failure_threshold=3):
+
+        # Name of the site whose health is tracked (only used in printouts)
+        self.site = site
+
+        # Site is declared unhealthy (breaker "open") after failure_threshold consecutive failures
+        self.failure_threshold = failure_threshold
+
+        # While open, a single probe request is allowed after open_delay seconds (breaker goes
+        # "half-open"). If the probe fails the delay is doubled, up to max_open_delay.
+        self.first_open_delay = 120
+        self.max_open_delay = 1800
+
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.open_delay = self.first_open_delay
+        self.opened_at = 0
+
+    def available(self):
+
+        # Return True if work on the site can proceed
+        with self.lock:
+            return (self.state == "closed")
+
+    def try_probe(self):
+
+        # Return True if the breaker is open and the probe time has come. The caller must then
+        # send one probe request to the site and record its result.
+        with self.lock:
+            if self.state != "open": return False
+            if time.time()-self.opened_at < self.open_delay: return False
+            self.state = "half-open"
+        print "CircuitBreaker - Site %s - Sending probe request"%self.site
+        return True
+
+    def record_success(self):
+
+        with self.lock:
+            if self.state != "closed":
+                print "CircuitBreaker - Site %s - Site is healthy again: resuming work"%self.site
+            self.state = "closed"
+            self.failures = 0
+            self.open_delay = self.first_open_delay
+
+    def record_failure(self):
+
+        with self.lock:
+            self.failures += 1
+            if self.state == "half-open":
+                # Probe failed: wait longer before next probe
+                self.open_delay = min(2*self.open_delay,self.max_open_delay)
+                self.state = "open"
+                self.opened_at = time.time()
+                print "CircuitBreaker - Site %s - Probe failed: next probe in %ds"%(self.site,self.open_delay)
+            elif (self.state == "closed") and (self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.time()
+                print "CircuitBreaker - Site %s - %d consecutive failures: pausing work on site for %ds"%(self.site,self.failures,self.open_delay)
+
+    def status(self):
+        with self.lock:
+            return "%s %s (%d failures)"%(self.site,self.state,self.failures)
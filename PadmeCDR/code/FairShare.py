@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+import threading
+
+class FairShare:
+
+    def __init__(self,capacity):
+
+        # Maximum number of transfers which can run at the same time for all routes together
+        self.capacity = capacity
+
+        # Slots in use and number of requests waiting for each route
+        self.used = {}
+        self.waiting = {}
+
+        self.cond = threading.Condition()
+
+    def is_next(self,route):
+
+        # A free slot goes to the waiting route which is using the fewest slots
+        # N.B. lock must be held by caller
+        if sum(self.used.values()) >= self.capacity: return False
+        fewest = min([ self.used.get(r,0) for r in self.waiting if self.waiting[r] ])
+        return (self.used.get(route,0) <= fewest)
+
+    def acquire(self,route,check=None):
+
+        # Wait until route can use one more slot and take it
+        # While waiting, call check function (if any) about once per second
+        with self.cond:
+            self.waiting[route] = self.waiting.get(route,0)+1
+        try:
+            while True:
+                with self.cond:
+                    if self.is_next(route):
+                        self.used[route] = self.used.get(route,0)+1
+                        return
+                    self.cond.wait(1.)
+                if check: check()
+        finally:
+            with self.cond:
+                self.waiting[route] -= 1
+                self.cond.notify_all()
+
+    def release(self,route):
+
+        with self.cond:
+            self.used[route] -= 1
+            self.cond.notify_all()
+
+    def status(self):
+
+        # Return dictionary with number of slots used by each route
+        with self.cond:
+            return dict(self.used)
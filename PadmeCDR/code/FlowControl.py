@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import time
+import threading
+
+class FlowControl:
+
+    def __init__(self,get_space,high=95.,low=85.):
+
+        # Function returning (total,free) space of the destination disk buffer in bytes
+        # It must return (0,0) if space cannot be measured
+        self.get_space = get_space
+
+        # Copies are paused when the buffer occupancy (in %) would go above the high watermark
+        # and resumed when tape migration brings it below the low watermark
+        self.high = high
+        self.low = low
+
+        # Measured space is trusted for ttl seconds (poll_interval while copies are paused)
+        self.ttl = 300
+        self.poll_interval = 60
+
+        # Expected size of a file when its real size is not known
+        self.file_size = 2*1024**3
+
+        self.lock = threading.Lock()
+        self.total = 0
+        self.used = 0
+        self.measured_at = 0
+        self.paused = False
+
+        # Bytes sent to the buffer after the last measurement and bytes still being sent
+        self.completed = 0
+        self.in_flight = 0
+
+    def refresh(self,max_age):
+
+        # Measure space again if last measurement is older than max_age
+        with self.lock:
+            if time.time()-self.measured_at < max_age: return
+        (total,free) = self.get_space()
+        with self.lock:
+            self.measured_at = time.time()
+            self.total = total
+            self.used = total-free
+            self.completed = 0
+            if total:
+                print "FlowControl - Buffer occupancy %.1f%% (%d bytes being copied)"%(100.*self.used/total,self.in_flight)
+            else:
+                print "FlowControl - WARNING - Unable to measure buffer occupancy"
+
+    def occupancy(self,size=0):
+
+        # Expected occupancy (in %) if a file of given size is added
+        # Space used by copies in progress may be partially included in the measurement
+        if not self.total: return 100.
+        return 100.*(self.used+self.completed+self.in_flight+size)/self.total
+
+    def acquire(self,size=0,check=None):
+
+        # Wait until there is room for a file of given size (expected size if not known)
+        # While waiting, call check function (if any) about once per second
+        # Return size debited to the buffer, to be passed to release() when copy ends
+        if not size: size = self.file_size
+        while True:
+            if self.paused:
+                self.refresh(self.poll_interval)
+            else:
+                self.refresh(self.ttl)
+            with self.lock:
+                if self.paused and self.occupancy() < self.low:
+                    print "FlowControl - Buffer occupancy below %.0f%%: resuming copies"%self.low
+                    self.paused = False
+                if not self.paused:
+                    if self.occupancy(size) < self.high:
+                        self.in_flight += size
+                        return size
+                    print "FlowControl - Buffer occupancy would be above %.0f%%: pausing copies"%self.high
+                    self.paused = True
+            for i in range(self.poll_interval):
+                if check: check()
+                time.sleep(1)
+
+    def release(self,size,copied=True):
+
+        # Copy ended: if it was successful its data are now in the buffer
+        with self.lock:
+            self.in_flight -= size
+            if copied: self.completed += size
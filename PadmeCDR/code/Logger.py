@@ -1,5 +1,6 @@
 import sys
 import time
+import threading
 
 class Logger(object):
 
@@ -7,20 +8,33 @@ class Logger(object):
 
         self.interactive = False
 
-        self.terminal = sys.stdout
+        self.terminal = sys.__stdout__
         self.log = open(log_file,"a")
 
+        # Output is collected per thread and written one full line at a time
+        # so that messages from parallel transfers do not get mixed up
+        self.lock = threading.Lock()
+        self.pending = threading.local()
+
     def write(self, message):
 
-        if (message != "\n"):
-            msg = self.now_str()+" "+message
+        # Wait for the end of the line before writing anything
+        text = getattr(self.pending,"text","")+message
+        if not text.endswith("\n"):
+            self.pending.text = text
+            return
+        self.pending.text = ""
+
+        if (text != "\n"):
+            msg = self.now_str()+" "+text
         else:
-            msg = message
-        if self.interactive:
-            self.terminal.write(msg)
-            self.terminal.flush()
-        self.log.write(msg)
-        self.log.flush()
+            msg = text
+        with self.lock:
+            if self.interactive:
+                self.terminal.write(msg)
+                self.terminal.flush()
+            self.log.write(msg)
+            self.log.flush()
 
     def flush(self):
 
@@ -31,3 +45,36 @@ class Logger(object):
 
     def now_str(self):
         return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime())
+
+def start_thread(target,args=()):
+
+    # Run target in a new daemon thread writing to the same route log as the calling thread
+    t = threading.Thread(target=target,args=args)
+    t.daemon = True
+    t.cdr_log = getattr(threading.current_thread(),"cdr_log",None)
+    t.start()
+    return t
+
+class RouteLogger(object):
+
+    def __init__(self,default_log):
+
+        # A multi-route CDR daemon writes to one log file per route: each thread writes to the
+        # log of the route it works for, or to the default log. Threads started with start_thread
+        # use the log of the thread which started them, so that transfer threads write to the
+        # log of their route.
+        self.default_log = default_log
+
+    def set_log(self,log):
+
+        # Send output of current thread to log
+        threading.current_thread().cdr_log = log
+
+    def get_log(self):
+        return getattr(threading.current_thread(),"cdr_log",None) or self.default_log
+
+    def write(self, message):
+        self.get_log().write(message)
+
+    def flush(self):
+        pass
@@ -10,6 +10,7 @@ import subprocess
 
 from PadmeCDRServer import PadmeCDRServer
 from PadmeCDRList import PadmeCDRList
+from PadmeCDRDaemon import PadmeCDRDaemon
 
 # Define list of available data servers
 data_servers_list = [ "l1padme3", "l1padme4" ]
@@ -19,13 +20,24 @@ sites_list = [ "ALL", "DAQ", "LNF", "CNAF", "KLOE" ]
 source_sites_list = [ "DAQ", "LNF", "CNAF" ]
 destination_sites_list = [ "LNF", "CNAF", "KLOE" ]
 
+# Define list of policies to order pending transfers
+policies_list = [ "oldest", "newest", "largest" ]
+
+# Define list of modes to verify copies from DAQ
+verify_modes_list = [ "post", "inline", "sampled" ]
+
+# Define list of sites which can receive fan-out copies from DAQ
+fanout_sites_list = [ "LNF", "CNAF" ]
+
 # Define list of years of data taking
 years_list = [ "2018", "2019", "2020", "2021", "2022" ]
 
 def print_help():
-    print 'PadmeCDR [-S src_site -D dst_site] [-L site] [-s data_srv] [-Y year] [-a after] [-b before] [-i] [-h]'
+    print 'PadmeCDR [-S src_site -D dst_site] [-R route_table] [-L site] [-s data_srv] [-Y year] [-a after] [-b before] [-j jobs] [-B bw] [-O policy] [-V mode] [-F sites] [-n [-W jobs_list]] [-i] [-h]'
     print '  -S src_site     Source site %s'%source_sites_list
     print '  -D dst_site     Destination site %s'%destination_sites_list
+    print '  -R route_table  Serve all routes listed in route_table (one per line, e.g. "-S DAQ -s l1padme3 -D LNF -B 50:0") with a single daemon'
+    print '                  Routes accept options -S -D -s -a -b -j -B -O -V -F. With -R, -j sets the number of parallel copies for all routes'
     print '  -L site         Get list of files at site %s'%sites_list
     print '                  ALL will compare content of all sites (SLOW!)'
     print '  -s data_srv     Data server from which data are copied %s'%data_servers_list
@@ -33,6 +45,18 @@ def print_help():
     print '  -Y year         Specify year of data taking to copy. Default: current year'
     print '  -a after_date   Only transfer runs collected after specified date (included). Format: yyyymmdd. Default: no limit'
     print '  -b before_date  Only transfer runs collected before specified date (included). Format: yyyymmdd. Default: no limit'
+    print '  -j jobs         Number of files to copy in parallel. Default: depends on source/destination and on data taking'
+    print '  -B bw           Bandwidth limit in MB/s while a run is on-going on the DAQ server. Format: ongoing[:idle]'
+    print '                  Optional second value is used while DAQ is idle. 0 means no limit. Default: depends on source/destination'
+    print '  -O policy       Order of pending transfers %s. Default: depends on source/destination'%policies_list
+    print '                  Runs listed in $PADME_CDR_DIR/run/PadmeCDR_pinned_runs.list are always copied first'
+    print '  -V mode         Verification of copies from DAQ %s. Default: depends on source/destination'%verify_modes_list
+    print '                  post: compare checksums after the copy, inline: let gfal-copy verify the copy, sampled: post for 10% of the files, inline for the others'
+    print '  -F sites        Comma separated list of sites %s which receive a copy of each file copied from DAQ to dst_site'%fanout_sites_list
+    print '                  DAQ data are read once: copies are made from dst_site and checked against the checksum at DAQ'
+    print '                  Fan-out to a site with its own running route from the same DAQ server is refused'
+    print '  -n              Do not copy files: print plan of pending transfers with ETA in JSON format and exit'
+    print '  -W jobs_list    Comma separated numbers of parallel copies used to compute ETA in plan mode. Default: 1,2,4,8,16'
     print '  -i              Run the PadmeCDR server in interactive mode'
     print '  -h              Show this help message and exit'
 
@@ -43,7 +67,7 @@ def main(argv):
     cdr_dir = os.getenv('PADME_CDR_DIR',".")
 
     try:
-        opts,args = getopt.getopt(argv,"iS:D:L:s:Y:a:b:h")
+        opts,args = getopt.getopt(argv,"inS:D:R:L:s:Y:a:b:j:B:O:V:F:W:h")
     except getopt.GetoptError:
         print_help()
         sys.exit(2)
@@ -53,9 +77,17 @@ def main(argv):
     source_site = ""
     destination_site = ""
     list_site = ""
+    route_table = ""
     date_after = ""
     date_before = ""
+    jobs = 0
+    bandwidth = None
+    policy = ""
+    verify_mode = ""
+    fanout = None
     serverInteractive = False
+    planMode = False
+    whatif = None
     for opt,arg in opts:
         if opt == '-h':
             print_help()
@@ -66,6 +98,8 @@ def main(argv):
             source_site = arg
         elif opt == '-D':
             destination_site = arg
+        elif opt == '-R':
+            route_table = arg
         elif opt == '-L':
             list_site = arg
         elif opt == '-Y':
@@ -74,6 +108,50 @@ def main(argv):
             date_after = arg
         elif opt == '-b':
             date_before = arg
+        elif opt == '-j':
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = -1
+            if jobs < 1:
+                print "ERROR - Number of parallel jobs must be a positive integer: %s"%arg
+                print_help()
+                sys.exit(2)
+        elif opt == '-B':
+            m = re.match("^(\d+)(:(\d+))?$",arg)
+            if not m:
+                print "ERROR - Bandwidth must be given as ongoing[:idle] in MB/s: %s"%arg
+                print_help()
+                sys.exit(2)
+            bandwidth = (int(m.group(1)),None)
+            if m.group(3): bandwidth = (int(m.group(1)),int(m.group(3)))
+        elif opt == '-O':
+            if (not arg in policies_list):
+                print "ERROR - Transfer policy",arg,"is unknown. Use one of",policies_list
+                print_help()
+                sys.exit(2)
+            policy = arg
+        elif opt == '-V':
+            if (not arg in verify_modes_list):
+                print "ERROR - Verification mode",arg,"is unknown. Use one of",verify_modes_list
+                print_help()
+                sys.exit(2)
+            verify_mode = arg
+        elif opt == '-F':
+            fanout = arg.split(",")
+            for site in fanout:
+                if (not site in fanout_sites_list):
+                    print "ERROR - Fan-out site",site,"is unknown. Use one of",fanout_sites_list
+                    print_help()
+                    sys.exit(2)
+        elif opt == '-n':
+            planMode = True
+        elif opt == '-W':
+            if not re.match("^\d+(,\d+)*$",arg):
+                print "ERROR - List of parallel jobs must be given as comma separated integers: %s"%arg
+                print_help()
+                sys.exit(2)
+            whatif = [ int(j) for j in arg.split(",") if int(j) > 0 ]
         elif opt == '-i':
             serverInteractive = True
 
@@ -89,6 +167,15 @@ def main(argv):
         print_help()
         sys.exit(2)
 
+    # Check that route table was not specified with a single route or a list site
+    if ( route_table and (list_site or source_site or destination_site or planMode) ):
+        print "ERROR - Route table",route_table,"cannot be used with -L, -S, -D or -n options"
+        print_help()
+        sys.exit(2)
+    if ( route_table and not os.path.isfile(route_table) ):
+        print "ERROR - Route table",route_table,"does not exist"
+        sys.exit(2)
+
     # When source/list is DAQ, check if data server was correctly specified
     if ( (source_site == "DAQ" or list_site == "DAQ") and not (data_server in data_servers_list) ):
         if (data_server):
@@ -118,6 +205,27 @@ def main(argv):
 
         PadmeCDRList(list_site,data_server)
 
+    elif ( route_table ):
+
+        print "Starting PadmeCDRDaemon with routes from",route_table
+
+        # Create long-lived proxy file (will ask user for password)
+        long_proxy_file = "%s/run/long_proxy"%cdr_dir
+        print "- Creating long-lived proxy file",long_proxy_file
+        proxy_cmd = "voms-proxy-init --valid 720:00 --out %s"%long_proxy_file
+        print ">",proxy_cmd
+        if subprocess.call(proxy_cmd.split()):
+            print "*** ERROR *** while generating long-lived proxy. Aborting"
+            sys.exit(2)
+
+        # Route table path must survive the change of working directory of the daemon
+        route_table = os.path.abspath(route_table)
+        if serverInteractive:
+            PadmeCDRDaemon(route_table,year,"i",jobs)
+        else:
+            print "Starting PadmeCDRDaemon in background"
+            with daemon.DaemonContext(working_directory="."): PadmeCDRDaemon(route_table,year,"d",jobs)
+
     else:
 
         # Check if source site is valid
@@ -138,13 +246,36 @@ def main(argv):
             print_help()
             sys.exit(2)
 
+        # Fan-out is only possible for copies from DAQ to a storage element
+        if fanout:
+            if ( source_site != "DAQ" or not destination_site in fanout_sites_list ):
+                print "ERROR - Fan-out is only supported for copies from DAQ to one of",fanout_sites_list
+                print_help()
+                sys.exit(2)
+            if destination_site in fanout:
+                print "ERROR - Fan-out sites must be different from destination site",destination_site
+                print_help()
+                sys.exit(2)
+
+        # In plan mode the long-lived proxy of the running servers is used, if present
+        long_proxy_file = "%s/run/long_proxy"%cdr_dir
+        if planMode:
+            if not os.path.exists(long_proxy_file):
+                print "- Creating long-lived proxy file",long_proxy_file
+                proxy_cmd = "voms-proxy-init --valid 720:00 --out %s"%long_proxy_file
+                print ">",proxy_cmd
+                if subprocess.call(proxy_cmd.split()):
+                    print "*** ERROR *** while generating long-lived proxy. Aborting"
+                    sys.exit(2)
+            PadmeCDRServer(source_site,destination_site,data_server,year,date_after,date_before,"n",jobs,bandwidth,policy,whatif,verify_mode)
+            sys.exit(0)
+
         if (source_site == "DAQ"):
             print "Starting PadmeCDRServer with source",source_site,"server",data_server,"and destination",destination_site
         else:
             print "Starting PadmeCDRServer with source",source_site,"and destination",destination_site
 
         # Create long-lived proxy file (will ask user for password)
-        long_proxy_file = "%s/run/long_proxy"%cdr_dir
         print "- Creating long-lived proxy file",long_proxy_file
         proxy_cmd = "voms-proxy-init --valid 720:00 --out %s"%long_proxy_file
         print ">",proxy_cmd
@@ -153,10 +284,10 @@ def main(argv):
             sys.exit(2)
 
         if serverInteractive:
-            PadmeCDRServer(source_site,destination_site,data_server,year,date_after,date_before,"i")
+            PadmeCDRServer(source_site,destination_site,data_server,year,date_after,date_before,"i",jobs,bandwidth,policy,None,verify_mode,fanout=fanout)
         else:
             print "Starting PadmeCDRServer in background"
-            with daemon.DaemonContext(working_directory="."): PadmeCDRServer(source_site,destination_site,data_server,year,date_after,date_before,"d")
+            with daemon.DaemonContext(working_directory="."): PadmeCDRServer(source_site,destination_site,data_server,year,date_after,date_before,"d",jobs,bandwidth,policy,None,verify_mode,fanout=fanout)
 
 # Execution starts here
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import getopt
+
+from ReplicaCatalog import ReplicaCatalog
+from RetryQueue import RetryQueue
+from TransferJournal import TransferJournal
+
+def print_help():
+    print 'PadmeCDRCatalog [-F file] [-R run] [-I site] [-X run] [-Q] [-U file] [-J] [-h]'
+    print '  -F file         Show all known copies of file (run/file or file name)'
+    print '  -R run          Show all known copies of files in run and the routes for which the run is complete'
+    print '  -I site         Show runs with files which are known elsewhere but are missing at site'
+    print '  -X run          Forget completion status of run so that it is checked again by the CDR servers'
+    print '  -Q              Show files waiting for a new copy attempt or quarantined after too many failures'
+    print '  -U file         Take file (run/file or file name) out of quarantine and retry it right away'
+    print '  -J              Show copies in progress or left unfinished by a CDR server which did not exit cleanly'
+    print '  -h              Show this help message and exit'
+
+def time_str(t):
+    if t is None: return "-"
+    return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime(t))
+
+def main(argv):
+
+    # Get position of CDR main directory from PADME_CDR_DIR environment variable
+    # Default to current dir if not set
+    cdr_dir = os.getenv('PADME_CDR_DIR',".")
+
+    try:
+        opts,args = getopt.getopt(argv,"F:R:I:X:QU:Jh")
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+
+    file_name = ""
+    run_name = ""
+    site_name = ""
+    clear_run = ""
+    show_queue = False
+    release_file = ""
+    show_journal = False
+    for opt,arg in opts:
+        if opt == '-h':
+            print_help()
+            sys.exit()
+        elif opt == '-F':
+            file_name = arg
+        elif opt == '-R':
+            run_name = arg
+        elif opt == '-I':
+            site_name = arg
+        elif opt == '-X':
+            clear_run = arg
+        elif opt == '-Q':
+            show_queue = True
+        elif opt == '-U':
+            release_file = arg
+        elif opt == '-J':
+            show_journal = True
+
+    if not (file_name or run_name or site_name or clear_run or show_queue or release_file or show_journal):
+        print "*** ERROR *** No action requested"
+        print_help()
+        sys.exit(2)
+
+    catalog_file = "%s/run/PadmeCDRCatalog.db"%cdr_dir
+    if not os.path.exists(catalog_file):
+        print "*** ERROR *** Catalog file %s does not exist"%catalog_file
+        sys.exit(2)
+    catalog = ReplicaCatalog(catalog_file)
+
+    if file_name:
+        replicas = catalog.where_is(file_name)
+        if not replicas:
+            print "File %s is not in the catalog"%file_name
+        for (site,rawfile,size,adler32,seen_at,verified_at,verified_by) in replicas:
+            if size is None: size = "-"
+            if adler32 is None: adler32 = "-"
+            msg = "%-14s %s size %s adler32 %s seen %s verified %s"%(site,rawfile,size,adler32,time_str(seen_at),time_str(verified_at))
+            if verified_by: msg += " (%s)"%verified_by
+            print msg
+
+    if run_name:
+        replicas = catalog.get_run_replicas(run_name)
+        if not replicas:
+            print "Run %s is not in the catalog"%run_name
+        for (rawfile,site,size,adler32) in replicas:
+            if size is None: size = "-"
+            if adler32 is None: adler32 = "-"
+            print "%s %-14s size %s adler32 %s"%(rawfile,site,size,adler32)
+        for (source,destination,n_files,completed_at) in catalog.get_run_transfers(run_name):
+            print "Run %s complete from %s to %s (%d files) on %s"%(run_name,source,destination,n_files,time_str(completed_at))
+
+    if site_name:
+        for (run,n_missing,n_files) in catalog.get_incomplete_runs(site_name):
+            print "%s %d/%d files missing at %s"%(run,n_missing,n_files,site_name)
+
+    if clear_run:
+        catalog.clear_run_complete(clear_run)
+        print "Completion status of run %s was cleared"%clear_run
+
+    if show_queue or release_file:
+        queue = RetryQueue(catalog_file)
+        if show_queue:
+            for (source,destination,rawfile,copy_failures,checksum_failures,last_reason,last_failure_at,next_at,quarantined) in queue.get_entries():
+                if quarantined:
+                    status = "QUARANTINED"
+                else:
+                    status = "retry after %s"%time_str(next_at)
+                print "%s %s -> %s copy errors %d checksum errors %d last %s error on %s %s"%(rawfile,source,destination,copy_failures,checksum_failures,last_reason,time_str(last_failure_at),status)
+        if release_file:
+            n = queue.release(release_file)
+            if n:
+                print "File %s released from retry queue (%d routes)"%(release_file,n)
+            else:
+                print "File %s is not in the retry queue"%release_file
+        queue.close()
+
+    if show_journal:
+        journal = TransferJournal(catalog_file)
+        for (source,destination,rawfile,state,adler32,pid,updated_at) in journal.get_entries():
+            if state == "committed": continue
+            if adler32 is None: adler32 = "-"
+            if pid is None: pid = "-"
+            print "%s %s -> %s %s on %s by process %s adler32 %s"%(rawfile,source,destination,state,time_str(updated_at),pid,adler32)
+        journal.close()
+
+    catalog.close()
+
+# Execution starts here
+if __name__ == "__main__":
+    main(sys.argv[1:])
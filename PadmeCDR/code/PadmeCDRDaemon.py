@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+import os
+import re
+import sys
+import time
+import getopt
+import threading
+import traceback
+
+from Logger import Logger, RouteLogger
+from ProxyHandler import ProxyHandler
+from SSHHandler import SSHHandler
+from ChecksumHandler import ChecksumHandler
+from ChecksumCache import ChecksumCache
+from StreamCopy import StreamCopy
+from StagingArea import StagingArea
+from FairShare import FairShare
+from PadmeCDRServer import PadmeCDRServer
+
+class PadmeCDRDaemon:
+
+    def __init__(self,route_file,year,mode,jobs=0):
+
+        # Get position of CDR main directory from PADME_CDR_DIR environment variable
+        # Default to current dir if not set
+        self.cdr_dir = os.getenv('PADME_CDR_DIR',".")
+
+        self.route_file = route_file
+        self.year = year
+        self.mode = mode
+
+        # Each route writes to its own log file (the same used by a single-route server)
+        # Messages which do not belong to a route go to the daemon log file
+        self.log_file = "%s/log/PadmeCDRDaemon.log"%self.cdr_dir
+        self.logger = Logger(self.log_file)
+        if mode == "i": self.logger.interactive = True
+        self.route_logger = RouteLogger(self.logger)
+        sys.stdout = self.route_logger
+        sys.stderr = sys.stdout
+
+        print ""
+        print "### PadmeCDRDaemon Initializing ###"
+        print "Route table: %s"%self.route_file
+        print "Year of data taking: %s"%self.year
+        print ""
+
+        # Create lock file
+        self.lock_file = "%s/run/PadmeCDRDaemon.lock"%self.cdr_dir
+        if (self.create_lock_file() == "error"): exit(1)
+
+        # Path to stop file: when file appears, all routes are stopped and the daemon exits
+        # Single routes are stopped with the stop file of the route, as for a single-route server
+        self.stop_cdr_file = "%s/run/PadmeCDRDaemon.stop"%self.cdr_dir
+
+        # Sites and options accepted in the route table
+        self.source_sites = [ "DAQ", "LNF", "CNAF" ]
+        self.destination_sites = [ "LNF", "CNAF", "KLOE" ]
+        self.policies = [ "oldest", "newest", "largest" ]
+        self.verify_modes = [ "post", "inline", "sampled" ]
+        self.fanout_sites = [ "LNF", "CNAF" ]
+
+        self.routes = self.read_route_table()
+        if not self.routes:
+            print "ERROR - No valid route found in route table %s"%self.route_file
+            self.remove_lock_file()
+            exit(1)
+
+        # Maximum number of copies running at the same time for all routes together (each
+        # route also keeps its own limit). A free slot goes to the route with fewest copies.
+        self.capacity_default = 12
+        if jobs:
+            self.capacity = FairShare(jobs)
+        else:
+            self.capacity = FairShare(self.capacity_default)
+        print "Parallel transfers for all routes: %d"%self.capacity.capacity
+
+        # Run lists of a site are shared by routes listing it less than listing_share_time
+        # seconds apart. Routes listing the same site at the same time wait for a single listing.
+        self.listing_share_time = 300
+        self.listings = {}
+        self.listing_locks = {}
+        self.listing_lock = threading.Lock()
+
+        # Proxy, ssh connections, checksums and staging area are shared by all routes
+        self.PH = ProxyHandler()
+        self.PH.long_proxy_file = "%s/run/long_proxy"%self.cdr_dir
+        self.PH.debug = 1
+        self.PH.start_renewal_thread()
+
+        self.SH = SSHHandler()
+
+        self.CH = ChecksumHandler(self.SH)
+        self.CH.debug = 1
+
+        self.CC = ChecksumCache("%s/run"%self.cdr_dir)
+
+        self.SC = StreamCopy(self.SH)
+        self.SC.debug = 1
+
+        self.staging_dir = os.getenv('PADME_CDR_STAGING_DIR',"/tmp/PadmeCDR_staging")
+        self.SA = StagingArea(self.staging_dir)
+
+        # Check every 10 seconds if routes are still running or if a stop was requested
+        self.poll_interval = 10
+
+        self.main_loop()
+
+    def create_lock_file(self):
+
+        print "- Creating lock file %s"%self.lock_file
+
+        # Check if lock file exists and if the process which created it is still running
+        if (os.path.exists(self.lock_file)):
+            if (os.path.isfile(self.lock_file)):
+                pid = 0
+                with open(self.lock_file,"r") as lf:
+                    for ll in lf: pid = ll.strip()
+                print "Lock file %s found for pid %s - checking status"%(self.lock_file,pid)
+                ppinfo = os.popen("ps -p %s"%pid)
+                pinfo = ppinfo.readlines()
+                ppinfo.close()
+                if ( len(pinfo) == 2 and pinfo[1].find("<defunct>") == -1 ):
+                    print "ERROR - there is already a PadmeCDRDaemon running with pid %s"%pid
+                    return "error"
+                print "No PadmeCDRDaemon process found. As you were..."
+            else:
+                print "ERROR - Lock file %s found but it is not a file"%self.lock_file
+                return "error"
+
+        with open(self.lock_file,"w") as lf:
+            lf.write("%d\n"%os.getpid())
+
+        return "ok"
+
+    def remove_lock_file(self):
+        print "- Removing lock file %s"%self.lock_file
+        if (os.path.isfile(self.lock_file)): os.remove(self.lock_file)
+
+    def read_route_table(self):
+
+        # Each line of the route table defines one route with the same options used to start
+        # a single-route server, e.g. "-S DAQ -s l1padme3 -D LNF -B 50:0". Accepted options:
+        #   -S src_site -D dst_site -s data_srv -a after -b before -j jobs -B bw -O policy -V mode -F sites
+        # Empty lines and lines starting with # are ignored.
+        routes = []
+        try:
+            with open(self.route_file,"r") as rf:
+                lines = rf.readlines()
+        except IOError as e:
+            print "ERROR - Unable to read route table %s: %s"%(self.route_file,e)
+            return routes
+        for line in lines:
+            line = line.split("#")[0].strip()
+            if not line: continue
+            route = self.parse_route(line)
+            if route is None:
+                print "WARNING - Route \"%s\" is not valid: ignoring it"%line
+                continue
+            if [ r for r in routes if r["id"] == route["id"] ]:
+                print "WARNING - Route %s is defined twice: ignoring \"%s\""%(route["id"],line)
+                continue
+            routes.append(route)
+
+        # Fan-out to a site which has its own route from the same DAQ server is refused: the
+        # same files would be read twice from DAQ
+        for route in routes:
+            if not route["fanout"]: continue
+            for site in list(route["fanout"]):
+                if [ r for r in routes if r["id"] == "DAQ_%s_%s"%(route["server"],site) ]:
+                    print "WARNING - Route DAQ_%s_%s is defined: refusing fan-out to %s in route %s"%(route["server"],site,site,route["id"])
+                    route["fanout"].remove(site)
+        return routes
+
+    def parse_route(self,line):
+
+        # Return route defined in line as a dictionary, None if line is not valid
+        try:
+            opts,args = getopt.getopt(line.split(),"S:s:D:a:b:j:B:O:V:F:")
+        except getopt.GetoptError:
+            return None
+        route = { "src": "", "dst": "", "server": "", "after": "", "before": "", "jobs": 0, "bandwidth": None, "policy": "", "verify": "", "fanout": None }
+        for opt,arg in opts:
+            if opt == '-S':
+                route["src"] = arg
+            elif opt == '-D':
+                route["dst"] = arg
+            elif opt == '-s':
+                route["server"] = arg
+            elif opt == '-a':
+                route["after"] = arg
+            elif opt == '-b':
+                route["before"] = arg
+            elif opt == '-j':
+                if not (arg.isdigit() and int(arg) > 0): return None
+                route["jobs"] = int(arg)
+            elif opt == '-B':
+                m = re.match("^(\d+)(:(\d+))?$",arg)
+                if not m: return None
+                route["bandwidth"] = (int(m.group(1)),None)
+                if m.group(3): route["bandwidth"] = (int(m.group(1)),int(m.group(3)))
+            elif opt == '-O':
+                route["policy"] = arg
+            elif opt == '-V':
+                route["verify"] = arg
+            elif opt == '-F':
+                route["fanout"] = arg.split(",")
+        if ( args or not (route["src"] in self.source_sites and route["dst"] in self.destination_sites) ): return None
+        if ( route["src"] == "DAQ" and not route["server"] ): return None
+        if ( route["policy"] and not route["policy"] in self.policies ): return None
+        if ( route["verify"] and not route["verify"] in self.verify_modes ): return None
+        if route["fanout"]:
+            if ( route["src"] != "DAQ" or not route["dst"] in self.fanout_sites ): return None
+            for site in route["fanout"]:
+                if ( site == route["dst"] or not site in self.fanout_sites ): return None
+        for date in (route["after"],route["before"]):
+            if ( date and not re.match("^\d{8}$",date) ): return None
+
+        # Same id used by the server for its log, lock and stop files
+        if (route["src"] == "DAQ"):
+            route["id"] = "%s_%s_%s"%(route["src"],route["server"],route["dst"])
+        else:
+            route["id"] = "%s_%s"%(route["src"],route["dst"])
+        return route
+
+    def get_signatures(self,key,function,args):
+
+        # Return signatures of run directories identified by key (site and data directory)
+        # The site is listed with function(*args) unless another route listed it recently
+        with self.listing_lock:
+            if not key in self.listing_locks: self.listing_locks[key] = threading.Lock()
+            lock = self.listing_locks[key]
+        with lock:
+            if key in self.listings:
+                (listed_at,signatures) = self.listings[key]
+                if (time.time()-listed_at < self.listing_share_time):
+                    print "Using run list of %s taken %ds ago"%(key,time.time()-listed_at)
+                    return dict(signatures)
+            signatures = function(*args)
+            if signatures is not None: self.listings[key] = (time.time(),signatures)
+            return signatures
+
+    def run_route(self,route):
+
+        # Run the server of one route (runs in a route thread until the route is stopped)
+        try:
+            PadmeCDRServer(route["src"],route["dst"],route["server"],self.year,route["after"],route["before"],self.mode,
+                           route["jobs"],route["bandwidth"],route["policy"],None,route["verify"],self,
+                           route["fanout"])
+        except SystemExit:
+            pass
+        except Exception:
+            print "- ERROR - Unexpected exception in route %s\n%s"%(route["id"],traceback.format_exc().rstrip())
+        finally:
+            # Back to the daemon log
+            self.route_logger.set_log(None)
+            print "Route %s stopped"%route["id"]
+
+    def main_loop(self):
+
+        print ""
+        print "### PadmeCDRDaemon ### Starting %d routes ###"%len(self.routes)
+        print ""
+
+        threads = {}
+        for route in self.routes:
+            print "Starting route %s"%route["id"]
+            threads[route["id"]] = threading.Thread(target=self.run_route,args=(route,))
+            threads[route["id"]].daemon = True
+            threads[route["id"]].start()
+
+        # Wait until all routes are stopped
+        stopping = False
+        while [ t for t in threads.values() if t.is_alive() ]:
+            if ( (not stopping) and os.path.exists(self.stop_cdr_file) ):
+                print "- Stop request file %s found: stopping all routes..."%self.stop_cdr_file
+                if (os.path.isfile(self.stop_cdr_file)): os.remove(self.stop_cdr_file)
+                for route in self.routes:
+                    if threads[route["id"]].is_alive():
+                        with open("%s/run/PadmeCDRServer_%s.stop"%(self.cdr_dir,route["id"]),"w") as sf: sf.write("")
+                stopping = True
+            time.sleep(self.poll_interval)
+
+        self.remove_lock_file()
+        print ""
+        print "### PadmeCDRDaemon ### Exiting ###"
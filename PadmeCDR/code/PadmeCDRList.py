@@ -7,6 +7,7 @@ import subprocess
 import re
 
 from Logger import Logger
+from SSHHandler import SSHHandler
 
 class PadmeCDRList:
 
@@ -26,6 +27,9 @@ class PadmeCDRList:
         # User running CDR
         self.cdr_user = os.environ['USER']
 
+        # Create ssh handler: all commands to the same remote account share one connection
+        self.SH = SSHHandler()
+
         # Path of current year rawdata wrt top daq directory
         self.year = time.strftime("%Y",time.gmtime())
         self.data_dir = "%s/rawdata"%self.year
@@ -48,7 +52,7 @@ class PadmeCDRList:
         self.daq_sftp = "sftp://%s%s"%(self.daq_server,self.daq_path)
 
         # SSH syntax to execute a command on the DAQ data server
-        self.daq_ssh = "ssh -i %s -l %s %s"%(self.daq_keyfile,self.daq_user,self.daq_server)
+        self.daq_ssh = self.SH.get_ssh(self.daq_keyfile,self.daq_user,self.daq_server)
 
         ##############################
         ### KLOE tape library data ###
@@ -69,7 +73,7 @@ class PadmeCDRList:
         self.kloe_sftp = "sftp://%s%s"%(self.kloe_server,self.kloe_path)
 
         # SSH syntax to execute a command on KLOE front end
-        self.kloe_ssh = "ssh -n -i %s -l %s %s"%(self.kloe_keyfile,self.kloe_user,self.kloe_server)
+        self.kloe_ssh = self.SH.get_ssh(self.kloe_keyfile,self.kloe_user,self.kloe_server,4,"-n")
 
         ###################################
         ### LNF and CNAF SRM sites data ###
@@ -98,7 +102,7 @@ class PadmeCDRList:
         if renew:
             cmd = "voms-proxy-init --noregen --cert %s --key %s --voms vo.padme.org --valid 24:00"%(self.long_proxy_file,self.long_proxy_file)
             #for line in self.run_command(cmd): print(line.rstrip())
-            self.run_command(cmd)
+            for line in self.run_command(cmd): pass
 
     def get_file_list_daq(self):
         self.daq_list = []
@@ -217,8 +221,10 @@ class PadmeCDRList:
         return a32
 
     def run_command(self,command):
-        p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
-        return iter(p.stdout.readline,b'')
+        with self.SH.session(command):
+            p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
+            for line in iter(p.stdout.readline,b''): yield line
+            p.wait()
 
     def now_str(self):
         return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime())
@@ -257,7 +263,7 @@ class PadmeCDRList:
 
             self.daq3_list = []
             self.daq_server = "l1padme3"
-            self.daq_ssh = "ssh -i %s -l %s %s"%(self.daq_keyfile,self.daq_user,self.daq_server)
+            self.daq_ssh = self.SH.get_ssh(self.daq_keyfile,self.daq_user,self.daq_server)
             if self.get_file_list_daq() == "error":
                 print "ERROR - DAQ server %s has problems: skippping"%self.daq_server
             else:
@@ -266,7 +272,7 @@ class PadmeCDRList:
 
             self.daq4_list = []
             self.daq_server = "l1padme4"
-            self.daq_ssh = "ssh -i %s -l %s %s"%(self.daq_keyfile,self.daq_user,self.daq_server)
+            self.daq_ssh = self.SH.get_ssh(self.daq_keyfile,self.daq_user,self.daq_server)
             if self.get_file_list_daq() == "error":
                 print "ERROR - DAQ server %s has problems: skippping"%self.daq_server
             else:
@@ -5,14 +5,32 @@ import sys
 import time
 import subprocess
 import re
+import json
+import random
 import shlex
+import calendar
+import threading
+import traceback
 
-from Logger import Logger
+from Logger import Logger, start_thread
 from ProxyHandler import ProxyHandler
+from TransferPool import TransferPool
+from ReplicaCatalog import ReplicaCatalog
+from SSHHandler import SSHHandler
+from ChecksumHandler import ChecksumHandler
+from ChecksumCache import ChecksumCache
+from StreamCopy import StreamCopy
+from StagingArea import StagingArea
+from FlowControl import FlowControl
+from RetryQueue import RetryQueue
+from CircuitBreaker import CircuitBreaker
+from BandwidthLimiter import BandwidthLimiter
+from TransferMetrics import TransferMetrics
+from TransferJournal import TransferJournal
 
 class PadmeCDRServer:
 
-    def __init__(self,source_site,destination_site,daq_server,year,date_after,date_before,mode):
+    def __init__(self,source_site,destination_site,daq_server,year,date_after,date_before,mode,jobs=0,bandwidth=None,policy="",whatif=None,verify_mode="",shared=None,fanout=None):
 
         # Get position of CDR main directory from PADME_CDR_DIR environment variable
         # Default to current dir if not set
@@ -33,11 +51,26 @@ class PadmeCDRServer:
         else:
             self.server_id += "%s_%s"%(self.src_site,self.dst_site)
 
+        # Routes served by a multi-route daemon share proxy, ssh connections, listings and
+        # transfer slots through the daemon (see PadmeCDRDaemon)
+        self.shared = shared
+
+        # In plan mode ("n") pending transfers are listed and printed in JSON format to standard
+        # output, without copying anything. Log messages go to a separate log file.
+        self.plan_mode = (mode == "n")
+
         # Redefine print to send output to log file
-        self.log_file = "%s/log/PadmeCDRServer_%s.log"%(self.cdr_dir,self.server_id)
-        sys.stdout = Logger(self.log_file)
-        sys.stderr = sys.stdout
-        if mode == "i": sys.stdout.interactive = True
+        if self.plan_mode:
+            self.log_file = "%s/log/PadmeCDRPlan_%s.log"%(self.cdr_dir,self.server_id)
+        else:
+            self.log_file = "%s/log/PadmeCDRServer_%s.log"%(self.cdr_dir,self.server_id)
+        self.logger = Logger(self.log_file)
+        if mode == "i": self.logger.interactive = True
+        if self.shared:
+            self.shared.route_logger.set_log(self.logger)
+        else:
+            sys.stdout = self.logger
+            sys.stderr = sys.stdout
 
         print ""
         print "### PadmeCDRServer Initializing ###"
@@ -51,12 +84,21 @@ class PadmeCDRServer:
         if self.date_before: print "            to date: %s"%self.date_before
         print ""
 
-        # Define file to store list of files with transfer errors
+        # Old file with list of files with transfer errors (now imported in the retry queue)
         self.transfer_error_list_file = "%s/log/transfer_error_%s.list"%(self.cdr_dir,self.server_id)
 
-        # Create lock file
+        # Reason of last failure of files being copied and files currently being copied
+        self.transfer_error_lock = threading.Lock()
+        self.transfer_errors = {}
+        self.active_files = set()
+
+        # Failed copies whose destination was cleaned up (or never written): their journal entry
+        # is removed. Entries of other failed copies are kept and resolved at next restart.
+        self.clean_files = set()
+
+        # Create lock file (plan mode can run while the server is running)
         self.lock_file = "%s/run/PadmeCDRServer_%s.lock"%(self.cdr_dir,self.server_id)
-        if (self.create_lock_file() == "error"): exit(1)
+        if ( (not self.plan_mode) and (self.create_lock_file() == "error") ): exit(1)
 
         # Path to long-lived generic proxy file generated by calling program
         #self.long_proxy_file =  "%s/run/long_proxy"%self.cdr_dir
@@ -73,10 +115,238 @@ class PadmeCDRServer:
         # Define minimum duration for an iteration (4 hours = 14400 seconds)
         self.iteration_minimum_duration = 14400
 
+        # Check every 10 seconds if a run was closed on the DAQ server and transfer it right away
+        # without waiting for the next full iteration (also done while an iteration waits for
+        # listings, transfer slots or copies in progress)
+        self.run_poll_interval = 10
+        self.last_run_poll_time = 0
+        self.polling_run_end = False
+
+        # Last run stopped on the DAQ server and runs to check for completion after copies end
+        self.last_run = ""
+        self.runs_to_check = []
+
+        # Files of the on-going run are copied as soon as they are closed, i.e. when a file with
+        # a higher sequence number exists for the same stream or when the file was not modified
+        # for file_stable_window seconds. Between iterations this is checked every 10 minutes.
+        self.file_stable_window = 600
+        self.ongoing_run_poll_interval = 600
+
+        # Default number of files to copy in parallel for each route
+        # KLOE front end does not like many concurrent ssh sessions: keep it low
+        self.transfer_workers_default = {
+            "DAQ_LNF"  : 4,
+            "DAQ_CNAF" : 4,
+            "LNF_CNAF" : 4,
+            "CNAF_LNF" : 4,
+            "LNF_KLOE" : 2,
+            "CNAF_KLOE": 2
+        }
+        if jobs:
+            self.transfer_workers = jobs
+        else:
+            self.transfer_workers = self.transfer_workers_default.get("%s_%s"%(self.src_site,self.dst_site),1)
+        print "Parallel transfers: %d"%self.transfer_workers
+
+        # Create pool of transfer threads
+        if self.shared:
+            self.transfer_pool = TransferPool(self.transfer_workers,self.shared.capacity,self.server_id)
+        else:
+            self.transfer_pool = TransferPool(self.transfer_workers)
+        self.transfer_workers_forced = (jobs != 0)
+
+        # Checksums of copied files are verified by a separate pool of threads, so that the
+        # transfer slot is free for the next copy while the previous one is being verified
+        self.verify_workers = self.transfer_workers
+        self.verify_pool = TransferPool(self.verify_workers)
+        self.stream_checksums = {}
+
+        # Bandwidth and parallel copies on this link depend on data taking: copies are throttled
+        # while a run is on-going and go full speed between runs. Limits (in MB/s) given on the
+        # command line as (ongoing,idle) replace the default ones (None keeps the default).
+        self.bandwidth = BandwidthLimiter("%s/run"%self.cdr_dir,self.server_id,"%s_%s"%(self.src_site,self.dst_site))
+        if bandwidth:
+            for (profile,rate) in zip(("ongoing","idle"),bandwidth):
+                if rate is not None: self.bandwidth.set_limit(profile,rate)
+
+        # Catalog of known replicas of raw data files (shared by all CDR servers)
+        self.catalog_file = "%s/run/PadmeCDRCatalog.db"%self.cdr_dir
+        self.catalog = ReplicaCatalog(self.catalog_file)
+
+        # Name of source site in the catalog
+        self.src_catalog_site = self.get_catalog_site(self.src_site)
+
+        # Failed copies are retried with exponential backoff and quarantined after too many
+        # failures. Retries are checked every minute while waiting for the next iteration.
+        # N.B. plan mode runs next to the server of the same route: it never writes to the
+        # catalog, the retry queue or the old error list
+        self.retry_queue = RetryQueue(self.catalog_file)
+        if not self.plan_mode:
+            n = self.retry_queue.import_error_list(self.src_catalog_site,self.dst_site,self.transfer_error_list_file,self.is_selected_file)
+            if n: print "Imported %d failed copies from %s"%(n,self.transfer_error_list_file)
+        self.retry_poll_interval = 60
+
+        # Each step of each copy is recorded in a journal. At startup copies left unfinished by
+        # a server which did not exit cleanly are cleaned up or completed before anything else.
+        self.journal = TransferJournal(self.catalog_file)
+
+        # Health of source and destination sites. A listing error only skips the run being
+        # handled: after several consecutive errors work on the site is paused and the site is
+        # probed again after a short delay. Skipped runs are retried as soon as sites recover.
+        self.site_breakers = {
+            self.src_site: CircuitBreaker(self.src_site),
+            self.dst_site: CircuitBreaker(self.dst_site)
+        }
+        self.skipped_runs = []
+        self.run_list_failed = False
+        self.recovery_poll_interval = 60
+
+        # Order in which pending files are copied: "oldest" (run and file order), "newest" (most
+        # recent runs first), or "largest" (largest files first: shortest total time with parallel
+        # copies). Runs listed in the pinned runs file (one per line) are always copied first.
+        # While the DAQ disk is filling up, oldest runs are copied first to free it.
+        self.transfer_policy_default = {
+            "DAQ_LNF" : "newest",
+            "DAQ_CNAF": "newest"
+        }
+        if policy:
+            self.transfer_policy = policy
+        else:
+            self.transfer_policy = self.transfer_policy_default.get("%s_%s"%(self.src_site,self.dst_site),"oldest")
+        print "Transfer policy: %s"%self.transfer_policy
+
+        # Verification of copies from DAQ: "post" (checksums at source and destination are compared
+        # after the copy), "inline" (gfal-copy checks the destination against the checksum of the
+        # source, computed in advance or taken from the checksum cache) or "sampled" (inline, but
+        # a fraction of the files is still verified after the copy to cross-check the transfer engine)
+        # If the source checksum is not available, the copy is verified after the copy.
+        # Copies between SRM sites are always verified by gfal-copy, copies to KLOE after the copy.
+        self.verify_mode_default = {
+            "DAQ_LNF" : "post",
+            "DAQ_CNAF": "post"
+        }
+        if verify_mode:
+            self.verify_mode = verify_mode
+        else:
+            self.verify_mode = self.verify_mode_default.get("%s_%s"%(self.src_site,self.dst_site),"post")
+        self.verify_post_fraction = 0.1
+        self.inline_checksum_options = "--checksum-mode target"
+        if (self.src_site == "DAQ"): print "Verification mode: %s"%self.verify_mode
+
+        # Copies from DAQ can be fanned out to other storage elements: as soon as a file is
+        # verified at destination it is copied from there to each fan-out site with a third
+        # party copy, checked against the checksum computed at source. DAQ disks are read once
+        # and the checksum at source is computed once for all destinations. Failed fan-out
+        # copies are left to the retry queue of the route from destination to fan-out site.
+        # Fan-out to a site which has its own route from the same DAQ server is refused: the
+        # same files would be read twice from DAQ. Copies of the same file to the same site
+        # never overlap anyway (see TransferJournal.claim).
+        self.fanout_sites = []
+        if fanout:
+            if (self.src_site == "DAQ"):
+                for site in fanout:
+                    if (site == self.dst_site): continue
+                    if self.is_route_running("DAQ_%s_%s"%(self.daq_server,site)):
+                        print "ERROR - Route DAQ_%s_%s is running: refusing fan-out to %s"%(self.daq_server,site,site)
+                        continue
+                    self.fanout_sites.append(site)
+            else:
+                print "WARNING - Fan-out is only supported for copies from DAQ: ignoring it"
+        if self.fanout_sites: print "Fan-out sites: %s"%" ".join(self.fanout_sites)
+        self.fanout_pool = TransferPool(self.transfer_workers)
+        self.pinned_runs_file = "%s/run/PadmeCDR_pinned_runs.list"%self.cdr_dir
+
+        # Pending files are reported by priority class: pinned runs, fresh runs (on-going or
+        # started less than 1 day ago) and backlog. Sizes of pending files are kept until copied.
+        self.fresh_run_period = 86400
+        self.file_sizes = {}
+        self.pending_report = {}
+
+        # Size and duration of each copy are recorded to estimate how long pending transfers will take
+        # Estimates use copies done in the last week and are computed for several numbers of parallel
+        # copies (what-if) besides the current one
+        self.metrics = TransferMetrics(self.catalog_file)
+        self.throughput_period = 604800
+        if whatif:
+            self.plan_workers = whatif
+        else:
+            self.plan_workers = [ 1, 2, 4, 8, 16 ]
+
+        # Runs known to be fully copied are not checked again until this time has passed (1 week)
+        self.catalog_trust_period = 604800
+
+        # Signatures of run directories at each site, as returned by last call to get_run_list
+        self.run_signatures = {}
+
+        # Runs are listed again if their last listing was done less than this time after their
+        # signature changed, as directory mtime may have a coarse resolution (e.g. 1 minute on SRM)
+        self.listing_settle_time = 300
+
+        # Runs are listed in background while copies of previous runs are in progress, up to
+        # listing_lookahead runs ahead. Source and destination of each run are listed together.
+        self.listing_lookahead = 4
+        self.listing_pool = TransferPool(self.listing_lookahead)
+
         # Create proxy handler
-        self.PH = ProxyHandler()
-        self.PH.long_proxy_file = "%s/run/long_proxy"%self.cdr_dir
-        self.PH.debug = 1
+        if self.shared:
+            self.PH = self.shared.PH
+        else:
+            self.PH = ProxyHandler()
+            self.PH.long_proxy_file = "%s/run/long_proxy"%self.cdr_dir
+            self.PH.debug = 1
+
+            # Proxy is renewed in background: copy threads only check its cached expiration time
+            if not self.plan_mode: self.PH.start_renewal_thread()
+
+        # Create ssh handler: all commands to the same remote account share one connection
+        if self.shared:
+            self.SH = self.shared.SH
+        else:
+            self.SH = SSHHandler()
+
+        # Create checksum handler to get checksums of many files with a single remote command
+        if self.shared:
+            self.CH = self.shared.CH
+        else:
+            self.CH = ChecksumHandler(self.SH)
+            self.CH.debug = 1
+
+        # Checksums of files on the DAQ server are computed in groups, in background while
+        # copies are started. Copies needing a checksum which is being computed wait for it.
+        self.checksum_group = 20
+        self.daq_checksums = {}
+        self.checksum_pending = {}
+        self.checksum_lock = threading.Lock()
+
+        # Checksums are shared with other CDR servers and tools through a persistent cache
+        # Checksum of a source file computed less than 30 days ago is not computed again
+        if self.shared:
+            self.CC = self.shared.CC
+        else:
+            self.CC = ChecksumCache("%s/run"%self.cdr_dir)
+        self.checksum_trust_period = 2592000
+
+        # Copies from storage elements to KLOE are streamed without a local copy of the file
+        # If streaming is not possible, the file is copied through a local temporary file
+        if self.shared:
+            self.SC = self.shared.SC
+        else:
+            self.SC = StreamCopy(self.SH)
+            self.SC.debug = 1
+        self.stream_copy = self.SC.can_stream_srm()
+
+        # Local temporary copies share a staging area with space reservation (default: 20GB)
+        # Files left over by CDR processes which crashed are removed at startup
+        self.staging_dir = os.getenv('PADME_CDR_STAGING_DIR',"/tmp/PadmeCDR_staging")
+        if self.shared:
+            self.SA = self.shared.SA
+        else:
+            self.SA = StagingArea(self.staging_dir)
+
+        # Size reserved when the size of the file cannot be retrieved (2GB) and maximum time
+        # to wait for space in the staging area (1 hour)
+        self.staging_default_size = 2*1024**3
+        self.staging_timeout = 3600
 
         ############################
         ### DAQ data server data ###
@@ -92,6 +362,18 @@ class PadmeCDRServer:
         # Path to adler32 command on DAQ data server
         self.daq_adler32_cmd = "/home/daq/DAQ/tools/adler32"
 
+        # Occupancy of the DAQ data disk (same thresholds used by CDRMonitor) drives the CDR effort.
+        # Above the warning level more files are copied in parallel, iterations are more frequent,
+        # and runs not yet fully copied are handled first, oldest first. Above the alarm level the
+        # bandwidth limits set for data taking are also ignored. Occupancy is checked every 10 minutes.
+        self.daq_disk_area = "/data"
+        self.daq_disk_warn = 65.
+        self.daq_disk_alarm = 90.
+        self.daq_disk_extra_workers = { "ok": 0, "warn": 2, "alarm": 4 }
+        self.daq_disk_iteration_duration = { "warn": 3600, "alarm": 900 }
+        self.daq_disk_poll_interval = 600
+        self.daq_disk_level = "ok"
+
         # Path to current_run and last_run files on DAQ data server
         self.current_run_file = "/home/daq/DAQ/run/current_run"
         self.last_run_file = "/home/daq/DAQ/run/last_run"
@@ -100,7 +382,7 @@ class PadmeCDRServer:
         self.daq_sftp = "sftp://%s%s"%(self.daq_server,self.daq_path)
 
         # SSH syntax to execute a command on the DAQ data server
-        self.daq_ssh = "ssh -i %s -l %s %s"%(self.daq_keyfile,self.daq_user,self.daq_server)
+        self.daq_ssh = self.SH.get_ssh(self.daq_keyfile,self.daq_user,self.daq_server)
 
         ##############################
         ### KLOE tape library data ###
@@ -124,7 +406,15 @@ class PadmeCDRServer:
         self.kloe_sftp = "sftp://%s%s"%(self.kloe_server,self.kloe_path)
 
         # SSH syntax to execute a command on KLOE front end
-        self.kloe_ssh = "ssh -i %s -l %s %s"%(self.kloe_keyfile,self.kloe_user,self.kloe_server)
+        # KLOE front end does not like many concurrent ssh sessions: limit them to 4
+        self.kloe_ssh = self.SH.get_ssh(self.kloe_keyfile,self.kloe_user,self.kloe_server,4)
+
+        # SCP syntax to copy files to KLOE front end
+        self.kloe_scp = self.SH.get_scp(self.kloe_keyfile,self.kloe_user,self.kloe_server,4)
+
+        # Copies to KLOE are paused when the disk buffer is about to fill up and are resumed
+        # when tape migration frees enough space. Disk occupancy is measured every 5 minutes.
+        self.kloe_flow = FlowControl(self.get_kloe_space,95.,85.)
 
         ###################################
         ### LNF and CNAF SRM sites data ###
@@ -135,8 +425,12 @@ class PadmeCDRServer:
             "CNAF": "srm://storm-fe-archive.cr.cnaf.infn.it:8444/srm/managerv2?SFN=/padmeTape/daq"
         }
 
-        # Initialization is finished: start the main CDR loop
-        self.main_loop()
+        # Initialization is finished: start the main CDR loop (or just print the plan)
+        if self.plan_mode:
+            self.print_plan()
+        else:
+            self.replay_journal()
+            self.main_loop()
 
     def create_lock_file(self):
 
@@ -172,6 +466,16 @@ class PadmeCDRServer:
 
         return "ok"
 
+    def is_route_running(self,server_id):
+
+        # Check if the CDR server of route server_id is running (its lock file holds a live pid)
+        lock_file = "%s/run/PadmeCDRServer_%s.lock"%(self.cdr_dir,server_id)
+        try:
+            with open(lock_file,"r") as lf: pid = int(lf.read().split()[-1])
+        except (IOError,ValueError,IndexError):
+            return False
+        return self.journal.pid_alive(pid)
+
     def remove_lock_file(self):
         print "- Removing lock file %s"%self.lock_file
         if (os.path.exists(self.lock_file)):
@@ -182,45 +486,109 @@ class PadmeCDRServer:
         else:
             print "WARNING - lock file %s DOES NOT EXIST"%self.lock_file
 
-    def get_ongoing_run(self):
+    def get_run_status(self):
 
-        print "Getting on-going run from DAQ server %s"%self.daq_server
-
-        # current_run is the last started run
+        # Get last started (current_run) and last stopped (last_run) runs with a single remote command
         current_run = ""
-        cmd = "%s \'( cat %s )\'"%(self.daq_ssh,self.current_run_file)
+        last_run = ""
+        cmd = "%s \'( for f in %s %s; do echo $(cat $f); done )\'"%(self.daq_ssh,self.current_run_file,self.last_run_file)
         (rc,out,err) = self.execute_command(cmd)
         if rc == 0:
-            for line in iter(out.splitlines()): current_run = line.rstrip()
+            lines = out.splitlines()
+            if len(lines) == 2:
+                current_run = lines[0].strip()
+                last_run = lines[1].strip()
+            else:
+                print "- WARNING - Unexpected output while reading run status\n%s"%out
         else:
             print "- WARNING - Command returned error %d\n%s"%(rc,err)
 
         if (current_run != "" and not re.match("run_\d+_\d+_\d+",current_run)): current_run = ""
-
-        # last_run is the last stopped run
-        last_run = ""
-        cmd = "%s \'( cat %s )\'"%(self.daq_ssh,self.last_run_file)
-        (rc,out,err) = self.execute_command(cmd)
-        if rc == 0:
-            for line in iter(out.splitlines()): last_run = line.rstrip()
-        else:
-            print "- WARNING - Command returned error %d\n%s"%(rc,err)
         if (last_run != "" and not re.match("run_\d+_\d+_\d+",last_run)): last_run = ""
 
+        return (current_run,last_run)
+
+    def get_ongoing_run(self):
+
+        print "Getting on-going run from DAQ server %s"%self.daq_server
+
+        (current_run,last_run) = self.get_run_status()
+        self.last_run = last_run
+
         if (current_run == "" or current_run == last_run):
             self.ongoing_run = ""
         else:
             self.ongoing_run = current_run
+        self.update_transfer_limits()
+
+    def update_transfer_limits(self):
+
+        # Select bandwidth profile and number of parallel copies according to data taking state
+        # and to DAQ disk occupancy
+        if (self.ongoing_run and self.daq_disk_level != "alarm"):
+            self.bandwidth.set_profile("ongoing")
+        else:
+            self.bandwidth.set_profile("idle")
+        if not self.transfer_workers_forced:
+            workers = self.bandwidth.get_jobs(self.transfer_workers)+self.daq_disk_extra_workers[self.daq_disk_level]
+            if workers != self.transfer_pool.workers:
+                print "Parallel transfers: %d"%workers
+                self.transfer_pool.set_workers(workers)
+
+    def get_daq_disk_usage(self):
+
+        # Return occupancy (in %) of DAQ data disk or -1 if it cannot be measured
+        cmd = "%s \'( df -P %s | tail -1 )\'"%(self.daq_ssh,self.daq_disk_area)
+        (rc,out,err) = self.execute_command(cmd)
+        if rc == 0:
+            m = re.match("^\S+\s+\d+\s+\d+\s+\d+\s+(\d+)%",out.strip())
+            if m: return float(m.group(1))
+            print "- WARNING - Unexpected output while reading DAQ disk occupancy\n%s"%out
+        else:
+            print "- WARNING - DAQ disk occupancy command returned error %d\n%s"%(rc,err)
+        return -1.
+
+    def check_daq_disk(self):
+
+        # Measure DAQ disk occupancy and adapt CDR effort if it crossed a threshold
+        # If occupancy cannot be measured, keep the current level
+        usage = self.get_daq_disk_usage()
+        if usage < 0: return
+        level = "ok"
+        if usage >= self.daq_disk_alarm:
+            level = "alarm"
+        elif usage >= self.daq_disk_warn:
+            level = "warn"
+        if level == self.daq_disk_level: return
+        print "- DAQ disk %s on %s is %.0f%% full: level changed from %s to %s"%(self.daq_disk_area,self.daq_server,usage,self.daq_disk_level,level)
+        self.daq_disk_level = level
+        self.update_transfer_limits()
+        print "- Minimum iteration duration: %ds"%self.get_iteration_minimum_duration()
+
+    def get_iteration_minimum_duration(self):
+        return self.daq_disk_iteration_duration.get(self.daq_disk_level,self.iteration_minimum_duration)
+
+    def get_catalog_site(self,site):
+
+        # Each DAQ data server holds its own set of files
+        if (site == "DAQ"): return "DAQ-%s"%self.daq_server
+        return site
 
     def get_run_list(self,site):
 
+        # Get list of runs at site. Signatures of all run directories are collected with a
+        # single remote command and stored in self.run_signatures[site]
         run_list = []
         if (site == "DAQ"):
             run_list = self.get_run_list_daq()
+        elif (site == "KLOE"):
+            run_list = self.get_run_list_kloe()
         elif (site == "LNF"):
             run_list = self.get_run_list_srm("LNF")
         elif (site == "CNAF"):
             run_list = self.get_run_list_srm("CNAF")
+        self.record_site_result(site,run_list)
+        if (run_list and run_list[0] == "error"): return run_list
 
         # No date interval specified: just return the run list
         if (self.date_after == "" and self.date_before == ""): return run_list
@@ -228,57 +596,109 @@ class PadmeCDRServer:
         # Check which runs are within the specified date interval
         run_list_ok = []
         for run in run_list:
-            m = re.match("^run_\d+_(\d+)_\d+",run)
-            if m:
-                date_run = m.group(1)
-                if ( (self.date_after == "" or date_run >= self.date_after) and (self.date_before == "" or date_run <= self.date_before) ):
-                    run_list_ok.append(run)
-            else:
-                # Run name is unusual: just accept it
-                run_list_ok.append(run)
+            if self.is_selected_run(run): run_list_ok.append(run)
         return run_list_ok
 
+    def is_selected_run(self,run):
+
+        # Check if run is within the specified date interval
+        m = re.match("^run_\d+_(\d+)_\d+",run)
+        if m:
+            date_run = m.group(1)
+            return ( (self.date_after == "" or date_run >= self.date_after) and (self.date_before == "" or date_run <= self.date_before) )
+
+        # Run name is unusual: just accept it
+        return True
+
+    def is_selected_file(self,rawfile):
+
+        # Check if rawfile (run/file) belongs to a run of the year of data taking handled by this
+        # server and within the specified date interval. Files of runs with unusual names are not
+        # accepted, as their year cannot be known.
+        m = re.match("^(run_\d+_(\d{4})\d{4}_\d+)/",rawfile)
+        if not m: return False
+        return ( m.group(2) == self.year and self.is_selected_run(m.group(1)) )
+
     def get_run_list_daq(self):
 
         run_list = []
 
         # Make sure we do not try to transfer files while they are being written
-        if (self.ongoing_run != ""): print "Run %s is on-going and will not be transferred"%self.ongoing_run
+        if (self.ongoing_run != ""): print "Run %s is on-going: only closed files will be transferred"%self.ongoing_run
 
         print "Getting list of runs for year %s on DAQ server %s"%(self.year,self.daq_server)
-        cmd = "%s \'( cd %s/%s; ls )\'"%(self.daq_ssh,self.daq_path,self.data_dir)
-        (rc,out,err) = self.execute_command(cmd)
-        if rc == 0:
-            for line in iter(out.splitlines()):
-                run = line.rstrip()
-                if (re.match("run_\d+_\d+_\d+",run) and run != self.ongoing_run):
-                    run_list.append(run)
+        signatures = self.get_site_signatures("DAQ",self.get_run_signatures_ssh,(self.daq_ssh,"%s/%s"%(self.daq_path,self.data_dir)))
+        if signatures is None:
+            print "***ERROR*** unable to retrieve run list from DAQ server %s"%self.daq_server
+            return [ "error" ]
+        self.run_signatures["DAQ"] = signatures
 
-        else:
-            print "***ERROR*** remote command returned error status %d while retrieving run list\n%s"%(rc,err)
+        run_list = sorted(signatures.keys())
+        return run_list
+
+    def get_run_list_kloe(self):
+
+        print "Getting list of runs for year %s at KLOE"%self.year
+        signatures = self.get_site_signatures("KLOE",self.get_run_signatures_ssh,(self.kloe_ssh,"%s/%s"%(self.kloe_path,self.data_dir)))
+        if signatures is None:
+            print "***ERROR*** unable to retrieve run list from KLOE"
             return [ "error" ]
+        self.run_signatures["KLOE"] = signatures
 
-        run_list.sort()
+        run_list = sorted(signatures.keys())
         return run_list
 
+    def get_run_signatures_ssh(self,ssh,path):
+
+        # Get mtime and number of entries of all run directories in path with a single remote command
+        signatures = {}
+        cmd = "%s \'( cd %s && for run in run_*; do echo $run $(stat -c %%Y $run) $(ls -f $run | wc -l); done )\'"%(ssh,path)
+        (rc,out,err) = self.execute_command(cmd)
+        if rc != 0:
+            print "- WARNING - Remote command returned error %d\n%s"%(rc,err)
+            return None
+        for line in iter(out.splitlines()):
+            fields = line.split()
+            if (len(fields) == 3 and re.match("run_\d+_\d+_\d+",fields[0])):
+                signatures[fields[0]] = "%s %s"%(fields[1],fields[2])
+        return signatures
+
     def get_run_list_srm(self,site):
 
         run_list = []
 
         print "Getting list of runs for year %s at %s"%(self.year,site)
-        cmd = "gfal-ls %s/%s"%(self.site_srm[site],self.data_dir)
-        (rc,out,err) = self.execute_command(cmd)
-        if rc == 0:
-            for line in iter(out.splitlines()):
-                run = line.rstrip()
-                if re.match("run_\d+_\d+_\d+",run): run_list.append(run)
-        else:
-            print "***ERROR*** gfal-ls returned error status %d while retrieving run list from %s\n%s"%(rc,site,err)
+        signatures = self.get_site_signatures(site,self.get_run_signatures_srm,(site,))
+        if signatures is None:
+            print "***ERROR*** unable to retrieve run list from %s"%site
             return [ "error" ]
+        self.run_signatures[site] = signatures
 
-        run_list.sort()
+        run_list = sorted(signatures.keys())
         return run_list
 
+    def get_run_signatures_srm(self,site):
+
+        # Long listing also returns mtime and size of each run directory: use them as signature
+        signatures = {}
+        cmd = "gfal-ls -l %s/%s"%(self.site_srm[site],self.data_dir)
+        (rc,out,err) = self.execute_command(cmd)
+        if rc != 0:
+            print "- WARNING - gfal-ls returned error status %d\n%s"%(rc,err)
+            return None
+        for line in iter(out.splitlines()):
+            fields = line.split()
+            if (fields and re.match("run_\d+_\d+_\d+",fields[-1])):
+                signatures[fields[-1]] = " ".join(fields[1:-1])
+        return signatures
+
+    def get_site_signatures(self,site,function,args):
+
+        # Return signatures of run directories at site, as returned by function(*args)
+        # Routes of a multi-route daemon share recent listings of the same site
+        if self.shared: return self.shared.get_signatures("%s:%s"%(self.get_catalog_site(site),self.data_dir),function,args)
+        return function(*args)
+
     def get_file_list(self,site,run):
         if (site == "DAQ"):
             return self.get_file_list_daq(run)
@@ -289,6 +709,54 @@ class PadmeCDRServer:
         elif (site == "CNAF"):
             return self.get_file_list_srm("CNAF",run)
 
+    def check_run_signature(self,site,run):
+
+        # Store signature of run directory at site in the catalog and return True if it changed
+        # Runs without a directory at site (e.g. not yet copied) have an empty signature
+        # In plan mode the signature is only compared: the running server must still see the change
+        signature = self.run_signatures.get(site,{}).get(run,"")
+        if self.plan_mode: return (self.catalog.get_run_signature(self.get_catalog_site(site),run) != signature)
+        return self.catalog.update_run_signature(self.get_catalog_site(site),run,signature)
+
+    def get_file_list_cached(self,site,run):
+
+        # Return list of files for run at site and a flag telling if it changed since last time.
+        # Run is listed again only if its directory signature changed, otherwise the list
+        # stored in the catalog (which includes files copied since then) is used.
+        catalog_site = self.get_catalog_site(site)
+        if not (self.check_run_signature(site,run) or self.catalog.need_listing(catalog_site,run,self.listing_settle_time)):
+            return (self.catalog.get_file_list(catalog_site,run),False)
+
+        file_list = self.get_file_list(site,run)
+        self.record_site_result(site,file_list)
+        if (file_list and file_list[0] == "error"): return (file_list,False)
+        if self.plan_mode: return (file_list,(set(file_list) != set(self.catalog.get_file_list(catalog_site,run))))
+        sizes = dict([ (f,self.file_sizes[f]) for f in file_list if f in self.file_sizes ])
+        changed = self.catalog.set_file_list(catalog_site,run,file_list,sizes)
+        self.catalog.set_run_listed(catalog_site,run)
+        return (file_list,changed)
+
+    def record_site_result(self,site,result):
+
+        # Update health of site with the result of a listing request
+        # In plan mode all runs are listed anyway: failed runs are reported as skipped
+        if self.plan_mode: return
+        if (result and result[0] == "error"):
+            self.site_breakers[site].record_failure()
+        else:
+            self.site_breakers[site].record_success()
+
+    def sites_available(self):
+        return (self.site_breakers[self.src_site].available() and self.site_breakers[self.dst_site].available())
+
+    def probe_sites(self):
+
+        # Send a probe request (a run listing) to each site whose work is paused, if it is time to
+        for site in (self.src_site,self.dst_site):
+            if self.site_breakers[site].try_probe():
+                self.check_stop_cdr()
+                self.get_run_list(site)
+
     def get_file_list_daq(self,run):
 
         print "Getting list of raw data files for run %s on DAQ server %s"%(run,self.daq_server)
@@ -307,6 +775,48 @@ class PadmeCDRServer:
         file_list.sort()
         return file_list
 
+    def get_file_list_daq_closed(self,run):
+
+        print "Getting list of closed raw data files for on-going run %s on DAQ server %s"%(run,self.daq_server)
+
+        file_list = []
+
+        # Get current time on DAQ server followed by name, size and mtime of all files
+        cmd = "%s \'( cd %s/%s/%s && date +%%s && stat -c \"%%n %%s %%Y\" *.root )\'"%(self.daq_ssh,self.daq_path,self.data_dir,run)
+        (rc,out,err) = self.execute_command(cmd)
+        lines = out.splitlines()
+        if rc != 0:
+            # Run may have no files yet
+            if (len(lines) == 1 and re.match("^.*No such file or directory",err)): return []
+            print "***ERROR*** remote command returned error status %d while retrieving file list\n%s"%(rc,err)
+            return [ "error" ]
+
+        re_stream_file = re.compile("^(.*_)(\d+)\.root$")
+        try:
+            now = int(lines[0])
+            files = []
+            last_sequence = {}
+            for line in lines[1:]:
+                (name,size,mtime) = line.split()
+                m = re_stream_file.match(name)
+                if m:
+                    (stream,sequence) = (m.group(1),int(m.group(2)))
+                    if sequence > last_sequence.get(stream,-1): last_sequence[stream] = sequence
+                else:
+                    (stream,sequence) = (None,None)
+                files.append((name,int(size),int(mtime),stream,sequence))
+        except (ValueError,IndexError):
+            print "***ERROR*** unexpected output while retrieving file list\n%s"%out
+            return [ "error" ]
+
+        for (name,size,mtime,stream,sequence) in files:
+            if ( (stream and sequence < last_sequence[stream]) or (now-mtime >= self.file_stable_window) ):
+                file_list.append("%s/%s"%(run,name))
+                self.file_sizes["%s/%s"%(run,name)] = size
+
+        file_list.sort()
+        return file_list
+
     def get_file_list_kloe(self,run):
 
         # Compile regexp to extract file name (improves performance)
@@ -351,7 +861,7 @@ class PadmeCDRServer:
         #self.renew_voms_proxy()
         self.PH.renew_voms_proxy()
 
-        self.check_stop_cdr()
+        # N.B. this runs in listing threads: stop requests are checked by the main thread only
 
         print "Getting list of raw data files for run %s at %s"%(run,site)
         file_list = []
@@ -369,7 +879,25 @@ class PadmeCDRServer:
         file_list.sort()
         return file_list
 
-    def get_checksum_srm(self,site,rawfile):
+    def get_file_size_srm(self,site,rawfile):
+        size = 0
+        cmd = "gfal-stat %s/%s/%s"%(self.site_srm[site],self.data_dir,rawfile)
+        (rc,out,err) = self.execute_command(cmd)
+        if rc == 0:
+            for line in iter(out.splitlines()):
+                m = re.match("^\s*Size:\s+(\d+)\s.*$",line)
+                if m: size = int(m.group(1))
+        else:
+            print "- WARNING - gfal-stat returned error %d\n%s"%(rc,err)
+        return size
+
+    def get_checksum_srm(self,site,rawfile,max_age=None,size=None):
+
+        # Use cached checksum if younger than max_age (default: always get a fresh checksum)
+        # If size of file is given, cached checksums of a file with a different size are not used
+        return self.CC.get_checksum(site,rawfile,self.compute_checksum_srm,(site,),max_age,size)
+
+    def compute_checksum_srm(self,site,rawfile):
         a32 = ""
         cmd = "gfal-sum %s/%s/%s adler32"%(self.site_srm[site],self.data_dir,rawfile)
         (rc,out,err) = self.execute_command(cmd)
@@ -384,7 +912,55 @@ class PadmeCDRServer:
             print "- WARNING - gfal-sum returned error %d\n%s"%(rc,err)
         return a32
 
+    def get_checksums_daq(self,rawfile_list):
+
+        # Compute checksum of a group of files on DAQ server with a single remote command
+        # Results are kept until the corresponding file is verified
+        # Cached checksums of files whose size changed (file re-written) are not used
+        print "Getting ADLER32 checksum of %d files on DAQ server %s"%(len(rawfile_list),self.daq_server)
+        sizes = {}
+        for f in rawfile_list:
+            size = self.get_expected_size(f)
+            if size: sizes[f] = size
+        checksums = self.CC.get_checksums(self.src_catalog_site,rawfile_list,self.CH.get_checksums_ssh,
+                                          (self.daq_ssh,self.daq_adler32_cmd,"%s/%s"%(self.daq_path,self.data_dir)),
+                                          self.checksum_trust_period,sizes)
+        with self.checksum_lock: self.daq_checksums.update(checksums)
+
+    def prefetch_checksums_daq(self,rawfile_list):
+
+        # Compute checksums of a group of files in a separate thread
+        # Files whose checksum is already known or being computed are skipped
+        with self.checksum_lock:
+            rawfile_list = [ f for f in rawfile_list if not ( (f in self.daq_checksums) or (f in self.checksum_pending) ) ]
+            if not rawfile_list: return
+            done = threading.Event()
+            for f in rawfile_list: self.checksum_pending[f] = done
+        def run_group():
+            try:
+                self.get_checksums_daq(rawfile_list)
+            except Exception:
+                print "- WARNING - Unexpected exception while getting checksums\n%s"%traceback.format_exc().rstrip()
+            finally:
+                with self.checksum_lock:
+                    for f in rawfile_list: self.checksum_pending.pop(f,None)
+                done.set()
+        start_thread(run_group)
+
     def get_checksum_daq(self,rawfile):
+
+        # Use checksum computed in advance, if available (wait if it is being computed)
+        with self.checksum_lock: done = self.checksum_pending.get(rawfile)
+        if done: done.wait()
+        with self.checksum_lock: a32 = self.daq_checksums.pop(rawfile,"")
+        if a32:
+            print "%s %s"%(a32,rawfile)
+            return a32
+
+        return self.CC.get_checksum(self.src_catalog_site,rawfile,self.compute_checksum_daq,(),self.checksum_trust_period,
+                                    self.get_expected_size(rawfile) or None)
+
+    def compute_checksum_daq(self,rawfile):
         a32 = ""
         cmd = "%s (%s %s/%s/%s)"%(self.daq_ssh,self.daq_adler32_cmd,self.daq_path,self.data_dir,rawfile)
         (rc,out,err) = self.execute_command(cmd)
@@ -414,13 +990,50 @@ class PadmeCDRServer:
             print "- WARNING - KLOE adler32 command returned error %d\n%s"%(rc,err)
         return a32
 
+    def get_checksum_pair(self,src_query,dst_query):
+
+        # Get checksums at source and destination at the same time. Each query is given as
+        # (function,args). Return (a32_src,a32_dst), with an empty string for failed queries.
+        result = {}
+        def run_query(key,query):
+            try:
+                result[key] = query[0](*query[1])
+            except Exception:
+                print "- WARNING - Unexpected exception while getting checksum\n%s"%traceback.format_exc().rstrip()
+        t = start_thread(run_query,("src",src_query))
+        run_query("dst",dst_query)
+        t.join()
+        return (result.get("src",""),result.get("dst",""))
+
     def execute_command(self,command):
         print "> %s"%command
-        p = subprocess.Popen(shlex.split(command),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        (out,err) = p.communicate()
+        with self.SH.session(command):
+            p = subprocess.Popen(shlex.split(command),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+            (out,err) = p.communicate()
         return (p.returncode,out,err)
 
+    def add_transfer_error(self,rawfile,reason):
+        with self.transfer_error_lock:
+            self.transfer_errors[rawfile] = reason
+
+    def check_main(self):
+
+        # Callback used by the main thread while waiting: check for stop requests and, on DAQ
+        # routes, if a run was stopped (not done while a run end is already being handled)
+        self.check_stop_cdr()
+        if ( (self.src_site != "DAQ") or self.plan_mode or self.polling_run_end ): return
+        if (time.time()-self.last_run_poll_time < self.run_poll_interval): return
+        self.polling_run_end = True
+        try:
+            self.check_run_end(False)
+        finally:
+            self.polling_run_end = False
+
     def check_stop_cdr(self):
+
+        # N.B. this must only be called from the main thread
+        # In plan mode stop and lock files belong to the server running on the same route: do not touch them
+        if self.plan_mode: return
         if (os.path.exists(self.stop_cdr_file)):
             if (os.path.isfile(self.stop_cdr_file)):
                 print "- Stop request file %s found. Removing it and exiting..."%self.stop_cdr_file
@@ -428,6 +1041,16 @@ class PadmeCDRServer:
             else:
                 print "- WARNING - Stop request at path %s found but IT IS NOT A FILE."%self.stop_cdr_file
                 print "- I will not try to remove it but I will exit anyway..."
+            # Do not leave partial copies around: let transfers in progress complete
+            if self.transfer_pool.active():
+                print "- Waiting for %d transfers in progress to complete..."%self.transfer_pool.active()
+                self.transfer_pool.wait()
+            if self.verify_pool.active():
+                print "- Waiting for %d verifications in progress to complete..."%self.verify_pool.active()
+                self.verify_pool.wait()
+            if self.fanout_pool.active():
+                print "- Waiting for %d fan-out copies in progress to complete..."%self.fanout_pool.active()
+                self.fanout_pool.wait()
             self.remove_lock_file()
             print ""
             print "### PadmeCDRServer ### Exiting ###"
@@ -438,38 +1061,102 @@ class PadmeCDRServer:
         #self.renew_voms_proxy()
         self.PH.renew_voms_proxy()
 
+        # Source checksum is needed in advance to let gfal-copy verify the copy
+        a32_src = ""
+        if (self.get_verify_mode() == "inline"):
+            a32_src = self.get_checksum_daq(rawfile)
+            if not a32_src: print "- File %s - WARNING - source checksum not available: copy will be verified after the copy"%rawfile
+
         copy_failed = False
         print "- File %s - Starting copy from DAQ to %s"%(rawfile,site)
-        cmd = "gfal-copy -t 3600 -T 3600 -p -D\"SFTP PLUGIN:USER=%s\" -D\"SFTP PLUGIN:PRIVKEY=%s\" %s/%s/%s %s/%s/%s"%(self.daq_user,self.daq_keyfile,self.daq_sftp,self.data_dir,rawfile,self.site_srm[site],self.data_dir,rawfile)
+        checksum_options = ""
+        if a32_src: checksum_options = " --checksum ADLER32:%s %s"%(a32_src,self.inline_checksum_options)
+        cmd = "gfal-copy -t 3600 -T 3600 -p%s -D\"SFTP PLUGIN:USER=%s\" -D\"SFTP PLUGIN:PRIVKEY=%s\" %s/%s/%s %s/%s/%s"%(checksum_options,self.daq_user,self.daq_keyfile,self.daq_sftp,self.data_dir,rawfile,self.site_srm[site],self.data_dir,rawfile)
         (rc,out,err) = self.execute_command(cmd)
         if rc == 0:
             print out,
         else:
             print "- File %s - ***ERROR*** gfal-copy returned error %d while copying from DAQ to %s"%(rawfile,rc,site)
             print err,
-            with open(self.transfer_error_list_file,"a") as telf:
-                telf.write("%s - %s copy\n"%(self.now_str(),rawfile))
-            cmd = "gfal-rm %s/%s/%s"%(self.site_srm[site],self.data_dir,rawfile)
-            (rc,out,err) = self.execute_command(cmd)
-            if rc:
-                print "- File %s - ***ERROR*** gfal-rm returned error %d while deleting destination copy at %s\n%s"%(rawfile,rc,site,err)
+            if self.is_exists_error(err): return self.check_existing_copy(rawfile)
+            if ( a32_src and re.search("checksum",err,re.IGNORECASE) ):
+                self.add_transfer_error(rawfile,"checksum")
+            else:
+                self.add_transfer_error(rawfile,"copy")
+            self.delete_copy_srm(site,rawfile)
             return "error"
 
+        # Copy was verified by gfal-copy: record it in the replica catalog
+        if a32_src:
+            self.journal_state(rawfile,"verified",a32_src)
+            print "- File %s - ADLER32 CRC %s verified by gfal-copy"%(rawfile,a32_src)
+            size = self.get_expected_size(rawfile) or None
+            self.catalog.add_replica(self.src_catalog_site,rawfile,size=size,adler32=a32_src)
+            self.catalog.add_replica(site,rawfile,size=size,adler32=a32_src,verified_by="inline")
+            return "ok"
+
+        # Copy must now be verified
+        self.journal_state(rawfile,"copied")
+        return "copied"
+
+    def delete_copy_srm(self,site,rawfile):
+
+        # Remove failed copy of rawfile at site. Return True if no copy is left at site.
+        cmd = "gfal-rm %s/%s/%s"%(self.site_srm[site],self.data_dir,rawfile)
+        (rc,out,err) = self.execute_command(cmd)
+        if ( rc and not "No such file" in out+err ):
+            print "- File %s - ***ERROR*** gfal-rm returned error %d while deleting destination copy at %s\n%s"%(rawfile,rc,site,err)
+            return False
+        if (site == self.dst_site): self.destination_clean(rawfile)
+        return True
+
+    def destination_clean(self,rawfile):
+
+        # Failed copy of rawfile left nothing at destination
+        with self.transfer_error_lock: self.clean_files.add(rawfile)
+
+    def is_exists_error(self,err):
+
+        # gfal-copy (without -f) refuses to overwrite a file which already exists at destination
+        return (re.search("file exists|EEXIST",err,re.IGNORECASE) is not None)
+
+    def check_existing_copy(self,rawfile):
+
+        # Copy was refused because rawfile is already at destination (e.g. copied by hand or by
+        # another route): the file was not written by this copy and is never removed. It is
+        # recorded as a good copy if it matches the source.
+        print "- File %s - File already exists at %s: comparing it with source"%(rawfile,self.dst_site)
+        self.destination_clean(rawfile)
+        a32 = self.verify_destination(rawfile)
+        if not a32:
+            print "- File %s - ***ERROR*** existing copy at %s does not match source: NOT removing it"%(rawfile,self.dst_site)
+            self.add_transfer_error(rawfile,"checksum")
+            return "error"
+        self.journal_state(rawfile,"verified",a32)
+        size = self.get_expected_size(rawfile) or None
+        self.catalog.add_replica(self.src_catalog_site,rawfile,size=size,adler32=a32)
+        self.catalog.add_replica(self.dst_site,rawfile,size=size,adler32=a32,verified_by="post")
+        return "ok"
+
+    def verify_copy_daq_srm(self,site,rawfile):
+
+        self.PH.renew_voms_proxy()
+
         # Verify checksum at source and destination
-        print "- File %s - Getting ADLER32 checksum at source"%rawfile
-        a32_src = self.get_checksum_daq(rawfile)
-        print "- File %s - Getting ADLER32 checksum at destination"%rawfile
-        a32_dst = self.get_checksum_srm(site,rawfile)
+        print "- File %s - Getting ADLER32 checksum at source and destination"%rawfile
+        (a32_src,a32_dst) = self.get_checksum_pair((self.get_checksum_daq,(rawfile,)),(self.get_checksum_srm,(site,rawfile)))
         print "- File %s - ADLER32 CRC - Source: %s - Destination: %s"%(rawfile,a32_src,a32_dst)
         if ( a32_src == "" or a32_dst == "" or a32_src != a32_dst ):
             print "- File %s - ***ERROR*** unmatched checksum while copying from DAQ to %s"%(rawfile,site)
-            with open(self.transfer_error_list_file,"a") as telf:
-                telf.write("%s - %s checksum\n"%(self.now_str(),rawfile))
-            cmd = "gfal-rm %s/%s/%s"%(self.site_srm[site],self.data_dir,rawfile)
-            (rc,out,err) = self.execute_command(cmd)
-            if rc:
-                print "- File %s - ***ERROR*** gfal-rm returned error %d while deleting destination copy at %s\n%s"%(rawfile,rc,site,err)
+            self.add_transfer_error(rawfile,"checksum")
+            self.delete_copy_srm(site,rawfile)
             return "error"
+        self.journal_state(rawfile,"verified",a32_src)
+
+        # Record verified copies in the replica catalog
+        size = self.get_expected_size(rawfile) or None
+        self.catalog.add_replica(self.src_catalog_site,rawfile,size=size,adler32=a32_src)
+        self.catalog.add_replica(site,rawfile,size=size,adler32=a32_dst,verified_by="post")
 
         return "ok"
 
@@ -487,16 +1174,14 @@ class PadmeCDRServer:
         else:
             print "- File %s - ***ERROR*** gfal-copy returned error %d while copying from %s to %s"%(rawfile,rc,src_site,dst_site)
             print err,
-            with open(self.transfer_error_list_file,"a") as telf:
-                telf.write("%s - %s copy\n"%(self.now_str(),rawfile))
-            cmd = "gfal-rm %s/%s/%s"%(self.site_srm[dst_site],self.data_dir,rawfile)
-            (rc,out,err) = self.execute_command(cmd)
-            if rc == 0:
-                print out,
-            else:
-                print "- File %s - ***ERROR*** gfal-rm returned error %d while deleting destination copy at %s"%(rawfile,rc,dst_site)
-                print err,
+            if self.is_exists_error(err): return self.check_existing_copy(rawfile)
+            self.add_transfer_error(rawfile,"copy")
+            self.delete_copy_srm(dst_site,rawfile)
             return "error"
+        self.journal_state(rawfile,"verified")
+
+        # Checksum was verified by gfal-copy: record new copy in the replica catalog
+        self.catalog.add_replica(dst_site,rawfile,size=(self.get_expected_size(rawfile) or None),verified_by="inline")
 
         return "ok"
 
@@ -509,22 +1194,97 @@ class PadmeCDRServer:
         rawdir = os.path.dirname(rawfile)
         if (rawdir == ""):
             print "- File %s - ***ERROR*** cannot extract directory from file name"%rawfile
-            with open(self.transfer_error_list_file,"a") as telf:
-                telf.write("%s - %s copy\n"%(self.now_str(),rawfile))
+            self.add_transfer_error(rawfile,"copy")
+            self.destination_clean(rawfile)
             return "error"
 
         cmd = "%s \'( mkdir -p %s/%s/%s )\'"%(self.kloe_ssh,self.kloe_path,self.data_dir,rawdir)
         (rc,out,err) = self.execute_command(cmd)
         if rc:
             print "- File %s - ***ERROR*** mkdir returned error %d while creating destination directory\n%s"%(rawfile,rc,err)
+            self.destination_clean(rawfile)
             return "error"
 
-        # Name of temporary file to use during copy (will be erased after use)
-        tmp_file = "/tmp/%s"%rawfile
+        cmd = "%s \'( mkdir -p %s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawdir)
+        (rc,out,err) = self.execute_command(cmd)
+        if rc:
+            print "- File %s - ***ERROR*** mkdir returned error %d while creating destination directory\n%s"%(rawfile,rc,err)
+            self.destination_clean(rawfile)
+            return "error"
 
-        copy_failed = False
         print "- File %s - Starting copy from %s to KLOE"%(rawfile,site)
 
+        # Stream file to KLOE temporary directory computing its checksum on the fly
+        status = "unavailable"
+        a32_stream = ""
+        if self.stream_copy:
+            src_cmd = "gfal-cat -t 3600 %s/%s/%s"%(self.site_srm[site],self.data_dir,rawfile)
+            dst_cmd = "%s \'( cat > %s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawfile)
+            (status,a32_stream,size) = self.SC.copy(src_cmd,dst_cmd)
+            if status == "error":
+                print "- File %s - ***ERROR*** streaming copy failed after %d bytes while copying from %s to KLOE"%(rawfile,size,site)
+                self.add_transfer_error(rawfile,"copy")
+                self.delete_kloe_tmp_file(rawfile)
+                return "error"
+            if status == "ok":
+                print "- File %s - Streamed %d bytes - ADLER32 CRC %s"%(rawfile,size,a32_stream)
+            else:
+                print "- File %s - WARNING - streaming from %s is not possible: copying through local file"%(rawfile,site)
+                a32_stream = ""
+
+        # Fall back to a copy through a local temporary file
+        if status == "unavailable":
+            if self.stage_file_srm_kloe(site,rawfile) == "error": return "error"
+        self.journal_state(rawfile,"copied")
+
+        # Copy must now be verified (checksum computed while streaming is kept for verification)
+        if a32_stream:
+            with self.transfer_error_lock: self.stream_checksums[rawfile] = a32_stream
+        return "copied"
+
+    def verify_copy_srm_kloe(self,site,rawfile):
+
+        self.PH.renew_voms_proxy()
+
+        # Verify if the copy was correctly completed
+        with self.transfer_error_lock: a32_stream = self.stream_checksums.pop(rawfile,"")
+        print "- File %s - Getting ADLER32 checksum at source and destination"%rawfile
+        (a32_src,a32_dst) = self.get_checksum_pair((self.get_checksum_srm,(site,rawfile,self.checksum_trust_period,self.get_expected_size(rawfile) or None)),(self.get_checksum_kloe,(rawfile,)))
+        print "- File %s - ADLER32 CRC - Source: %s - Destination: %s"%(rawfile,a32_src,a32_dst)
+        if ( a32_src == "" or a32_dst == "" or a32_src != a32_dst or (a32_stream and a32_stream != a32_src) ):
+            print "- File %s - ***ERROR*** unmatched checksum while copying from %s to KLOE"%(rawfile,site)
+            self.add_transfer_error(rawfile,"checksum")
+            self.delete_kloe_tmp_file(rawfile)
+            return "error"
+        self.journal_state(rawfile,"verified",a32_src)
+
+        # Finally move file from temporary directory to daq data directory
+        cmd = "%s \'( mv %s/%s %s/%s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawfile,self.kloe_path,self.data_dir,rawfile)
+        (rc,out,err) = self.execute_command(cmd)
+        if rc:
+            print "- File %s - ***ERROR*** ssh returned error %d while moving KLOE copy to final directory\n%s"%(rawfile,rc,err)
+            self.delete_kloe_tmp_file(rawfile)
+            return "error"
+
+        # Record verified copies in the replica catalog
+        size = self.get_expected_size(rawfile) or None
+        self.catalog.add_replica(site,rawfile,size=size,adler32=a32_src)
+        self.catalog.add_replica("KLOE",rawfile,size=size,adler32=a32_dst,verified_by="post")
+        self.CC.store("KLOE",rawfile,a32_dst,size)
+
+        return "ok"
+
+    def stage_file_srm_kloe(self,site,rawfile):
+
+        # Reserve space for temporary local copy (will be erased after use)
+        size = self.get_file_size_srm(site,rawfile)
+        if not size: size = self.staging_default_size
+        tmp_file = self.SA.reserve(rawfile,size,self.staging_timeout)
+        if not tmp_file:
+            print "- File %s - ***ERROR*** no space available in local staging area %s"%(rawfile,self.staging_dir)
+            self.destination_clean(rawfile)
+            return "error"
+
         # gfal-copy SFTP destination is not working: create a temporary local copy of the file
         cmd = "gfal-copy -t 3600 -T 3600 -p %s/%s/%s file://%s"%(self.site_srm[site],self.data_dir,rawfile,tmp_file)
         (rc,out,err) = self.execute_command(cmd)
@@ -532,57 +1292,32 @@ class PadmeCDRServer:
             print out,
         else:
             print "- File %s - ***ERROR*** gfal-copy returned error %d while copying from %s to local file\n%s"%(rawfile,rc,site,err)
-            with open(self.transfer_error_list_file,"a") as telf:
-                telf.write("%s - %s copy\n"%(self.now_str(),rawfile))
-            self.delete_local_file(tmp_file)
+            self.add_transfer_error(rawfile,"copy")
+            self.SA.release(tmp_file)
+            self.destination_clean(rawfile)
             return "error"
 
         # Now send local copy to KLOE temporary directory using good old scp
-        cmd = "%s \'( mkdir -p %s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawdir)
-        (rc,out,err) = self.execute_command(cmd)
-        if rc:
-            print "- File %s - ***ERROR*** mkdir returned error %d while creating destination directory\n%s"%(rawfile,rc,err)
-            self.delete_local_file(tmp_file)
-            return "error"
-
-        cmd = "scp -i %s %s %s@%s:%s/%s"%(self.kloe_keyfile,tmp_file,self.kloe_user,self.kloe_server,self.kloe_tmpdir,rawfile)
+        cmd = "%s %s %s@%s:%s/%s"%(self.kloe_scp,tmp_file,self.kloe_user,self.kloe_server,self.kloe_tmpdir,rawfile)
         (rc,out,err) = self.execute_command(cmd)
         if rc:
             print "- File %s - ***ERROR*** scp returned error %d while copying temporary file\n%s"%(rawfile,rc,err)
-            self.delete_local_file(tmp_file)
+            self.SA.release(tmp_file)
+            self.delete_kloe_tmp_file(rawfile)
             return "error"
 
-        # Clean up local temporary file
-        self.delete_local_file(tmp_file)
+        # Clean up local temporary file and its reservation
+        self.SA.release(tmp_file)
 
-        # Verify if the copy was correctly completed
-        print "- File %s - Getting ADLER32 checksum at source"%rawfile
-        a32_src = self.get_checksum_srm(site,rawfile)
-        print "- File %s - Getting ADLER32 checksum at destination"%rawfile
-        a32_dst = self.get_checksum_kloe(rawfile)
-        print "- File %s - ADLER32 CRC - Source: %s - Destination: %s"%(rawfile,a32_src,a32_dst)
-        if ( a32_src == "" or a32_dst == "" or a32_src != a32_dst ):
-            print "- File %s - ***ERROR*** unmatched checksum while copying from %s to KLOE"%(rawfile,site)
-            with open(self.transfer_error_list_file,"a") as telf:
-                telf.write("%s - %s checksum\n"%(self.now_str(),rawfile))
-            cmd = "%s \'( rm -f %s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawfile)
-            (rc,out,err) = self.execute_command(cmd)
-            if rc:
-                print "- File %s - ***ERROR*** ssh returned error %d while removing temporary copy of file at KLOE\n%s"%(rawfile,rc,err)
-            return "error"
+        return "ok"
 
-        # Finally move file from temporary directory to daq data directory
-        cmd = "%s \'( mv %s/%s %s/%s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawfile,self.kloe_path,self.data_dir,rawfile)
+    def delete_kloe_tmp_file(self,rawfile):
+        cmd = "%s \'( rm -f %s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawfile)
         (rc,out,err) = self.execute_command(cmd)
         if rc:
-            print "- File %s - ***ERROR*** ssh returned error %d while moving KLOE copy to final directory\n%s"%(rawfile,rc,err)
-            cmd = "%s \'( rm -f %s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawfile)
-            (rc,out,err) = self.execute_command(cmd)
-            if rc:
-                print "- File %s - ***ERROR*** ssh returned error %d while removing temporary copy of file at KLOE\n%s"%(rawfile,rc,err)
-            return "error"
-
-        return "ok"
+            print "- File %s - ***ERROR*** ssh returned error %d while removing temporary copy of file at KLOE\n%s"%(rawfile,rc,err)
+        else:
+            self.destination_clean(rawfile)
 
     def delete_local_file(self,del_file):
         cmd = "rm -f %s"%del_file
@@ -617,25 +1352,811 @@ class PadmeCDRServer:
         print "- WARNING - Copy from %s to %s is not supported"%(src_site,dst_site)
         return "error"
 
-    def get_kloe_used_space(self):
-        used = 100
-        cmd = "%s \'( df | grep \/pdm | awk \"{print \$4}\" )\'"%self.kloe_ssh
+    def get_verify_mode(self):
+
+        # Return how next copy from DAQ must be verified: "inline" or "post"
+        if (self.verify_mode == "sampled"):
+            if (random.random() < self.verify_post_fraction): return "post"
+            return "inline"
+        return self.verify_mode
+
+    def verify_copy(self,src_site,dst_site,rawfile):
+
+        # Verify a copy for which copy_file returned "copied" and complete it
+        if (src_site == "DAQ"):
+            return self.verify_copy_daq_srm(dst_site,rawfile)
+        elif (dst_site == "KLOE"):
+            return self.verify_copy_srm_kloe(src_site,rawfile)
+        print "- WARNING - Verification of copies from %s to %s is not supported"%(src_site,dst_site)
+        return "error"
+
+    def journal_state(self,rawfile,state,adler32=None):
+        self.journal.set_state(self.src_catalog_site,self.dst_site,rawfile,state,adler32)
+
+    def replay_journal(self):
+
+        # Resolve copies left unfinished by a server which did not exit cleanly: copies whose
+        # destination matches the source are completed, all others are removed
+        n = self.journal.purge()
+        if n: print "Removed %d old entries from transfer journal"%n
+        in_flight = self.journal.get_in_flight(self.src_catalog_site,self.dst_site)
+        if not in_flight: return
+
+        print ""
+        print "=== PadmeCDRServer resolving %d unfinished copies from %s to %s ==="%(len(in_flight),self.src_catalog_site,self.dst_site)
+        print ""
+
+        for (rawfile,state,a32,active) in in_flight:
+            self.check_stop_cdr()
+            if active:
+                print "- File %s - Copy is in progress in another process: not touching it"%rawfile
+                continue
+            print "- File %s - Copy was left in %s state"%(rawfile,state)
+            verified_by = None
+            if (state == "started" or state == "copied"):
+                # Destination may hold a good copy (the copy ended just before the crash, or the
+                # file reached destination in another way): compare it with source before deleting
+                a32 = self.verify_destination(rawfile)
+                if a32: (state,verified_by) = ("verified","post")
+            if (state == "verified"):
+                result = self.commit_destination(rawfile,a32,verified_by)
+            else:
+                result = self.clean_destination(rawfile)
+            if (result == "ok"):
+                # Run must be checked again at next iteration
+                self.catalog.clear_run_complete(rawfile.split("/")[0],source=self.src_catalog_site,destination=self.dst_site)
+            else:
+                print "- File %s - WARNING - unable to resolve copy: will try again at next restart"%rawfile
+
+    def verify_destination(self,rawfile):
+
+        # Compare checksums of file at source and of its copy at destination (in the temporary
+        # directory for KLOE). Return checksum if they match, an empty string otherwise.
+        if (self.src_site == "DAQ"):
+            src_query = (self.get_checksum_daq,(rawfile,))
+        else:
+            src_query = (self.get_checksum_srm,(self.src_site,rawfile,self.checksum_trust_period,self.get_expected_size(rawfile) or None))
+        if (self.dst_site == "KLOE"):
+            dst_query = (self.get_checksum_kloe,(rawfile,))
+        else:
+            dst_query = (self.get_checksum_srm,(self.dst_site,rawfile))
+        print "- File %s - Getting ADLER32 checksum at source and destination"%rawfile
+        (a32_src,a32_dst) = self.get_checksum_pair(src_query,dst_query)
+        print "- File %s - ADLER32 CRC - Source: %s - Destination: %s"%(rawfile,a32_src,a32_dst)
+        if ( a32_src == "" or a32_dst == "" or a32_src != a32_dst ): return ""
+        return a32_src
+
+    def commit_destination(self,rawfile,a32,verified_by=None):
+
+        # Complete a verified copy: move it to its final place (KLOE only) and record it in the
+        # replica catalog. On KLOE the move may already have been done before the crash.
+        size = self.get_expected_size(rawfile) or None
+        if (self.dst_site == "KLOE"):
+            tmp_file = "%s/%s"%(self.kloe_tmpdir,rawfile)
+            final_file = "%s/%s/%s"%(self.kloe_path,self.data_dir,rawfile)
+            cmd = "%s \'( if [ -f %s ]; then mv %s %s; fi; test -f %s )\'"%(self.kloe_ssh,tmp_file,tmp_file,final_file,final_file)
+            (rc,out,err) = self.execute_command(cmd)
+            if rc:
+                print "- File %s - ***ERROR*** ssh returned error %d while moving KLOE copy to final directory\n%s"%(rawfile,rc,err)
+                return "error"
+            if a32: self.CC.store("KLOE",rawfile,a32,size)
+        if a32: self.catalog.add_replica(self.src_catalog_site,rawfile,size=size,adler32=a32)
+        self.catalog.add_replica(self.dst_site,rawfile,size=size,adler32=a32,verified_by=verified_by)
+        self.journal_state(rawfile,"committed",a32)
+        print "- File %s - Copy from %s to %s completed"%(rawfile,self.src_site,self.dst_site)
+        return "ok"
+
+    def clean_destination(self,rawfile):
+
+        # Remove copy of rawfile at destination (temporary copy for KLOE) and forget it
+        if (self.dst_site == "KLOE"):
+            cmd = "%s \'( rm -f %s/%s )\'"%(self.kloe_ssh,self.kloe_tmpdir,rawfile)
+            (rc,out,err) = self.execute_command(cmd)
+        else:
+            self.PH.renew_voms_proxy()
+            cmd = "gfal-rm %s/%s/%s"%(self.site_srm[self.dst_site],self.data_dir,rawfile)
+            (rc,out,err) = self.execute_command(cmd)
+            if (rc and "No such file" in out+err): rc = 0
+        if rc:
+            print "- File %s - ***ERROR*** error %d while deleting unfinished copy at %s\n%s"%(rawfile,rc,self.dst_site,err)
+            return "error"
+        if (self.dst_site != "KLOE"): self.catalog.remove_replica(self.dst_site,rawfile)
+        self.journal.remove(self.src_catalog_site,self.dst_site,rawfile)
+        print "- File %s - Unfinished copy at %s removed"%(rawfile,self.dst_site)
+        return "ok"
+
+    def start_transfer(self,rawfile):
+
+        # Start copy of rawfile in a separate thread unless it is already being copied
+        with self.transfer_error_lock:
+            if rawfile in self.active_files: return
+            self.active_files.add(rawfile)
+
+        # Wait until there is room for the file in the KLOE disk buffer
+        size = self.get_expected_size(rawfile)
+        flow_size = 0
+        if (self.dst_site == "KLOE"): flow_size = self.kloe_flow.acquire(size,self.check_main)
+
+        # Wait until the bandwidth allowed on this link is available
+        self.bandwidth.acquire(size,self.check_main)
+
+        # If current profile limits parallel copies on this link, wait for a copy slot shared
+        # with other processes using the same link (e.g. TransferRun jobs)
+        slot = self.bandwidth.acquire_slot(self.transfer_pool.workers,self.check_main)
+
+        # Wait for a free transfer slot
+        self.transfer_pool.reserve_slot(self.check_main)
+
+        # Copy file from source to destination in a separate thread
+        self.transfer_pool.start(self.transfer_file,(rawfile,flow_size,size,slot))
+
+    def get_expected_size(self,rawfile):
+
+        # Return size of rawfile if it is known from source listing or from the catalog, 0 otherwise
+        if rawfile in self.file_sizes: return self.file_sizes[rawfile]
+        for (site,f,size,adler32,seen_at,verified_at,verified_by) in self.catalog.where_is(rawfile):
+            if size: return size
+        return 0
+
+    def transfer_file(self,rawfile,flow_size=0,size=0,slot=None):
+
+        # Copy file from source to destination (runs in a transfer thread)
+        # Copies which must still be verified are handed over to the verification pool: the
+        # transfer slot is then released while checksums are computed
+        result = "error"
+        verifying = False
+        start_time = time.time()
+
+        # Another route or process may be writing the same file to destination (e.g. a fan-out
+        # copy): leave the file to it
+        if not self.journal.claim(self.src_catalog_site,self.dst_site,rawfile):
+            print "- File %s - File is being copied to %s by another route or process: skipping it"%(rawfile,self.dst_site)
+            with self.transfer_error_lock: self.active_files.discard(rawfile)
+            if flow_size: self.kloe_flow.release(flow_size,False)
+            self.bandwidth.release_slot(slot)
+            return
+
+        try:
+            try:
+                result = self.copy_file(self.src_site,self.dst_site,rawfile)
+            finally:
+                # Link is not used anymore while the copy is verified
+                self.bandwidth.release_slot(slot)
+            if (result == "copied"):
+                self.verify_pool.submit(self.verify_file,(rawfile,flow_size,size,start_time))
+                verifying = True
+        finally:
+            if not verifying: self.finish_transfer(rawfile,(result == "ok"),flow_size,size,start_time)
+
+    def verify_file(self,rawfile,flow_size,size,start_time):
+
+        # Verify copy of file (runs in a verification thread)
+        verified = False
+        try:
+            verified = (self.verify_copy(self.src_site,self.dst_site,rawfile) == "ok")
+        finally:
+            self.finish_transfer(rawfile,verified,flow_size,size,start_time)
+
+    def finish_transfer(self,rawfile,copied,flow_size,size,start_time):
+
+        # Record result of the copy of rawfile
+        with self.transfer_error_lock:
+            reason = self.transfer_errors.pop(rawfile,"copy")
+            self.active_files.discard(rawfile)
+            clean = (rawfile in self.clean_files)
+            self.clean_files.discard(rawfile)
+        if copied:
+            print "- File %s - Copy from %s to %s successful"%(rawfile,self.src_site,self.dst_site)
+            self.journal_state(rawfile,"committed")
+            self.retry_queue.remove(self.src_catalog_site,self.dst_site,rawfile)
+            if size: self.metrics.add_transfer(self.src_catalog_site,self.dst_site,rawfile,size,time.time()-start_time)
+            for site in self.fanout_sites: self.fanout_pool.submit(self.fanout_file,(rawfile,site))
+        else:
+            # Forget the copy if nothing was left at destination, otherwise keep its entry so that
+            # the destination is resolved at next restart
+            if clean:
+                self.journal.remove(self.src_catalog_site,self.dst_site,rawfile)
+            else:
+                self.journal.release(self.src_catalog_site,self.dst_site,rawfile)
+            (failures,quarantined) = self.retry_queue.add_failure(self.src_catalog_site,self.dst_site,rawfile,reason)
+            if quarantined:
+                print "- File %s - Copy from %s to %s failed (%s error %d) - File is now QUARANTINED"%(rawfile,self.src_site,self.dst_site,reason,failures)
+            else:
+                print "- File %s - Copy from %s to %s failed (%s error %d) - Will retry later"%(rawfile,self.src_site,self.dst_site,reason,failures)
+
+        # Tell flow control how much data was added to the KLOE disk buffer
+        if flow_size: self.kloe_flow.release(flow_size,copied)
+
+    def fanout_file(self,rawfile,site):
+
+        # Copy verified file from destination to fan-out site (runs in a fan-out thread)
+        run = rawfile.split("/")[0]
+        if rawfile in self.catalog.get_file_list(site,run): return
+
+        # Copy is checked against the checksum computed at source for the first copy
+        a32 = ""
+        for (s,f,size,adler32,seen_at,verified_at,verified_by) in self.catalog.where_is(rawfile):
+            if (s == self.src_catalog_site and adler32): a32 = adler32
+
+        self.PH.renew_voms_proxy()
+        if not self.journal.claim(self.dst_site,site,rawfile):
+            print "- File %s - File is being copied to %s by another route or process: no fan-out copy"%(rawfile,site)
+            return
+        print "- File %s - Starting fan-out copy from %s to %s"%(rawfile,self.dst_site,site)
+        if a32:
+            checksum_options = "--checksum ADLER32:%s"%a32
+        else:
+            checksum_options = "--checksum ADLER32"
+        cmd = "gfal-copy -t 3600 -T 3600 -p %s %s/%s/%s %s/%s/%s"%(checksum_options,self.site_srm[self.dst_site],self.data_dir,rawfile,self.site_srm[site],self.data_dir,rawfile)
+        (rc,out,err) = self.execute_command(cmd)
+        if rc == 0:
+            print out,
+            size = self.get_expected_size(rawfile) or None
+            if a32:
+                self.journal.set_state(self.dst_site,site,rawfile,"verified",a32)
+                self.catalog.add_replica(site,rawfile,size=size,adler32=a32,verified_by="inline")
+            else:
+                self.journal.set_state(self.dst_site,site,rawfile,"verified")
+                self.catalog.add_replica(site,rawfile,size=size,verified_by="inline")
+            self.journal.set_state(self.dst_site,site,rawfile,"committed")
+            self.retry_queue.remove(self.dst_site,site,rawfile)
+            print "- File %s - Fan-out copy from %s to %s successful"%(rawfile,self.dst_site,site)
+            return
+
+        print "- File %s - ***ERROR*** gfal-copy returned error %d while copying from %s to %s"%(rawfile,rc,self.dst_site,site)
+        print err,
+
+        # A file which already exists at fan-out site was not written by us: do not remove it
+        if self.is_exists_error(err):
+            self.journal.remove(self.dst_site,site,rawfile)
+            print "- File %s - File already exists at %s: left to route %s_%s"%(rawfile,site,self.dst_site,site)
+            return
+
+        if ( a32 and re.search("checksum",err,re.IGNORECASE) ):
+            reason = "checksum"
+        else:
+            reason = "copy"
+        if self.delete_copy_srm(site,rawfile):
+            self.journal.remove(self.dst_site,site,rawfile)
+        else:
+            self.journal.release(self.dst_site,site,rawfile)
+        (failures,quarantined) = self.retry_queue.add_failure(self.dst_site,site,rawfile,reason)
+        print "- File %s - Fan-out copy from %s to %s failed (%s error %d) - Left to route %s_%s"%(rawfile,self.dst_site,site,reason,failures,self.dst_site,site)
+
+    def transfer_retries(self):
+
+        # Copy again files whose retry time has come. Files which appeared at destination
+        # in the meantime (e.g. copied by hand) are removed from the queue.
+        # Nothing is retried while work on one of the sites is paused.
+        if not self.sites_available(): return
+        for rawfile in self.retry_queue.get_due(self.src_catalog_site,self.dst_site):
+            self.check_stop_cdr()
+            run = rawfile.split("/")[0]
+            if rawfile in self.catalog.get_file_list(self.dst_site,run):
+                self.retry_queue.remove(self.src_catalog_site,self.dst_site,rawfile)
+                continue
+
+            # Catalog only knows files of runs which were listed: check destination directly
+            # (files with an unfinished copy are copied again and checked by the copy itself)
+            unfinished = [ f for (f,state,a32,active) in self.journal.get_in_flight(self.src_catalog_site,self.dst_site,run) if f == rawfile ]
+            if not unfinished:
+                status = self.file_at_destination(rawfile)
+                if (status == "error"): continue
+                if (status == "yes"):
+                    print "- File %s - File is already at %s: removed from retry queue"%(rawfile,self.dst_site)
+                    self.catalog.add_replica(self.dst_site,rawfile,size=(self.get_expected_size(rawfile) or None),verified=False)
+                    self.retry_queue.remove(self.src_catalog_site,self.dst_site,rawfile)
+                    continue
+
+            print "- File %s - Retrying copy from %s to %s"%(rawfile,self.src_site,self.dst_site)
+            self.start_transfer(rawfile)
+
+    def file_at_destination(self,rawfile):
+
+        # Check if rawfile exists at destination (on disk buffer or on tape library for KLOE)
+        # Return "yes", "no" or "error" if this cannot be checked
+        if (self.dst_site == "KLOE"):
+            path = "%s/%s/%s"%(self.kloe_path,self.data_dir,rawfile)
+            cmd = "%s \'( test -f %s || dsmc query archive %s )\'"%(self.kloe_ssh,path,path)
+            (rc,out,err) = self.execute_command(cmd)
+            if rc == 0: return "yes"
+            # dsmc returns 8 if the file is not on tape
+            if rc == 8: return "no"
+        else:
+            self.PH.renew_voms_proxy()
+            cmd = "gfal-stat %s/%s/%s"%(self.site_srm[self.dst_site],self.data_dir,rawfile)
+            (rc,out,err) = self.execute_command(cmd)
+            if rc == 0: return "yes"
+            if ( rc == 2 or "No such file" in out+err ): return "no"
+        print "- File %s - WARNING - unable to check if file exists at %s (error %d)\n%s"%(rawfile,self.dst_site,rc,err)
+        return "error"
+
+    def get_kloe_space(self):
+
+        # Return total and free space (in bytes) of KLOE disk buffer
+        cmd = "%s \'( df -k | grep \/pdm | awk \"{print \$2,\$3}\" )\'"%self.kloe_ssh
         (rc,out,err) = self.execute_command(cmd)
         if rc == 0:
             for line in iter(out.splitlines()):
                 try:
-                    used = int(line.rstrip()[:-1])
+                    (total,free) = line.split()
+                    return (int(total)*1024,int(free)*1024)
                 except:
-                    print "- WARNING - Could not extract used disk space from KLOE server\n%s"%out
-                    used = 100
+                    print "- WARNING - Could not extract disk space from KLOE server\n%s"%out
         else:
             print "- WARNING - KLOE disk space command returned error %d\n%s"%(rc,err)
-
-        return used
+        return (0,0)
 
     def now_str(self):
         return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime())
 
+    def transfer_run(self,run):
+
+        # Start copy of all files of run which are missing at destination
+        self.transfer_runs([run])
+
+    def transfer_runs(self,run_list):
+
+        # Start copy of all files of runs in run_list which are missing at destination, in the
+        # order defined by the transfer policy
+        # If the policy follows run order, copies of each run are started as soon as the run is
+        # listed, while the next runs are listed in background. Otherwise all runs are listed first.
+        if (self.get_transfer_policy() == "largest"):
+            self.start_transfers(self.plan_transfers(run_list))
+            return
+        pending = []
+        for (run,status,missing_list) in self.list_runs(self.order_runs(run_list)):
+            if missing_list:
+                self.start_transfers(self.order_files(missing_list))
+                pending.extend(missing_list)
+        if pending: self.report_pending(pending)
+
+    def plan_transfers(self,run_list):
+
+        # Return list of files of runs in run_list which are missing at destination, ordered by
+        # transfer policy, and report how much data is pending for each priority class
+        pending = []
+        for (run,status,missing_list) in self.list_runs(run_list):
+            pending.extend(missing_list)
+        pending = self.order_files(pending)
+        if pending: self.report_pending(pending)
+        return pending
+
+    def list_runs(self,run_list):
+
+        # Generator returning (run,status,missing_list) for each run in run_list, in the same order
+        # Runs are listed by the listing pool up to listing_lookahead runs ahead of the run being
+        # returned, so listings go on while the caller is starting copies
+        results = {}
+        done = {}
+        next_run = 0
+        for n in range(len(run_list)):
+            while ( next_run < len(run_list) and next_run < n+self.listing_lookahead ):
+                done[run_list[next_run]] = threading.Event()
+                self.listing_pool.submit(self.list_run,(run_list[next_run],results,done[run_list[next_run]]),self.check_main)
+                next_run += 1
+            run = run_list[n]
+            while not done[run].is_set():
+                self.check_main()
+                self.probe_sites()
+                done[run].wait(1.)
+            del done[run]
+            (status,missing_list) = results.pop(run)
+            yield (run,status,missing_list)
+
+    def list_run(self,run,results,done):
+
+        # Find files of run missing at destination and get their size (runs in a listing thread)
+        results[run] = ("error",[])
+        try:
+            (status,missing_list) = self.get_missing_files(run)
+            if missing_list:
+                self.get_file_sizes(run,missing_list)
+                # Sizes from source listing are also kept in the catalog
+                if not self.plan_mode:
+                    self.catalog.set_sizes(self.src_catalog_site,dict([ (f,self.file_sizes[f]) for f in missing_list if f in self.file_sizes ]))
+            results[run] = (status,missing_list)
+        finally:
+            done.set()
+
+    def start_transfers(self,file_list):
+
+        # Start copy of all files in file_list in the given order
+        for n in range(len(file_list)):
+            rawfile = file_list[n]
+            self.check_main()
+
+            # On DAQ server, get checksums of groups of files with a single remote command
+            # The next group is computed in background while files of this group are copied
+            if ( (self.src_site == "DAQ") and (n % self.checksum_group == 0) ):
+                if (n == 0): self.prefetch_checksums_daq(file_list[:self.checksum_group])
+                self.prefetch_checksums_daq(file_list[n+self.checksum_group:n+2*self.checksum_group])
+
+            self.start_transfer(rawfile)
+
+    def get_pinned_runs(self):
+
+        # Return set of runs pinned by the operator in the pinned runs file (comments start with #)
+        pinned = set()
+        try:
+            with open(self.pinned_runs_file,"r") as f:
+                for line in f:
+                    run = line.split("#")[0].strip()
+                    if run: pinned.add(run)
+        except IOError:
+            pass
+        return pinned
+
+    def get_run_class(self,run,pinned):
+
+        # Return priority class of run: "pinned", "fresh" or "backlog"
+        if run in pinned: return "pinned"
+        if run == self.ongoing_run: return "fresh"
+        m = re.match("^run_\d+_(\d{8}_\d{6})",run)
+        if m:
+            try:
+                run_time = calendar.timegm(time.strptime(m.group(1),"%Y%m%d_%H%M%S"))
+                if time.time()-run_time < self.fresh_run_period: return "fresh"
+            except ValueError:
+                pass
+        return "backlog"
+
+    def get_transfer_policy(self):
+
+        # DAQ disk relief has precedence over the configured policy
+        if (self.daq_disk_level != "ok"): return "oldest"
+        return self.transfer_policy
+
+    def order_runs(self,run_list):
+
+        # Order runs according to transfer policy (for policies which follow run order)
+        # Pinned runs always come first
+        pinned = self.get_pinned_runs()
+        ordered = sorted(run_list,reverse=(self.get_transfer_policy() == "newest"))
+        ordered.sort(key=lambda r: not (r in pinned))
+        return ordered
+
+    def order_files(self,file_list):
+
+        # Order files according to transfer policy. Files of pinned runs always come first.
+        # Run names contain run number and start time, so name order is time order.
+        pinned = self.get_pinned_runs()
+        policy = self.get_transfer_policy()
+        ordered = sorted(file_list)
+        if policy == "newest":
+            ordered.sort(key=lambda f: f.split("/")[0],reverse=True)
+        elif policy == "largest":
+            ordered.sort(key=lambda f: self.file_sizes.get(f,0),reverse=True)
+        ordered.sort(key=lambda f: not (f.split("/")[0] in pinned))
+        return ordered
+
+    def report_pending(self,file_list):
+
+        # Print number of files and bytes pending for each priority class
+        pinned = self.get_pinned_runs()
+        report = {}
+        for c in ("pinned","fresh","backlog"): report[c] = [0,0,0]
+        for rawfile in file_list:
+            c = self.get_run_class(rawfile.split("/")[0],pinned)
+            report[c][0] += 1
+            if rawfile in self.file_sizes:
+                report[c][1] += self.file_sizes[rawfile]
+            else:
+                report[c][2] += 1
+        self.pending_report = report
+        print "- Pending transfers (policy %s):"%self.get_transfer_policy()
+        for c in ("pinned","fresh","backlog"):
+            (n,size,unknown) = report[c]
+            if not n: continue
+            msg = "  %-8s %5d files %10.1f GB"%(c,n,size/1024.**3)
+            if unknown: msg += " (%d files of unknown size)"%unknown
+            print msg
+
+    def get_file_sizes(self,run,file_list):
+
+        # Get size of files in file_list (all from run at source site) with a single listing
+        # Sizes are stored in self.file_sizes. Files whose size is already known are not listed.
+        if not [ f for f in file_list if not f in self.file_sizes ]: return
+        sizes = {}
+        if (self.src_site == "DAQ"):
+            cmd = "%s \'( cd %s/%s/%s && stat -c \"%%n %%s\" *.root )\'"%(self.daq_ssh,self.daq_path,self.data_dir,run)
+            (rc,out,err) = self.execute_command(cmd)
+            if rc == 0:
+                for line in iter(out.splitlines()):
+                    fields = line.split()
+                    if (len(fields) == 2 and fields[1].isdigit()): sizes["%s/%s"%(run,fields[0])] = int(fields[1])
+        elif (self.src_site == "LNF" or self.src_site == "CNAF"):
+            cmd = "gfal-ls -l %s/%s/%s"%(self.site_srm[self.src_site],self.data_dir,run)
+            (rc,out,err) = self.execute_command(cmd)
+            if rc == 0:
+                for line in iter(out.splitlines()):
+                    fields = line.split()
+                    if (len(fields) >= 5 and fields[4].isdigit()): sizes["%s/%s"%(run,fields[-1])] = int(fields[4])
+        else:
+            return
+        if rc:
+            print "- WARNING - Unable to get size of files in run %s at %s (error %d)\n%s"%(run,self.src_site,rc,err)
+            return
+        for f in file_list:
+            if f in sizes: self.file_sizes[f] = sizes[f]
+
+    def get_missing_files(self,run):
+
+        # Return ("ok",list of files of run missing at destination) or ("error",[]) if one of the
+        # sites has problems: run is then retried when sites recover
+
+        if not self.sites_available():
+            print "WARNING - Work on %s is paused: skipping run %s"%(" and ".join([ s.status() for s in self.site_breakers.values() if not s.available() ]),run)
+            return (self.skip_run(run),[])
+
+        # N.B. this runs in a listing thread: do not call check_stop_cdr here
+        ongoing = (self.src_site == "DAQ" and run == self.ongoing_run)
+        if not ongoing:
+
+            # Runs which were modified at source must be checked again
+            changed = self.check_run_signature(self.src_site,run)
+            if ( changed and not self.plan_mode ):
+                self.catalog.clear_run_complete(run,source=self.src_catalog_site)
+
+            # Skip runs which are already known to be fully copied to destination
+            if ( (not changed) and self.catalog.is_run_complete(self.src_catalog_site,self.dst_site,run,self.catalog_trust_period) ):
+                return ("ok",[])
+
+        # Get list of files for this run at source site in a separate thread while destination
+        # site is listed (runs are only listed if they changed)
+        src_result = {}
+        t = start_thread(self.get_source_file_list,(run,ongoing,src_result))
+        (dst_file_list,dst_changed) = self.get_file_list_cached(self.dst_site,run)
+        t.join()
+        (src_file_list,src_changed) = src_result.get("list",([ "error" ],False))
+
+        if (src_file_list and src_file_list[0] == "error"):
+            print "WARNING - Source site %s has problems: skipping run %s"%(self.src_site,run)
+            return (self.skip_run(run),[])
+
+        if (dst_file_list and dst_file_list[0] == "error"):
+            print "WARNING - Destination site %s has problems: skipping run %s"%(self.dst_site,run)
+            return (self.skip_run(run),[])
+
+        # Runs on SRM sites may still be receiving files from the DAQ servers:
+        # only consider them complete if their content did not change since last iteration
+        if ( (self.src_site == "DAQ" and run != self.ongoing_run) or not src_changed ): self.runs_to_check.append(run)
+
+        # Files whose copy was not completed may have a partial copy at destination: they are
+        # missing even if they are listed there. Files being written to destination by other copies
+        # (from any source, e.g. fan-out copies from another route) are skipped.
+        in_flight = self.journal.get_in_flight(self.src_catalog_site,self.dst_site,run)
+        unfinished = set([ f for (f,state,a32,active) in in_flight if not active ])
+        dst_file_set = set(dst_file_list)-unfinished
+
+        # Files which failed recently or too many times are left to the retry queue
+        blocked = self.retry_queue.get_blocked(self.src_catalog_site,self.dst_site,run)
+        blocked.update([ f for (f,state,a32,active) in in_flight if active ])
+        blocked.update(self.journal.get_active(self.src_catalog_site,self.dst_site,run))
+        missing_list = [ rawfile for rawfile in src_file_list if not (rawfile in dst_file_set or rawfile in blocked) ]
+        return ("ok",missing_list)
+
+    def get_source_file_list(self,run,ongoing,result):
+
+        # Store (file_list,changed) for run at source site in result (runs in a separate thread)
+        # Only closed files are returned for the on-going run
+        try:
+            if ongoing:
+                file_list = self.get_file_list_daq_closed(run)
+                self.record_site_result(self.src_site,file_list)
+                result["list"] = (file_list,True)
+            else:
+                result["list"] = self.get_file_list_cached(self.src_site,run)
+        except Exception:
+            print "- WARNING - Unexpected exception while listing run %s at %s\n%s"%(run,self.src_site,traceback.format_exc().rstrip())
+
+    def skip_run(self,run):
+
+        # Remember run so that it is transferred as soon as both sites are healthy
+        # The on-going run is copied periodically anyway
+        if ( (run != self.ongoing_run) and not (run in self.skipped_runs) ): self.skipped_runs.append(run)
+        return "error"
+
+    def transfer_skipped_runs(self):
+
+        # Transfer runs which were skipped because of site problems
+        print ""
+        print "=== PadmeCDRServer sites are healthy: transferring %d skipped runs ==="%len(self.skipped_runs)
+        print ""
+
+        run_list = self.skipped_runs
+        self.skipped_runs = []
+        self.transfer_runs(run_list)
+        self.check_runs_complete()
+
+    def check_runs_complete(self):
+
+        # Wait for all copies in progress to complete and to be verified
+        # Copies of runs stopped on the DAQ server in the meantime may start while waiting
+        while True:
+            self.transfer_pool.wait(self.check_main)
+            self.verify_pool.wait(self.check_main)
+            self.fanout_pool.wait(self.check_main)
+            if not (self.transfer_pool.active() or self.verify_pool.active() or self.fanout_pool.active()): break
+
+        # Drop checksums and sizes of files which were not copied
+        with self.checksum_lock: self.daq_checksums = {}
+        self.file_sizes = {}
+
+        # Update catalog with runs which are now fully copied to destination
+        for run in self.runs_to_check:
+            if self.catalog.check_run_complete(self.src_catalog_site,self.dst_site,run):
+                print "- Run %s - All files from %s are now at %s"%(run,self.src_catalog_site,self.dst_site)
+        self.runs_to_check = []
+
+    def check_run_end(self,wait=True):
+
+        # Check if a new run was stopped on the DAQ server and, if so, transfer it immediately
+        # If wait is False (called while the main thread waits) copies are only started:
+        # they are completed by the caller's own wait
+        self.last_run_poll_time = time.time()
+        (current_run,last_run) = self.get_run_status()
+        if (current_run == "" or current_run == last_run):
+            self.ongoing_run = ""
+        else:
+            self.ongoing_run = current_run
+        self.update_transfer_limits()
+        if (last_run == "" or last_run == self.last_run): return
+
+        print ""
+        print "=== PadmeCDRServer run %s was stopped on DAQ server %s ==="%(last_run,self.daq_server)
+        print ""
+
+        self.last_run = last_run
+
+        # Refresh run lists (and run signatures) at both sites
+        self.check_stop_cdr()
+        src_run_list = self.get_run_list(self.src_site)
+        if (src_run_list and src_run_list[0] == "error"):
+            print "WARNING - Source site %s has problems: transfer of run %s postponed"%(self.src_site,last_run)
+            return
+        if not last_run in src_run_list:
+            print "- Run %s - Not selected for transfer"%last_run
+            return
+        self.check_stop_cdr()
+        dst_run_list = self.get_run_list(self.dst_site)
+        if (dst_run_list and dst_run_list[0] == "error"):
+            print "WARNING - Destination site %s has problems: transfer of run %s postponed"%(self.dst_site,last_run)
+            return
+
+        self.transfer_run(last_run)
+        if not wait:
+            print "- Run %s - Copies started"%last_run
+            return
+        self.check_runs_complete()
+
+        print ""
+        print "=== PadmeCDRServer transfer of run %s finished ==="%last_run
+        print ""
+
+    def transfer_ongoing_run(self):
+
+        # Copy files of the on-going run which were closed since last check
+        print ""
+        print "=== PadmeCDRServer copying closed files of on-going run %s ==="%self.ongoing_run
+        print ""
+
+        self.transfer_run(self.ongoing_run)
+        self.check_runs_complete()
+
+    def print_plan(self):
+
+        # List pending transfers as the main loop would do, without copying anything, and
+        # print the plan in JSON format to standard output
+        print ""
+        print "=== PadmeCDRServer computing transfer plan ==="
+        print ""
+
+        self.ongoing_run = ""
+        if (self.src_site == "DAQ"):
+            self.check_daq_disk()
+            self.get_ongoing_run()
+        pending = []
+        src_run_list = self.get_run_list(self.src_site)
+        if (src_run_list and src_run_list[0] == "error"):
+            self.run_list_failed = True
+        else:
+            dst_run_list = self.get_run_list(self.dst_site)
+            if (dst_run_list and dst_run_list[0] == "error"):
+                self.run_list_failed = True
+            else:
+                pending = self.plan_transfers(src_run_list)
+
+        plan = self.get_plan(pending)
+        sys.__stdout__.write(json.dumps(plan,indent=2,sort_keys=True)+"\n")
+        sys.__stdout__.flush()
+
+    def get_plan(self,pending):
+
+        # Return plan for files in pending list (already ordered by transfer policy)
+        pinned = self.get_pinned_runs()
+        plan = {
+            "route": self.server_id,
+            "source": self.src_catalog_site,
+            "destination": self.dst_site,
+            "generated_at": self.now_str(),
+            "policy": self.get_transfer_policy(),
+            "workers": self.transfer_pool.workers,
+            "daq_disk_level": self.daq_disk_level,
+            "complete": not (self.run_list_failed or self.skipped_runs),
+            "skipped_runs": self.skipped_runs
+        }
+
+        # Pending files and bytes for each run (in transfer order) and for each priority class
+        runs = []
+        classes = {}
+        for c in ("pinned","fresh","backlog"): classes[c] = { "files": 0, "bytes": 0, "runs": 0 }
+        unknown = 0
+        for rawfile in pending:
+            run = rawfile.split("/")[0]
+            if not (runs and runs[-1]["run"] == run):
+                c = self.get_run_class(run,pinned)
+                runs.append({ "run": run, "class": c, "files": 0, "bytes": 0 })
+                classes[c]["runs"] += 1
+            runs[-1]["files"] += 1
+            classes[runs[-1]["class"]]["files"] += 1
+            if rawfile in self.file_sizes:
+                runs[-1]["bytes"] += self.file_sizes[rawfile]
+                classes[runs[-1]["class"]]["bytes"] += self.file_sizes[rawfile]
+            else:
+                unknown += 1
+        total = sum([ c["bytes"] for c in classes.values() ])
+        plan["runs"] = runs
+        plan["classes"] = classes
+        plan["pending"] = { "files": len(pending), "bytes": total, "runs": len(runs), "files_unknown_size": unknown }
+
+        # Files of unknown size are assumed to have the average size of the other pending files
+        # (or of recently copied files)
+        (copies,size,duration,peak) = self.metrics.get_throughput(self.src_catalog_site,self.dst_site,self.throughput_period)
+        if len(pending) > unknown:
+            mean_size = float(total)/(len(pending)-unknown)
+        elif copies:
+            mean_size = float(size)/copies
+        else:
+            mean_size = 0.
+        estimated = total+unknown*mean_size
+        plan["pending"]["bytes_estimated"] = int(estimated)
+
+        # Retry queue content for this route
+        waiting = 0
+        quarantined = 0
+        for entry in self.retry_queue.get_entries():
+            if (entry[0] == self.src_catalog_site and entry[1] == self.dst_site):
+                if entry[8]:
+                    quarantined += 1
+                else:
+                    waiting += 1
+        plan["retry_queue"] = { "waiting": waiting, "quarantined": quarantined }
+
+        # Throughput observed on this route and estimated time to copy all pending files
+        # A single copy is assumed to run at the mean observed speed, several copies in parallel
+        # share the bandwidth limit of the current profile (if any)
+        plan["throughput"] = { "period": self.throughput_period, "copies": copies, "bytes": size, "copy_MBps": 0., "peak_hourly_MBps": peak/3600./1024**2 }
+        plan["eta"] = []
+        if copies and duration:
+            copy_rate = size/duration
+            plan["throughput"]["copy_MBps"] = copy_rate/1024**2
+            workers_list = sorted(set(self.plan_workers+[self.transfer_pool.workers]))
+            for workers in workers_list:
+                rate = workers*copy_rate
+                if self.bandwidth.rate: rate = min(rate,self.bandwidth.rate)
+                seconds = int(estimated/rate)
+                plan["eta"].append({
+                    "workers": workers,
+                    "rate_MBps": rate/1024**2,
+                    "seconds": seconds,
+                    "finish_at": time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime(time.time()+seconds))
+                })
+        else:
+            print "WARNING - No copies recorded on route %s in the last %d days: unable to estimate ETA"%(self.server_id,self.throughput_period/86400)
+
+        return plan
+
     def main_loop(self):
 
         print ""
@@ -653,56 +2174,42 @@ class PadmeCDRServer:
 
             # Reset all file/dir lists
             self.ongoing_run = ""
+            self.runs_to_check = []
+            self.skipped_runs = []
+            self.run_list_failed = False
             src_run_list = []
-            src_file_list = []
-            dst_file_list = []
+            dst_run_list = []
 
-            # Check on DAQ servers if a run is ongoing
+            # Check on DAQ servers if a run is ongoing and how full the DAQ disk is
             self.check_stop_cdr()
-            if (self.src_site == "DAQ"): self.get_ongoing_run()
+            if (self.src_site == "DAQ"):
+                self.check_daq_disk()
+                self.get_ongoing_run()
 
             # Get list of runs at source site
             self.check_stop_cdr()
             src_run_list = self.get_run_list(self.src_site)
             if (src_run_list and src_run_list[0] == "error"):
-                print "WARNING - Source site %s has problems: suspending iteration"%self.src_site
-            else:
-
-                # Loop over all runs at source site and get list of files
-                for run in src_run_list:
-
-                    # Get list of files for this run at source site
-                    self.check_stop_cdr()
-                    src_file_list = self.get_file_list(self.src_site,run)
-                    if (src_file_list and src_file_list[0] == "error"):
-                        print "WARNING - Source site %s has problems: suspending iteration"%self.src_site
-                        break
+                print "WARNING - Source site %s has problems: iteration will restart when site recovers"%self.src_site
+                self.run_list_failed = True
+                src_run_list = []
 
-                    # Get list of files for this run at destination site
-                    self.check_stop_cdr()
-                    dst_file_list = self.get_file_list(self.dst_site,run)
-                    if (dst_file_list and dst_file_list[0] == "error"):
-                        print "WARNING - Destination site %s has problems: suspending iteration"%self.dst_site
-                        break
-
-                    suspend_iteration = False
-                    for rawfile in src_file_list:
-                        self.check_stop_cdr()
-                        if ( not rawfile in dst_file_list ):
-
-                            # Check disk space at KLOE front end before copying
-                            if ( (self.dst_site == "KLOE") and (self.get_kloe_used_space() > 95) ):
-                                print "- WARNING - KLOE disk space is more than 95% full - Suspending iteration"
-                                suspend_iteration = True
-                                break
+            # Get list of runs at destination site (only used to detect changes in run directories)
+            self.check_stop_cdr()
+            if src_run_list:
+                dst_run_list = self.get_run_list(self.dst_site)
+                if (dst_run_list and dst_run_list[0] == "error"):
+                    print "WARNING - Destination site %s has problems: iteration will restart when site recovers"%self.dst_site
+                    self.run_list_failed = True
+                    src_run_list = []
 
-                            # Copy file from source to destination
-                            if self.copy_file(self.src_site,self.dst_site,rawfile) == "ok":
-                                print "- File %s - Copy from %s to %s successful"%(rawfile,self.src_site,self.dst_site)
-                            else:
-                                print "- File %s - Copy from %s to %s failed"%(rawfile,self.src_site,self.dst_site)
+            # Find files missing at destination for all runs at source site and copy them in
+            # the order defined by the transfer policy
+            # Runs skipped because of site problems are retried when sites are healthy again
+            self.transfer_runs(src_run_list)
 
-                    if suspend_iteration: break
+            # Wait for all copies started in this iteration to complete and update catalog
+            self.check_runs_complete()
 
             end_iteration_time = time.time()
 
@@ -710,12 +2217,38 @@ class PadmeCDRServer:
             print "=== PadmeCDRServer iteration finished ==="
             print ""
 
-            # Check if current iteration lasted a minimum time (currently 4 hours)
+            # Check if current iteration lasted a minimum time (4 hours, less if DAQ disk is filling up)
             # If not, pause the remaining time to avoid stress on grid data servers
+            # While pausing, runs stopped on the DAQ server are transferred as soon as they end
             iteration_duration = end_iteration_time-start_iteration_time
-            if (iteration_duration < self.iteration_minimum_duration):
-                iteration_pause = self.iteration_minimum_duration-iteration_duration
-                print "- Iteration lasted %ds < %ds - Sleeping %ds"%(iteration_duration,self.iteration_minimum_duration,iteration_pause)
-                for _ in range(int(iteration_pause/10)):
+            iteration_minimum_duration = self.get_iteration_minimum_duration()
+            if (iteration_duration < iteration_minimum_duration):
+                iteration_pause = iteration_minimum_duration-iteration_duration
+                print "- Iteration lasted %ds < %ds - Sleeping %ds"%(iteration_duration,iteration_minimum_duration,iteration_pause)
+                last_ongoing_time = time.time()
+                last_retry_time = 0
+                last_recovery_time = time.time()
+                last_disk_time = time.time()
+                while (time.time() < start_iteration_time+self.get_iteration_minimum_duration()):
                     self.check_stop_cdr()
                     time.sleep(10)
+                    if ( (self.src_site == "DAQ") and (time.time()-last_disk_time >= self.daq_disk_poll_interval) ):
+                        self.check_daq_disk()
+                        last_disk_time = time.time()
+                    self.probe_sites()
+                    if ( (self.run_list_failed or self.skipped_runs) and (time.time()-last_recovery_time >= self.recovery_poll_interval) ):
+                        last_recovery_time = time.time()
+                        if self.sites_available():
+                            # Run lists could not be retrieved: start a new iteration right away
+                            if self.run_list_failed:
+                                print "- Sites are healthy again: starting new iteration"
+                                break
+                            self.transfer_skipped_runs()
+                    if ( (self.src_site == "DAQ") and (time.time()-self.last_run_poll_time >= self.run_poll_interval) ):
+                        self.check_run_end()
+                    if ( (self.ongoing_run != "") and (time.time()-last_ongoing_time >= self.ongoing_run_poll_interval) ):
+                        self.transfer_ongoing_run()
+                        last_ongoing_time = time.time()
+                    if (time.time()-last_retry_time >= self.retry_poll_interval):
+                        self.transfer_retries()
+                        last_retry_time = time.time()
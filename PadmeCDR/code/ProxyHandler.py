@@ -4,6 +4,9 @@ import re
 import subprocess
 import shlex
 import os
+import time
+import fcntl
+import threading
 
 class ProxyHandler:
 
@@ -27,13 +30,67 @@ class ProxyHandler:
         # Long term non-VOMS proxy must be defined by calling program
         self.long_proxy_file = ""
 
-    def renew_voms_proxy(self):
-
-        # Check if current proxy is still valid and renew it if expiration is close
+        # Background renewal thread renews the proxy when its validity goes below this time
+        self.proxy_renew_ahead = 4*self.proxy_renew_threshold
+
+        # Make sure parallel transfer threads do not renew the proxy at the same time
+        self.lock = threading.Lock()
+
+        # Expiration time of the proxy and mtime of the proxy file when it was read
+        # Expiration is read again only when the proxy file changes. Value read by
+        # voms-proxy-info is shared with other processes through an info file.
+        self.proxy_expiration = 0
+        self.proxy_mtime = None
+
+        self.renewal_thread = None
+
+    def get_proxy_file(self):
+
+        # VOMS proxy is stored in X509_USER_PROXY or in the standard location
+        if self.voms_proxy: return self.voms_proxy
+        return "/tmp/x509up_u%d"%os.getuid()
+
+    def get_time_left(self):
+
+        # Return validity left (seconds) of current proxy. N.B. lock must be held by caller.
+        try:
+            mtime = os.stat(self.get_proxy_file()).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is None:
+            self.proxy_expiration = 0
+        elif mtime != self.proxy_mtime:
+            self.proxy_expiration = self.load_proxy_expiration(mtime)
+        self.proxy_mtime = mtime
+        return self.proxy_expiration-time.time()
+
+    def load_proxy_expiration(self,mtime):
+
+        # Use expiration time found by another process for the same proxy file, if any
+        info_file = "%s.info"%self.get_proxy_file()
+        try:
+            with open(info_file,"r") as f: (info_mtime,expiration) = f.read().split()
+            if info_mtime == "%.3f"%mtime: return int(expiration)
+        except (IOError,ValueError):
+            pass
+
+        expiration = self.read_proxy_expiration()
+        if expiration:
+            try:
+                tmp_file = "%s.%d"%(info_file,os.getpid())
+                with open(tmp_file,"w") as f: f.write("%.3f %d\n"%(mtime,expiration))
+                os.rename(tmp_file,info_file)
+            except (IOError,OSError):
+                pass
+        return expiration
+
+    def read_proxy_expiration(self):
+
+        # Get time left for current proxy from voms-proxy-info and return its expiration time
+        expiration = 0
         info_cmd = "voms-proxy-info --actimeleft"
         if self.voms_proxy: info_cmd += " --file %s"%self.voms_proxy
         if self.debug: print "> %s"%info_cmd
-        renew = True
         p = subprocess.Popen(shlex.split(info_cmd),stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
         (out,err) = p.communicate()
         if self.debug >= 2:
@@ -43,20 +100,56 @@ class ProxyHandler:
         if p.returncode == 0:
             for l in iter(out.splitlines()):
                 r = re.match("^\s*(\d+)\s*$",l)
-                if r and int(r.group(1))>=self.proxy_renew_threshold:
-                    renew = False
+                if r: expiration = int(time.time())+int(r.group(1))
         elif p.returncode != 1:
             print "  WARNING voms-proxy-info returned error code %d"%p.returncode
             print "- STDOUT -\n%s"%out
             print "- STDERR -\n%s"%err
+        return expiration
+
+    def renew_voms_proxy(self,threshold=0):
 
-        if renew:
-            if self.debug:
-                if self.voms_proxy:
-                    print "- VOMS proxy %s is missing or will expire in less than %d seconds."%(self.voms_proxy,self.proxy_renew_threshold)
-                else:
-                    print "- Standard VOMS proxy is missing or will expire in less than %d seconds."%self.proxy_renew_threshold
-            self.create_voms_proxy()
+        # Check if current proxy is still valid and renew it if expiration is close
+        # With the renewal thread running this is normally just a comparison of times
+        if not threshold: threshold = self.proxy_renew_threshold
+        with self.lock:
+            if self.get_time_left() >= threshold: return
+
+            # Only one process at a time renews the proxy: the others wait for the lock and
+            # then find the new proxy already in place
+            lock_fd = os.open("%s.lock"%self.get_proxy_file(),os.O_RDWR|os.O_CREAT,0600)
+            try:
+                fcntl.flock(lock_fd,fcntl.LOCK_EX)
+                if self.get_time_left() >= threshold: return
+                if self.debug:
+                    if self.voms_proxy:
+                        print "- VOMS proxy %s is missing or will expire in less than %d seconds."%(self.voms_proxy,threshold)
+                    else:
+                        print "- Standard VOMS proxy is missing or will expire in less than %d seconds."%threshold
+                self.create_voms_proxy()
+            finally:
+                os.close(lock_fd)
+
+    def start_renewal_thread(self):
+
+        # Renew the proxy in background well before it reaches the renewal threshold
+        if self.renewal_thread: return
+        self.renewal_thread = threading.Thread(target=self.renewal_loop)
+        self.renewal_thread.daemon = True
+        self.renewal_thread.start()
+
+    def renewal_loop(self):
+
+        while True:
+            self.renew_voms_proxy(self.proxy_renew_ahead)
+            with self.lock: time_left = self.get_time_left()
+            if time_left < self.proxy_renew_ahead:
+                # Renewal failed: try again in a few minutes
+                pause = 300
+            else:
+                # Sleep until it is time to renew the proxy, checking at least once per hour
+                pause = min(time_left-self.proxy_renew_ahead,3600)
+            time.sleep(max(60,pause))
 
     def create_voms_proxy(self):
 
@@ -70,13 +163,19 @@ class ProxyHandler:
             else:
                 print "- Creating new standard VOMS proxy from long-lived proxy %s"%self.long_proxy_file
 
-        renew_cmd = "voms-proxy-init --noregen --cert %s --key %s --voms vo.padme.org --valid 24:00"%(self.long_proxy_file,self.long_proxy_file)
+        # New proxy is written to a temporary file and then renamed, so that processes using
+        # the proxy never see a partially written file
+        proxy_file = self.get_proxy_file()
+        tmp_file = "%s.%d"%(proxy_file,os.getpid())
+        renew_cmd = "voms-proxy-init --noregen --cert %s --key %s --voms vo.padme.org --valid 24:00 --out %s"%(self.long_proxy_file,self.long_proxy_file,tmp_file)
         if self.debug: print "> %s"%renew_cmd
         p = subprocess.Popen(shlex.split(renew_cmd),stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
         (out,err) = p.communicate()
         if p.returncode == 0:
             if self.debug: print out
+            os.rename(tmp_file,proxy_file)
         else:
             print "  WARNING voms-proxy-init returned error code %d"%p.returncode
             print "- STDOUT -\n%s"%out
             print "- STDERR -\n%s"%err
+            if os.path.exists(tmp_file): os.remove(tmp_file)
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+import time
+import sqlite3
+import threading
+
+class ReplicaCatalog:
+
+    def __init__(self,db_file):
+
+        # Path to SQLite file holding the catalog
+        self.db_file = db_file
+
+        # Connection is shared by all threads of the process: serialize access
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_file,timeout=60,check_same_thread=False)
+
+        self.create_tables()
+
+    def create_tables(self):
+
+        with self.lock:
+            c = self.conn.cursor()
+
+            # One entry for each copy of a raw data file (file is stored as run/file)
+            c.execute("""
+CREATE TABLE IF NOT EXISTS replica (
+    site        TEXT NOT NULL,
+    run         TEXT NOT NULL,
+    file        TEXT NOT NULL,
+    size        INTEGER,
+    adler32     TEXT,
+    seen_at     REAL,
+    verified_at REAL,
+    verified_by TEXT,
+    PRIMARY KEY (site,file)
+)""")
+            c.execute("CREATE INDEX IF NOT EXISTS replica_run ON replica (run)")
+
+            # Catalogs created by older versions do not record how each copy was verified
+            c.execute("PRAGMA table_info(replica)")
+            if not "verified_by" in [ row[1] for row in c.fetchall() ]:
+                c.execute("ALTER TABLE replica ADD COLUMN verified_by TEXT")
+
+            # Runs which were fully copied from source to destination
+            c.execute("""
+CREATE TABLE IF NOT EXISTS run_transfer (
+    source       TEXT NOT NULL,
+    destination  TEXT NOT NULL,
+    run          TEXT NOT NULL,
+    n_files      INTEGER,
+    completed_at REAL,
+    PRIMARY KEY (source,destination,run)
+)""")
+
+            # Signature (mtime, number of entries, ...) of each run directory at each site
+            c.execute("""
+CREATE TABLE IF NOT EXISTS run_signature (
+    site        TEXT NOT NULL,
+    run         TEXT NOT NULL,
+    signature   TEXT,
+    changed_at  REAL,
+    listed_at   REAL,
+    PRIMARY KEY (site,run)
+)""")
+
+            self.conn.commit()
+
+    def set_file_list(self,site,run,file_list,sizes=None):
+
+        # Store result of a full listing of run at site. Files which are not in the
+        # list anymore are removed. Return True if the list of files changed.
+        # Sizes of files found by the listing (rawfile -> size) are stored if given.
+        now = time.time()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT file FROM replica WHERE site=? AND run=?",(site,run))
+            old_files = set([ f for (f,) in c.fetchall() ])
+            new_files = set(file_list)
+            for f in old_files-new_files:
+                c.execute("DELETE FROM replica WHERE site=? AND file=?",(site,f))
+            for f in new_files-old_files:
+                c.execute("INSERT INTO replica (site,run,file,seen_at) VALUES (?,?,?,?)",(site,run,f,now))
+            c.execute("UPDATE replica SET seen_at=? WHERE site=? AND run=?",(now,site,run))
+            if sizes:
+                for f in new_files:
+                    if f in sizes: c.execute("UPDATE replica SET size=? WHERE site=? AND file=?",(sizes[f],site,f))
+            self.conn.commit()
+        return (old_files != new_files)
+
+    def set_sizes(self,site,sizes):
+
+        # Store size of files (rawfile -> size) already known at site
+        with self.lock:
+            c = self.conn.cursor()
+            for (f,size) in sizes.items():
+                c.execute("UPDATE replica SET size=? WHERE site=? AND file=?",(size,site,f))
+            self.conn.commit()
+
+    def add_replica(self,site,rawfile,size=None,adler32=None,verified=True,verified_by=None):
+
+        # Record a new (or updated) copy of rawfile at site
+        # verified_by tells how the copy was verified ("inline" by the transfer engine or "post"
+        # by comparing checksums after the copy)
+        run = rawfile.split("/")[0]
+        now = time.time()
+        verified_at = None
+        if verified: verified_at = now
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT COUNT(*) FROM replica WHERE site=? AND file=?",(site,rawfile))
+            (n,) = c.fetchone()
+            if n:
+                c.execute("""
+UPDATE replica SET seen_at=?,
+    size=COALESCE(?,size),
+    adler32=COALESCE(?,adler32),
+    verified_at=COALESCE(?,verified_at),
+    verified_by=COALESCE(?,verified_by)
+WHERE site=? AND file=?""",(now,size,adler32,verified_at,verified_by,site,rawfile))
+            else:
+                c.execute("INSERT INTO replica (site,run,file,size,adler32,seen_at,verified_at,verified_by) VALUES (?,?,?,?,?,?,?,?)",
+                          (site,run,rawfile,size,adler32,now,verified_at,verified_by))
+            self.conn.commit()
+
+    def remove_replica(self,site,rawfile):
+
+        # Forget copy of rawfile at site (e.g. a partial copy which was deleted)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM replica WHERE site=? AND file=?",(site,rawfile))
+            self.conn.commit()
+
+    def get_file_list(self,site,run):
+
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT file FROM replica WHERE site=? AND run=? ORDER BY file",(site,run))
+            return [ f for (f,) in c.fetchall() ]
+
+    def is_run_complete(self,source,destination,run,max_age=0):
+
+        # Check if run was fully copied. If max_age is set, older results are not trusted.
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT completed_at FROM run_transfer WHERE source=? AND destination=? AND run=?",(source,destination,run))
+            res = c.fetchone()
+        if res is None: return False
+        if max_age and res[0] < time.time()-max_age: return False
+        return True
+
+    def check_run_complete(self,source,destination,run):
+
+        # Mark run as complete if all files known at source are also known at destination
+        src_files = set(self.get_file_list(source,run))
+        dst_files = set(self.get_file_list(destination,run))
+        if not src_files or not src_files.issubset(dst_files): return False
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT OR REPLACE INTO run_transfer (source,destination,run,n_files,completed_at) VALUES (?,?,?,?,?)",
+                      (source,destination,run,len(src_files),time.time()))
+            self.conn.commit()
+        return True
+
+    def clear_run_complete(self,run,source=None,destination=None):
+
+        # Forget completion status of run (for all routes if source/destination are not given)
+        query = "DELETE FROM run_transfer WHERE run=?"
+        args = [run]
+        if source:
+            query += " AND source=?"
+            args.append(source)
+        if destination:
+            query += " AND destination=?"
+            args.append(destination)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute(query,args)
+            self.conn.commit()
+
+    def update_run_signature(self,site,run,signature):
+
+        # Store current signature of run directory at site. Return True if it changed.
+        now = time.time()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT signature FROM run_signature WHERE site=? AND run=?",(site,run))
+            res = c.fetchone()
+            if res is None:
+                c.execute("INSERT INTO run_signature (site,run,signature,changed_at) VALUES (?,?,?,?)",(site,run,signature,now))
+            elif res[0] != signature:
+                c.execute("UPDATE run_signature SET signature=?,changed_at=? WHERE site=? AND run=?",(signature,now,site,run))
+            else:
+                return False
+            self.conn.commit()
+        return True
+
+    def get_run_signature(self,site,run):
+
+        # Return stored signature of run directory at site (None if run is unknown)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT signature FROM run_signature WHERE site=? AND run=?",(site,run))
+            res = c.fetchone()
+        if res is None: return None
+        return res[0]
+
+    def need_listing(self,site,run,settle_time=0):
+
+        # Run must be listed if it was never listed or if it was last listed less than
+        # settle_time seconds after its signature changed (mtime resolution may hide new files)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT changed_at,listed_at FROM run_signature WHERE site=? AND run=?",(site,run))
+            res = c.fetchone()
+        if res is None or res[1] is None: return True
+        return (res[1] < res[0]+settle_time)
+
+    def set_run_listed(self,site,run):
+
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("UPDATE run_signature SET listed_at=? WHERE site=? AND run=?",(time.time(),site,run))
+            self.conn.commit()
+
+    def where_is(self,rawfile):
+
+        # Return all known copies of a file. Both run/file and plain file names are accepted.
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("""
+SELECT site,file,size,adler32,seen_at,verified_at,verified_by FROM replica
+WHERE file=? OR file LIKE ?
+ORDER BY site""",(rawfile,"%%/%s"%rawfile))
+            return c.fetchall()
+
+    def get_run_replicas(self,run):
+
+        # Return list of (file,site,size,adler32) for all known copies of files in run
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT file,site,size,adler32 FROM replica WHERE run=? ORDER BY file,site",(run,))
+            return c.fetchall()
+
+    def get_incomplete_runs(self,site):
+
+        # Return list of (run,n_missing,n_files) for runs with files known elsewhere but not at site
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("""
+SELECT r.run,
+       COUNT(DISTINCT CASE WHEN s.file IS NULL THEN r.file END),
+       COUNT(DISTINCT r.file)
+FROM replica r
+    LEFT JOIN replica s ON s.site=? AND s.file=r.file
+WHERE r.site!=?
+GROUP BY r.run
+ORDER BY r.run""",(site,site))
+            return [ row for row in c.fetchall() if row[1] ]
+
+    def get_run_transfers(self,run):
+
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT source,destination,n_files,completed_at FROM run_transfer WHERE run=? ORDER BY source,destination",(run,))
+            return c.fetchall()
+
+    def close(self):
+
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+import os
+import re
+import time
+import random
+import sqlite3
+import threading
+
+class RetryQueue:
+
+    def __init__(self,db_file):
+
+        # Queue is kept in a SQLite file (normally the replica catalog file)
+        self.db_file = db_file
+
+        # Backoff parameters for each failure reason: first delay and maximum number of
+        # failures before the file is quarantined. Delay doubles with each failure.
+        self.first_delay = { "copy": 300, "checksum": 3600 }
+        self.max_failures = { "copy": 8, "checksum": 3 }
+
+        # Maximum delay between retries (1 day) and random variation of the delay (+/-25%)
+        self.max_delay = 86400
+        self.jitter = 0.25
+
+        # Connection is shared by all threads of the process: serialize access
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_file,timeout=60,check_same_thread=False)
+
+        self.create_tables()
+
+    def create_tables(self):
+
+        with self.lock:
+            c = self.conn.cursor()
+
+            # Files which failed to be copied from source to destination (file is stored as run/file)
+            c.execute("""
+CREATE TABLE IF NOT EXISTS retry (
+    source            TEXT NOT NULL,
+    destination       TEXT NOT NULL,
+    run               TEXT NOT NULL,
+    file              TEXT NOT NULL,
+    copy_failures     INTEGER DEFAULT 0,
+    checksum_failures INTEGER DEFAULT 0,
+    last_reason       TEXT,
+    last_failure_at   REAL,
+    next_at           REAL,
+    quarantined       INTEGER DEFAULT 0,
+    PRIMARY KEY (source,destination,file)
+)""")
+            self.conn.commit()
+
+    def get_reason(self,reason):
+        if reason == "checksum": return "checksum"
+        return "copy"
+
+    def get_delay(self,reason,failures):
+
+        delay = min(self.first_delay[reason]*2**(failures-1),self.max_delay)
+        return delay*random.uniform(1.-self.jitter,1.+self.jitter)
+
+    def add_failure(self,source,destination,rawfile,reason,failures=1,now=None):
+
+        # Record failed copy of rawfile and compute when it can be tried again
+        # Return number of failures for this reason and True if file is now quarantined
+        reason = self.get_reason(reason)
+        if now is None: now = time.time()
+        run = rawfile.split("/")[0]
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT copy_failures,checksum_failures FROM retry WHERE source=? AND destination=? AND file=?",(source,destination,rawfile))
+            res = c.fetchone()
+            if res is None: res = (0,0)
+            counts = { "copy": res[0], "checksum": res[1] }
+            counts[reason] += failures
+            quarantined = (counts[reason] >= self.max_failures[reason])
+            next_at = now+self.get_delay(reason,counts[reason])
+            c.execute("""
+INSERT OR REPLACE INTO retry (source,destination,run,file,copy_failures,checksum_failures,last_reason,last_failure_at,next_at,quarantined)
+VALUES (?,?,?,?,?,?,?,?,?,?)""",(source,destination,run,rawfile,counts["copy"],counts["checksum"],reason,now,next_at,int(quarantined)))
+            self.conn.commit()
+        return (counts[reason],quarantined)
+
+    def remove(self,source,destination,rawfile):
+
+        # File was copied: forget its failures
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM retry WHERE source=? AND destination=? AND file=?",(source,destination,rawfile))
+            self.conn.commit()
+
+    def get_due(self,source,destination,now=None):
+
+        # Return files which can be tried again now, oldest first
+        if now is None: now = time.time()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT file FROM retry WHERE source=? AND destination=? AND quarantined=0 AND next_at<=? ORDER BY next_at",
+                      (source,destination,now))
+            return [ f for (f,) in c.fetchall() ]
+
+    def get_blocked(self,source,destination,run,now=None):
+
+        # Return files of run which must not be copied now (quarantined or waiting for retry)
+        if now is None: now = time.time()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT file FROM retry WHERE source=? AND destination=? AND run=? AND (quarantined=1 OR next_at>?)",
+                      (source,destination,run,now))
+            return set([ f for (f,) in c.fetchall() ])
+
+    def get_entries(self,quarantined_only=False):
+
+        # Return list of (source,destination,file,copy_failures,checksum_failures,last_reason,last_failure_at,next_at,quarantined)
+        query = "SELECT source,destination,file,copy_failures,checksum_failures,last_reason,last_failure_at,next_at,quarantined FROM retry"
+        if quarantined_only: query += " WHERE quarantined=1"
+        query += " ORDER BY source,destination,file"
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute(query)
+            return c.fetchall()
+
+    def release(self,rawfile):
+
+        # Take file out of quarantine and make it eligible for a new copy right away
+        # Both run/file and plain file names are accepted. Return number of entries released.
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("""
+UPDATE retry SET copy_failures=0,checksum_failures=0,quarantined=0,next_at=?
+WHERE file=? OR file LIKE ?""",(time.time(),rawfile,"%%/%s"%rawfile))
+            n = c.rowcount
+            self.conn.commit()
+        return n
+
+    def import_error_list(self,source,destination,list_file,accept=None):
+
+        # Import failures recorded in old transfer_error_<server_id>.list files
+        # Each line has format "YYYY-MM-DD HH:MM:SS - run/file reason"
+        # Only files for which accept(rawfile) is True are imported (lines do not tell the year
+        # of data taking): imported lines are moved to <list_file>.imported, the others are kept.
+        # Old failures are not replayed: each file gets a single failure with its last reason,
+        # so that it is retried right away and is never quarantined by the import.
+        if not os.path.exists(list_file): return 0
+        failures = {}
+        imported = []
+        kept = []
+        with open(list_file,"r") as f:
+            for line in f:
+                m = re.match("^\s*\S+\s+\S+\s+-\s+(\S+)\s+(\S+)\s*$",line)
+                if m and (accept is None or accept(m.group(1))):
+                    failures[m.group(1)] = self.get_reason(m.group(2))
+                    imported.append(line)
+                else:
+                    kept.append(line)
+        if not imported: return 0
+        now = time.time()
+        for rawfile in failures.keys():
+            self.add_failure(source,destination,rawfile,failures[rawfile],1,now-self.max_delay*2)
+        with open("%s.imported"%list_file,"a") as f: f.writelines(imported)
+        if kept:
+            with open("%s.tmp"%list_file,"w") as f: f.writelines(kept)
+            os.rename("%s.tmp"%list_file,list_file)
+        else:
+            os.remove(list_file)
+        return len(failures)
+
+    def close(self):
+
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+import os
+import time
+import errno
+import fcntl
+import shlex
+import socket
+import threading
+import subprocess
+
+from contextlib import contextmanager
+
+class SSHHandler:
+
+    def __init__(self,persist=600):
+
+        # Set to 1 or more to enable printout of master connection handling
+        self.debug = 0
+
+        # Master connections are closed after being idle for this time (seconds)
+        self.persist = persist
+
+        # Default maximum number of sessions sharing a master connection
+        # N.B. sshd refuses more than MaxSessions (default 10) sessions per connection
+        self.default_sessions = 8
+
+        # Control sockets are shared by all CDR processes of this user (servers, tools, monitor)
+        # Sessions are counted across processes with one lock file per session slot
+        self.control_dir = "%s/.ssh/cdr"%os.path.expanduser("~")
+        if not os.path.isdir(self.control_dir):
+            try:
+                os.makedirs(self.control_dir,0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
+        self.control_path = "%s/%%r@%%h:%%p"%self.control_dir
+
+        # Interval (seconds) between attempts to get a free session slot
+        self.slot_poll_interval = 0.2
+
+        # Options used by all ssh/scp commands: sessions only use an existing master
+        # connection and fall back to a direct connection if the master is not available
+        self.options = "-o ControlMaster=no -o ControlPath=%s"%self.control_path
+
+        # Known remote accounts: (user,host) -> (keyfile,sessions)
+        # N.B. master connections are not closed at exit: they may be used by other processes
+        # and close by themselves after being idle for persist seconds
+        self.lock = threading.Lock()
+        self.accounts = {}
+
+    def get_ssh(self,keyfile,user,host,sessions=0,options=""):
+
+        # Return ssh syntax to execute a command on host using a shared master connection
+        if options:
+            ssh = "ssh %s -i %s %s -l %s %s"%(options,keyfile,self.options,user,host)
+        else:
+            ssh = "ssh -i %s %s -l %s %s"%(keyfile,self.options,user,host)
+        self.add_account(keyfile,user,host,sessions)
+        return ssh
+
+    def get_scp(self,keyfile,user,host,sessions=0):
+
+        # Return scp syntax to copy files to/from user@host using a shared master connection
+        scp = "scp -i %s %s"%(keyfile,self.options)
+        self.add_account(keyfile,user,host,sessions)
+        return scp
+
+    def add_account(self,keyfile,user,host,sessions):
+
+        if not sessions: sessions = self.default_sessions
+        with self.lock:
+            if not (user,host) in self.accounts:
+                self.accounts[(user,host)] = (keyfile,sessions)
+
+    def socket_file(self,user,host):
+        return "%s/%s@%s:22"%(self.control_dir,user,host)
+
+    def acquire_slot(self,user,host,sessions):
+
+        # Wait for one of the sessions slots of user@host to be free and lock it
+        # Locks are released by the system if the process dies
+        while True:
+            for n in range(sessions):
+                fd = os.open("%s/%s@%s.slot%d"%(self.control_dir,user,host,n),os.O_RDWR|os.O_CREAT,0600)
+                try:
+                    fcntl.flock(fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+                    return fd
+                except IOError:
+                    os.close(fd)
+            time.sleep(self.slot_poll_interval)
+
+    def release_slot(self,fd):
+        fcntl.flock(fd,fcntl.LOCK_UN)
+        os.close(fd)
+
+    def master_running(self,user,host):
+
+        # Check if a master connection is listening on the control socket
+        # Sockets left by a master which died are removed
+        path = self.socket_file(user,host)
+        if not os.path.exists(path): return False
+        s = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+            return True
+        except socket.error as e:
+            if e.errno == errno.ECONNREFUSED:
+                if self.debug: print "> Removing stale control socket %s"%path
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return False
+        finally:
+            s.close()
+
+    def start_master(self,user,host,keyfile):
+
+        # Start master connection to host in background if it is not running
+        # The lock file makes sure that only one process starts it
+        # N.B. master is started explicitly with all standard streams on /dev/null: if it were
+        # started by a session, it would keep the session output pipes open after it ended
+        fd = os.open("%s/%s@%s.master.lock"%(self.control_dir,user,host),os.O_RDWR|os.O_CREAT,0600)
+        try:
+            fcntl.flock(fd,fcntl.LOCK_EX)
+            if self.master_running(user,host): return
+            cmd = "ssh -i %s -o ControlMaster=yes -o ControlPath=%s -o ControlPersist=%d -N -f -l %s %s"%(keyfile,self.control_path,self.persist,user,host)
+            if self.debug: print "> %s"%cmd
+            with open(os.devnull,"r+") as devnull:
+                rc = subprocess.call(shlex.split(cmd),stdin=devnull,stdout=devnull,stderr=devnull)
+            if rc:
+                print "- WARNING - Unable to start ssh master connection to %s@%s (error %d)"%(user,host,rc)
+        finally:
+            fcntl.flock(fd,fcntl.LOCK_UN)
+            os.close(fd)
+
+    @contextmanager
+    def session(self,command):
+
+        # Reserve a session on all master connections used by command (ssh or scp)
+        # Commands not using any known account are executed without restrictions
+        with self.lock:
+            accounts = []
+            for (user,host) in sorted(self.accounts.keys()):
+                if ( command.startswith("ssh ") and (" -l %s %s "%(user,host) in command+" ") ) or ("%s@%s:"%(user,host) in command):
+                    accounts.append((user,host)+self.accounts[(user,host)])
+
+        acquired = []
+        try:
+            for (user,host,keyfile,sessions) in accounts:
+                acquired.append(self.acquire_slot(user,host,sessions))
+                self.start_master(user,host,keyfile)
+            yield
+        finally:
+            for fd in acquired: self.release_slot(fd)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+import os
+import time
+import errno
+import fcntl
+import shutil
+
+class StagingArea:
+
+    def __init__(self,staging_dir,budget=20*1024**3,min_free=5*1024**3):
+
+        # Set to 1 or more to enable printout of reservations
+        self.debug = 0
+
+        # Directory holding local temporary copies of files. It can be shared by several
+        # processes: each process uses its own subdirectory.
+        self.staging_dir = staging_dir
+
+        # Maximum number of bytes reserved at the same time by all processes
+        self.budget = budget
+
+        # Free space which must always be left on the file system holding the staging area
+        self.min_free = min_free
+
+        # While waiting for space, check again every poll_interval seconds
+        self.poll_interval = 10
+
+        self.process_dir = "%s/%d"%(self.staging_dir,os.getpid())
+        self.lock_file = "%s/.lock"%self.staging_dir
+
+        if not os.path.isdir(self.staging_dir): os.makedirs(self.staging_dir)
+        self.cleanup()
+
+    def pid_alive(self,pid):
+
+        try:
+            os.kill(pid,0)
+        except OSError as e:
+            if e.errno == errno.ESRCH: return False
+        return True
+
+    def cleanup(self):
+
+        # Remove files and reservations left by processes which are not running anymore
+        fd = self.lock()
+        try:
+            for entry in os.listdir(self.staging_dir):
+                if not entry.isdigit(): continue
+                if self.pid_alive(int(entry)): continue
+                print "StagingArea - Removing orphan staging directory %s/%s"%(self.staging_dir,entry)
+                shutil.rmtree("%s/%s"%(self.staging_dir,entry),True)
+        finally:
+            self.unlock(fd)
+
+    def lock(self):
+        fd = os.open(self.lock_file,os.O_RDWR|os.O_CREAT,0664)
+        fcntl.flock(fd,fcntl.LOCK_EX)
+        return fd
+
+    def unlock(self,fd):
+        os.close(fd)
+
+    def get_reserved(self):
+
+        # Return total number of bytes reserved by all running processes and the part of
+        # them not yet written to disk (bytes already written are not in the free space anymore)
+        reserved = 0
+        unwritten = 0
+        for entry in os.listdir(self.staging_dir):
+            if not (entry.isdigit() and self.pid_alive(int(entry))): continue
+            pdir = "%s/%s"%(self.staging_dir,entry)
+            for rsv in os.listdir(pdir):
+                if not rsv.endswith(".rsv"): continue
+                try:
+                    with open("%s/%s"%(pdir,rsv),"r") as f: size = int(f.read())
+                except (IOError,ValueError):
+                    continue
+                try:
+                    written = os.path.getsize("%s/%s"%(pdir,rsv[:-4]))
+                except OSError:
+                    written = 0
+                reserved += size
+                unwritten += max(size-written,0)
+        return (reserved,unwritten)
+
+    def get_free(self):
+        st = os.statvfs(self.staging_dir)
+        return st.f_bavail*st.f_frsize
+
+    def file_path(self,name):
+        return "%s/%s"%(self.process_dir,name.replace("/","__"))
+
+    def try_reserve(self,name,size):
+
+        # Reserve size bytes for file name if budget and free disk space allow it
+        # A file larger than the budget is accepted when nothing else is reserved
+        fd = self.lock()
+        try:
+            (reserved,unwritten) = self.get_reserved()
+            if reserved:
+                if reserved+size > self.budget: return False
+                if self.get_free()-(unwritten+size) < self.min_free: return False
+            elif self.get_free()-size < self.min_free:
+                return False
+            if not os.path.isdir(self.process_dir): os.makedirs(self.process_dir)
+            with open("%s.rsv"%self.file_path(name),"w") as f: f.write("%d"%size)
+        finally:
+            self.unlock(fd)
+        if self.debug: print "StagingArea - Reserved %d bytes for %s (%d already reserved)"%(size,name,reserved)
+        return True
+
+    def reserve(self,name,size,timeout=0):
+
+        # Reserve space for a local copy of file name and return the path to use for it
+        # If space is not available, wait until other copies release it (or timeout expires)
+        # Return "" if no space could be reserved
+        start = time.time()
+        waiting = False
+        while not self.try_reserve(name,size):
+            if timeout and time.time()-start > timeout:
+                print "StagingArea - Unable to reserve %d bytes for %s after %d seconds"%(size,name,timeout)
+                return ""
+            if not waiting:
+                print "StagingArea - Waiting for %d bytes to stage %s"%(size,name)
+                waiting = True
+            time.sleep(self.poll_interval)
+        return self.file_path(name)
+
+    def release(self,path):
+
+        # Remove local copy and its reservation
+        for f in (path,"%s.rsv"%path):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import os
+import zlib
+import shlex
+import tempfile
+import subprocess
+import distutils.spawn
+
+class StreamCopy:
+
+    def __init__(self,SH=None):
+
+        # Set to 1 or more to enable printout of executed commands
+        self.debug = 0
+
+        # SSH handler used to run remote commands (optional)
+        self.SH = SH
+
+        # Size of data blocks passed from source to destination (bytes)
+        self.block_size = 4*1024*1024
+
+    def can_stream_srm(self):
+
+        # Streaming from storage elements needs gfal-cat
+        return (distutils.spawn.find_executable("gfal-cat") is not None)
+
+    def copy(self,src_command,dst_command):
+
+        # Run src_command, which writes the file to its stdout, and dst_command, which writes
+        # its stdin to the destination file, passing data between them without any local copy.
+        # Return (status,adler32,size) where adler32 and size refer to the data which were sent.
+        # Status is "unavailable" if source could not send any data: caller may then fall back
+        # to a copy through a local file.
+        if self.debug:
+            print "> %s"%src_command
+            print "> %s"%dst_command
+        if self.SH:
+            with self.SH.session(src_command):
+                with self.SH.session(dst_command):
+                    return self.pipe(src_command,dst_command)
+        return self.pipe(src_command,dst_command)
+
+    def pipe(self,src_command,dst_command):
+
+        src_err = tempfile.TemporaryFile()
+        dst_out = tempfile.TemporaryFile()
+        try:
+            with open(os.devnull,"r") as devnull:
+                src = subprocess.Popen(shlex.split(src_command),stdin=devnull,stdout=subprocess.PIPE,stderr=src_err)
+        except OSError as e:
+            print "- WARNING - Unable to start stream source command: %s"%e
+            return ("unavailable","",0)
+        dst = subprocess.Popen(shlex.split(dst_command),stdin=subprocess.PIPE,stdout=dst_out,stderr=subprocess.STDOUT)
+
+        a32 = 1
+        size = 0
+        write_failed = False
+        while True:
+            data = src.stdout.read(self.block_size)
+            if not data: break
+            a32 = zlib.adler32(data,a32)
+            size += len(data)
+            try:
+                dst.stdin.write(data)
+            except IOError:
+                # Destination command died: stop reading from source
+                write_failed = True
+                src.kill()
+                break
+        try:
+            dst.stdin.close()
+        except IOError:
+            write_failed = True
+        src_rc = src.wait()
+        dst_rc = dst.wait()
+
+        status = "ok"
+        if src_rc or dst_rc or write_failed:
+            status = "error"
+            if src_rc and (size == 0): status = "unavailable"
+            for (name,rc,out) in (("source",src_rc,src_err),("destination",dst_rc,dst_out)):
+                out.seek(0)
+                msg = out.read().rstrip()
+                if rc or msg: print "- WARNING - Stream %s command returned %d\n%s"%(name,rc,msg)
+        src_err.close()
+        dst_out.close()
+
+        return (status,"%08x"%(a32 & 0xffffffff),size)
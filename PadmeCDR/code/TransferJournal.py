@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+import os
+import time
+import errno
+import sqlite3
+import threading
+
+class TransferJournal:
+
+    def __init__(self,db_file):
+
+        # Journal is kept in a SQLite file (normally the replica catalog file)
+        self.db_file = db_file
+
+        # Each copy goes through these states. The state is written before moving on with the
+        # next step, so that after a crash the server knows what to clean up or to complete:
+        #   started   - copy to destination begun: destination may hold a partial file
+        #   copied    - data copied but not verified yet
+        #   verified  - checksums match but copy is not recorded/moved to its final place yet
+        #   committed - copy is complete and recorded in the replica catalog
+        self.states = [ "started", "copied", "verified", "committed" ]
+
+        # Committed entries are kept for some time (1 week) for reference, then removed
+        self.keep_period = 604800
+
+        # Connection is shared by all threads of the process: serialize access
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_file,timeout=60,check_same_thread=False)
+
+        self.create_tables()
+
+    def create_tables(self):
+
+        with self.lock:
+            c = self.conn.cursor()
+
+            # Last known state of each copy from source to destination (file is stored as run/file)
+            c.execute("""
+CREATE TABLE IF NOT EXISTS transfer_journal (
+    source      TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    run         TEXT NOT NULL,
+    file        TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    adler32     TEXT,
+    pid         INTEGER,
+    updated_at  REAL,
+    PRIMARY KEY (source,destination,file)
+)""")
+            self.conn.commit()
+
+    def set_state(self,source,destination,rawfile,state,adler32=None):
+
+        # Record new state of the copy of rawfile (and its checksum, once known)
+        if not state in self.states:
+            print "TransferJournal - ***ERROR*** unknown state %s for file %s"%(state,rawfile)
+            return "error"
+        run = rawfile.split("/")[0]
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("""
+INSERT OR REPLACE INTO transfer_journal (source,destination,run,file,state,adler32,pid,updated_at)
+VALUES (?,?,?,?,?,COALESCE(?,(SELECT adler32 FROM transfer_journal WHERE source=? AND destination=? AND file=?)),?,?)""",
+                      (source,destination,run,rawfile,state,adler32,source,destination,rawfile,os.getpid(),time.time()))
+            self.conn.commit()
+        return "ok"
+
+    def claim(self,source,destination,rawfile):
+
+        # Record start of a copy of rawfile to destination, unless another running copy is writing
+        # the same file to the same destination: from another source (e.g. a fan-out copy and a
+        # copy from DAQ) or in another process. Return True if the copy can start.
+        # Entries of processes which are not running anymore do not block the copy.
+        run = rawfile.split("/")[0]
+        others = "destination=? AND file=? AND state!='committed' AND pid IS NOT NULL AND (source!=? OR pid!=?)"
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT source,pid FROM transfer_journal WHERE %s"%others,(destination,rawfile,source,os.getpid()))
+            for (s,pid) in c.fetchall():
+                if not self.pid_alive(pid):
+                    c.execute("UPDATE transfer_journal SET pid=NULL WHERE source=? AND destination=? AND file=? AND pid=?",(s,destination,rawfile,pid))
+            # Check and insert with a single statement, so that two processes cannot both claim the file
+            c.execute("""
+INSERT OR REPLACE INTO transfer_journal (source,destination,run,file,state,adler32,pid,updated_at)
+SELECT ?,?,?,?,'started',(SELECT adler32 FROM transfer_journal WHERE source=? AND destination=? AND file=?),?,?
+WHERE NOT EXISTS (SELECT 1 FROM transfer_journal WHERE %s)"""%others,
+                      (source,destination,run,rawfile,source,destination,rawfile,os.getpid(),time.time(),destination,rawfile,source,os.getpid()))
+            claimed = (c.rowcount == 1)
+            self.conn.commit()
+        return claimed
+
+    def release(self,source,destination,rawfile):
+
+        # Copy failed and was cleaned up by the copying process: the entry is kept until the
+        # file is copied again, but it is not attached to a running process anymore
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("UPDATE transfer_journal SET pid=NULL WHERE source=? AND destination=? AND file=?",(source,destination,rawfile))
+            self.conn.commit()
+
+    def remove(self,source,destination,rawfile):
+
+        # Destination was cleaned up: forget the copy
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM transfer_journal WHERE source=? AND destination=? AND file=?",(source,destination,rawfile))
+            self.conn.commit()
+
+    def pid_alive(self,pid):
+
+        if not pid: return False
+        try:
+            os.kill(pid,0)
+        except OSError as e:
+            if e.errno == errno.ESRCH: return False
+        return True
+
+    def get_in_flight(self,source,destination,run=None):
+
+        # Return list of (file,state,adler32,active) for copies which were not committed
+        # Copies are active if the process which is copying them is still running (copies
+        # from the same route are also started by fan-out from other routes)
+        query = "SELECT file,state,adler32,pid FROM transfer_journal WHERE source=? AND destination=? AND state!='committed'"
+        args = [source,destination]
+        if run:
+            query += " AND run=?"
+            args.append(run)
+        query += " ORDER BY file"
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute(query,args)
+            entries = c.fetchall()
+        return [ (f,state,adler32,self.pid_alive(pid)) for (f,state,adler32,pid) in entries ]
+
+    def get_active(self,source,destination,run):
+
+        # Return set of files of run which other running copies are writing to destination (from
+        # another source or in another process)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT file,pid FROM transfer_journal WHERE destination=? AND run=? AND state!='committed' AND pid IS NOT NULL AND (source!=? OR pid!=?)",
+                      (destination,run,source,os.getpid()))
+            entries = c.fetchall()
+        return set([ f for (f,pid) in entries if self.pid_alive(pid) ])
+
+    def get_entries(self):
+
+        # Return list of (source,destination,file,state,adler32,pid,updated_at)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT source,destination,file,state,adler32,pid,updated_at FROM transfer_journal ORDER BY source,destination,file")
+            return c.fetchall()
+
+    def purge(self):
+
+        # Remove committed entries older than keep_period. Return number of entries removed.
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM transfer_journal WHERE state='committed' AND updated_at<?",(time.time()-self.keep_period,))
+            n = c.rowcount
+            self.conn.commit()
+        return n
+
+    def close(self):
+
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
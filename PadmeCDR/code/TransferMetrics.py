@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+import time
+import sqlite3
+import threading
+
+class TransferMetrics:
+
+    def __init__(self,db_file):
+
+        # Metrics are kept in a SQLite file (normally the replica catalog file)
+        self.db_file = db_file
+
+        # Metrics older than this are removed (30 days)
+        self.keep_period = 2592000
+
+        # Connection is shared by all threads of the process: serialize access
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_file,timeout=60,check_same_thread=False)
+
+        self.create_tables()
+
+    def create_tables(self):
+
+        with self.lock:
+            c = self.conn.cursor()
+
+            # One entry for each successful copy: size of the file (bytes) and time spent to copy
+            # and verify it (seconds)
+            c.execute("""
+CREATE TABLE IF NOT EXISTS transfer_metrics (
+    source      TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    file        TEXT NOT NULL,
+    size        INTEGER,
+    duration    REAL,
+    finished_at REAL
+)""")
+            c.execute("CREATE INDEX IF NOT EXISTS transfer_metrics_route ON transfer_metrics (source,destination,finished_at)")
+            self.conn.commit()
+
+    def add_transfer(self,source,destination,rawfile,size,duration):
+
+        now = time.time()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT INTO transfer_metrics (source,destination,file,size,duration,finished_at) VALUES (?,?,?,?,?,?)",
+                      (source,destination,rawfile,size,duration,now))
+            c.execute("DELETE FROM transfer_metrics WHERE finished_at<?",(now-self.keep_period,))
+            self.conn.commit()
+
+    def get_throughput(self,source,destination,period):
+
+        # Return (copies,bytes,duration,peak) for copies on route which ended in the last period seconds
+        # Bytes/duration is the mean throughput of a single copy, peak is the highest number of
+        # bytes copied on the route in one hour (all parallel copies together)
+        since = time.time()-period
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT COUNT(*),SUM(size),SUM(duration) FROM transfer_metrics WHERE source=? AND destination=? AND finished_at>=?",
+                      (source,destination,since))
+            (copies,size,duration) = c.fetchone()
+            c.execute("""
+SELECT MAX(hour_size) FROM (
+    SELECT SUM(size) AS hour_size FROM transfer_metrics
+    WHERE source=? AND destination=? AND finished_at>=?
+    GROUP BY CAST(finished_at/3600 AS INTEGER)
+)""",(source,destination,since))
+            (peak,) = c.fetchone()
+        return (copies,size or 0,duration or 0.,peak or 0)
+
+    def close(self):
+
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
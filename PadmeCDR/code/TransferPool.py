@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import threading
+import traceback
+
+from Logger import start_thread
+
+class TransferPool:
+
+    def __init__(self,workers,share=None,route=""):
+
+        # Maximum number of transfers which can run at the same time
+        self.workers = workers
+
+        # Pools of several routes may also share a common number of slots (see FairShare)
+        self.share = share
+        self.route = route
+
+        # Number of slots currently reserved or in use
+        self.running = 0
+
+        self.cond = threading.Condition()
+
+    def reserve_slot(self,check=None):
+
+        # Wait until a transfer slot is free and reserve it
+        # While waiting, call check function (if any) about once per second
+        while True:
+            with self.cond:
+                if self.running < self.workers:
+                    self.running += 1
+                    break
+                self.cond.wait(1.)
+            if check: check()
+
+        # Then wait for a slot shared with other routes, if any
+        if self.share:
+            try:
+                self.share.acquire(self.route,check)
+            except:
+                self.release_slot(False)
+                raise
+
+    def release_slot(self,shared=True):
+
+        if (self.share and shared): self.share.release(self.route)
+        with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+    def set_workers(self,workers):
+
+        # Change maximum number of parallel transfers. Transfers in progress are not affected.
+        with self.cond:
+            self.workers = workers
+            self.cond.notify_all()
+
+    def start(self,function,args=()):
+
+        # Run function in a new thread using a previously reserved slot
+        start_thread(self.run_transfer,(function,args))
+
+    def submit(self,function,args=(),check=None):
+
+        self.reserve_slot(check)
+        self.start(function,args)
+
+    def run_transfer(self,function,args):
+
+        try:
+            function(*args)
+        except Exception:
+            print "- WARNING - Unexpected exception in transfer thread\n%s"%traceback.format_exc().rstrip()
+        finally:
+            self.release_slot()
+
+    def active(self):
+
+        with self.cond:
+            return self.running
+
+    def wait(self,check=None):
+
+        # Wait for all transfers in progress to complete
+        while True:
+            with self.cond:
+                if self.running == 0: return
+                self.cond.wait(1.)
+            if check: check()
@@ -17,6 +17,25 @@ while os.path.islink(thisscript): thisscript = os.readlink(thisscript)
 SCRIPT_DIR,SCRIPT_FILE = os.path.split(os.path.abspath(thisscript))
 #print SCRIPT_PATH,SCRIPT_NAME,SCRIPT_DIR,SCRIPT_FILE
 
+# Local temporary copies use the staging area shared with the CDR servers
+sys.path.insert(0,"%s/../code"%SCRIPT_DIR)
+from StagingArea import StagingArea
+STAGING_DIR = os.getenv('PADME_CDR_STAGING_DIR',"/tmp/PadmeCDR_staging")
+STAGING_DEFAULT_SIZE = 2*1024**3
+# Give up a copy if no space can be reserved in the staging area within this time (seconds)
+STAGING_TIMEOUT = 3600
+SA = StagingArea(STAGING_DIR)
+
+# VOMS proxy is renewed from the CDR long-lived proxy: when many copies run in parallel
+# only one of them renews it while the others wait and use the new proxy
+from ProxyHandler import ProxyHandler
+PH = ProxyHandler()
+PH.long_proxy_file = "%s/run/long_proxy"%os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+
+# Bandwidth used on each link is shared with the CDR servers and with other copies on the same link
+from BandwidthLimiter import BandwidthLimiter
+BANDWIDTH_DIR = "%s/run"%os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+
 # List of available sites
 SITE_LIST = [ "LNF", "LNF2", "CNAF", "CNAF2", "KLOE", "LOCAL" ]
 
@@ -59,12 +78,13 @@ DST_DEFAULT = "CNAF"
 VERBOSE = 0
 
 def print_help():
-    print '%s -F file_path [-S src_site] [-D dst_site] [-s src_dir] [-d dst_dir] [-c] [-v] [-h]'%SCRIPT_NAME
+    print '%s -F file_path [-S src_site] [-D dst_site] [-s src_dir] [-d dst_dir] [-B bw] [-c] [-v] [-h]'%SCRIPT_NAME
     print '  -F file_path    Full path (relative to storage system top dir) of file to copy. E.g. /mc/devel/prod_test/sim/prod_test_job000001.root'
     print '  -S src_site     Source site. Default: %s'%SRC_DEFAULT
     print '  -D dst_site     Destination site. Default: %s'%DST_DEFAULT
     print '  -s src_dir      Path to top dir when source is LOCAL.'
     print '  -d dst_dir      Path to top dir when destination is LOCAL.'
+    print '  -B bw           Maximum bandwidth in MB/s for this link (0 means no limit). Default: depends on route'
     print '  -v              Enable verbose mode (repeat to increase level)'
     print '  -h              Show this help message and exit'
     print '  Available sites:   %s'%SITE_LIST
@@ -118,6 +138,13 @@ def file_exists_kloe(filepath):
 
     return False
 
+def get_size(filepath,site,top_dir):
+    if (site == "LNF" or site == "LNF2" or site == "CNAF" or site == "CNAF2"):
+        return get_size_srm(filepath,site)
+    elif (site == "LOCAL"):
+        return get_size_local(filepath,top_dir)
+    return ""
+
 def get_size_srm(filepath,site):
     size = ""
     cmd = "gfal-stat %s%s"%(SRM[site],filepath)
@@ -336,8 +363,16 @@ def copy_file_srm_kloe(filepath,src_site):
         if err: print "- STDERR -\n%s"%err,
         return "error"
 
-    # Copy file from SRM to local tmp file
-    tmp_file = "/tmp/%s/%s"%(SCRIPT_NAME,dst_file)
+    # Copy file from SRM to local tmp file in the staging area (wait if it is full)
+    size = get_size_srm(filepath,src_site)
+    if size:
+        size = int(size)
+    else:
+        size = STAGING_DEFAULT_SIZE
+    tmp_file = SA.reserve(filepath,size,STAGING_TIMEOUT)
+    if not tmp_file:
+        print "%s - File %s - ***ERROR*** no space available in staging area %s"%(now_str(),filepath,STAGING_DIR)
+        return "error"
     cmd = "gfal-copy -t 3600 -T 3600 -p %s%s file://%s"%(SRM[src_site],filepath,tmp_file)
     (rc,out,err) = execute_command(cmd)
     if rc == 0:
@@ -346,9 +381,8 @@ def copy_file_srm_kloe(filepath,src_site):
         print "%s - File %s - ***ERROR*** gfal-copy returned error status while copying from %s to local file %s"%(now_str(),filepath,src_site,tmp_file)
         if out: print "- STDOUT -\n%s"%out,
         if err: print "- STDERR -\n%s"%err,
-        # Remove destination file (if any)
-        cmd = "rm -f %s"%tmp_file
-        subprocess.call(shlex.split(cmd))
+        # Remove local temporary file (if any)
+        SA.release(tmp_file)
         return "error"
 
     # Now send local copy to KLOE temporary directory using good old scp
@@ -365,13 +399,11 @@ def copy_file_srm_kloe(filepath,src_site):
         cmd = "ssh -i %s -l %s %s rm -f %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,tmp_file_kloe)
         subprocess.call(shlex.split(cmd))
         # Remove local temporary file
-        cmd = "rm -f %s"%tmp_file
-        subprocess.call(shlex.split(cmd))
+        SA.release(tmp_file)
         return "error"
 
     # Clean up local temporary file
-    cmd = "rm -f %s"%tmp_file
-    subprocess.call(shlex.split(cmd))
+    SA.release(tmp_file)
 
     # Verify checksum
     (dum0,dum1,size_src,a32_src) = check_file(filepath,src_site,"")
@@ -547,9 +579,10 @@ def main(argv):
     dst_site = DST_DEFAULT
     dst_string = ""
     dst_dir = ""
+    bandwidth = None
 
     try:
-        opts,args = getopt.getopt(argv,"F:S:D:s:d:vh")
+        opts,args = getopt.getopt(argv,"F:S:D:s:d:B:vh")
     except getopt.GetoptError as err:
         end_error("ERROR - %s"%err)
 
@@ -571,6 +604,11 @@ def main(argv):
             src_dir = arg
         elif opt == '-d':
             dst_dir = arg
+        elif opt == '-B':
+            try:
+                bandwidth = int(arg)
+            except ValueError:
+                end_error("ERROR - Invalid bandwidth %s"%arg)
         elif opt == '-v':
             VERBOSE += 1
 
@@ -611,6 +649,9 @@ def main(argv):
     print
     print "%s === TransferFile %s from %s to %s ==="%(now_str(),filepath,src_string,dst_string)
 
+    # Make sure a valid VOMS proxy is available
+    PH.renew_voms_proxy()
+
     # Check if file exists at source site
     if not file_exists(filepath,src_site,src_dir):
         print "ERROR - file %s is missing at source site %s"%(filepath,src_string)
@@ -633,6 +674,17 @@ def main(argv):
 
         sys.exit()
 
+    # Wait until the bandwidth allowed on this link is available
+    # Size of the file is only needed if bandwidth is limited
+    BW = BandwidthLimiter(BANDWIDTH_DIR,"%s_%s"%(src_site,dst_site),"%s_%s"%(src_site,dst_site))
+    if bandwidth is not None: BW.set_limit("idle",bandwidth)
+    if BW.rate:
+        size = get_size(filepath,src_site,src_dir)
+        if size:
+            BW.acquire(int(size))
+        else:
+            BW.acquire()
+
     # Copy the file
     if copy_file(filepath,src_site,src_dir,dst_site,dst_dir) == "ok":
         print "%s - File %s - Copy from %s to %s successful"%(now_str(),filepath,src_string,dst_string)
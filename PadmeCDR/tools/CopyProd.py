@@ -21,6 +21,12 @@ SCRIPT_DIR,SCRIPT_FILE = os.path.split(os.path.abspath(thisscript))
 # Define correct path to CopyFile script
 COPYFILE = "%s/CopyFile.py"%SCRIPT_DIR
 
+# Renew VOMS proxy before starting parallel copies, so that they find a valid proxy
+sys.path.insert(0,"%s/../code"%SCRIPT_DIR)
+from ProxyHandler import ProxyHandler
+PH = ProxyHandler()
+PH.long_proxy_file = "%s/run/long_proxy"%os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+
 # Create global handler to PadmeMCDB
 DB = PadmeMCDB()
 
@@ -54,13 +60,14 @@ JOBS_DEFAULT = "20"
 VERBOSE = 0
 
 def print_help():
-    print '%s -P prod_name [-S src_site] [-D dst_site] [-s src_dir]  [-d dst_dir] [-j jobs] [-h]'%SCRIPT_NAME
+    print '%s -P prod_name [-S src_site] [-D dst_site] [-s src_dir]  [-d dst_dir] [-j jobs] [-B bw] [-h]'%SCRIPT_NAME
     print '  -P prod_name    Name of production to copy'
     print '  -S src_site     Source site. Default: %s'%SRC_DEFAULT
     print '  -D dst_site     Destination site. Default: %s'%DST_DEFAULT
     print '  -s src_dir      Path to data directory if source is LOCAL.'
     print '  -d dst_dir      Path to data directory if destination is LOCAL.'
     print '  -j jobs         Number of parallel jobs to use. Default: %s'%JOBS_DEFAULT
+    print '  -B bw           Maximum bandwidth in MB/s for this link (0 means no limit). Default: depends on route'
     print '  -h              Show this help message and exit'
     print '  Available sites:   %s'%SITE_LIST
 
@@ -127,9 +134,10 @@ def main(argv):
     src_srm = ""
     dst_srm = ""
     jobs = JOBS_DEFAULT
+    bandwidth = ""
 
     try:
-        opts,args = getopt.getopt(argv,"P:S:D:s:d:j:h")
+        opts,args = getopt.getopt(argv,"P:S:D:s:d:j:B:h")
     except getopt.GetoptError as e:
         end_error("Option error: %s"%str(e))
 
@@ -153,6 +161,8 @@ def main(argv):
             dst_dir = arg
         elif opt == '-j':
             jobs = arg
+        elif opt == '-B':
+            bandwidth = arg
 
     # Check if a production was specified
     if not prod:
@@ -219,9 +229,11 @@ def main(argv):
     print "%s === %s - copying production %s from %s to %s ==="%(now_str(),SCRIPT_NAME,prod,src_string,dst_string)
     print "%s - Start copying production %s (%d files)"%(now_str(),prod,len(copy_file_list))
 
+    PH.renew_voms_proxy()
     cmd = "parallel -j %s %s -F {} -S %s -D %s"%(jobs,COPYFILE,src_site,dst_site)
     if src_dir: cmd += " -s %s"%src_dir
     if dst_dir: cmd += " -d %s"%dst_dir
+    if bandwidth: cmd += " -B %s"%bandwidth
     cmd += " :::"
     #for f in copy_file_list: cmd += " %s"%f
     for f in copy_file_list: cmd += " %s/%s"%(prod_dir,f)
@@ -15,6 +15,31 @@ while os.path.islink(thisscript): thisscript = os.readlink(thisscript)
 SCRIPT_DIR,SCRIPT_FILE = os.path.split(os.path.abspath(thisscript))
 #print SCRIPT_PATH,SCRIPT_NAME,SCRIPT_DIR,SCRIPT_FILE
 
+# Use ssh handler from PadmeCDR code: all commands sent to the same remote account share one connection
+sys.path.insert(0,"%s/../code"%SCRIPT_DIR)
+from SSHHandler import SSHHandler
+from StreamCopy import StreamCopy
+from StagingArea import StagingArea
+SH = SSHHandler(60)
+SC = StreamCopy(SH)
+
+# Local temporary copies use the staging area shared with the CDR servers
+STAGING_DIR = os.getenv('PADME_CDR_STAGING_DIR',"/tmp/PadmeCDR_staging")
+STAGING_DEFAULT_SIZE = 2*1024**3
+# Give up a copy if no space can be reserved in the staging area within this time (seconds)
+STAGING_TIMEOUT = 3600
+SA = StagingArea(STAGING_DIR)
+
+# VOMS proxy is renewed from the CDR long-lived proxy: when many copies run in parallel
+# only one of them renews it while the others wait and use the new proxy
+from ProxyHandler import ProxyHandler
+PH = ProxyHandler()
+PH.long_proxy_file = "%s/run/long_proxy"%os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+
+# Bandwidth used on each link is shared with the CDR servers and with other copies on the same link
+from BandwidthLimiter import BandwidthLimiter
+BANDWIDTH_DIR = "%s/run"%os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+
 # List of available sites
 SITE_LIST = [ "LNF", "LNF2", "CNAF", "CNAF2", "KLOE", "DAQ", "LOCAL" ]
 
@@ -31,6 +56,8 @@ DAQ_KEYFILE = "/home/%s/.ssh/id_rsa_cdr"%CDR_USER
 DAQ_SERVERS = [ "l1padme3", "l1padme4" ]
 DAQ_PATH = "/data/DAQ"
 DAQ_ADLER32_CMD = "/home/daq/DAQ/tools/adler32"
+DAQ_CURRENT_RUN_FILE = "/home/daq/DAQ/run/current_run"
+DAQ_LAST_RUN_FILE = "/home/daq/DAQ/run/last_run"
 
 # Access information for KLOE tape library
 KLOE_SERVER = "fibm15"
@@ -64,13 +91,19 @@ DST_DEFAULT = "LNF"
 # Verbose level (no messages by default)
 VERBOSE = 0
 
+# Copies to DAQ and KLOE servers are streamed without a local copy of the file (if possible)
+STREAM_COPY = True
+
 def print_help():
-    print '%s -F file_name [-S src_site] [-D dst_site] [-s src_dir] [-d dst_dir] [-c] [-v] [-h]'%SCRIPT_NAME
+    print '%s -F file_name [-S src_site] [-D dst_site] [-s src_dir] [-d dst_dir] [-L] [-P profile] [-B bw] [-v] [-h]'%SCRIPT_NAME
     print '  -F file_name    Name of file to transfer'
     print '  -S src_site     Source site. Default: %s'%SRC_DEFAULT
     print '  -D dst_site     Destination site. Default: %s'%DST_DEFAULT
     print '  -s src_dir      Path to data directory if source is LOCAL, name of data server if source is DAQ.'
     print '  -d dst_dir      Path to data directory if destination is LOCAL, name of data server if destination is DAQ.'
+    print '  -L              Always copy files to DAQ and KLOE servers through a local file or scp -3 (no streaming)'
+    print '  -P profile      Bandwidth profile: ongoing or idle. Default: checked on DAQ server if copying from/to DAQ, else idle'
+    print '  -B bw           Maximum bandwidth in MB/s for this link (0 means no limit). Default: depends on route and profile'
     print '  -v              Enable verbose mode (repeat to increase level)'
     print '  -h              Show this help message and exit'
     print '  Available sites:   %s'%SITE_LIST
@@ -83,8 +116,10 @@ def end_error(msg):
 
 def run_command(command):
     print "%s > %s"%(now_str(),command)
-    p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
-    return iter(p.stdout.readline, b'')
+    with SH.session(command):
+        p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
+        for line in iter(p.stdout.readline, b''): yield line
+        p.wait()
 
 def now_str():
     return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime())
@@ -155,7 +190,7 @@ def get_size_srm(filepath,site):
 
 def get_size_daq(filepath,server):
     size = ""
-    cmd = "ssh -i %s -l %s %s ls -l %s"%(DAQ_KEYFILE,DAQ_USER,server,filepath)
+    cmd = "%s ls -l %s"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,server),filepath)
     for line in run_command(cmd):
         print "    %s"%line.rstrip()
         m = re.match("^\s*\S+\s+\S+\s+\S+\s+\S+\s+(\d+)\s+\S+\s+\S+\s+\S+\s+\S+\s*$",line.rstrip())
@@ -173,7 +208,7 @@ def get_size_local(filepath):
 
 def get_size_kloe_disk(filepath):
     size = ""
-    cmd = "ssh -i %s -l %s %s ls -l %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,filepath)
+    cmd = "%s ls -l %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),filepath)
     for line in run_command(cmd):
         print "    %s"%line.rstrip()
         m = re.match("^\s*\S+\s+\S+\s+\S+\s+\S+\s+(\d+)\s+\S+\s+\S+\s+\S+\s+\S+\s*$",line.rstrip())
@@ -182,7 +217,7 @@ def get_size_kloe_disk(filepath):
 
 def get_size_kloe_tape(filepath):
     size = ""
-    cmd = "ssh -i %s -l %s %s dsmc query archive %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,filepath)
+    cmd = "%s dsmc query archive %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),filepath)
     for line in run_command(cmd):
         print "    %s"%line.rstrip()
         m = re.match("^\s*([0-9,]+)\s+\S+\s+\S+\s+\S+\s+(\S+)\s+.*$",line.rstrip())
@@ -202,7 +237,7 @@ def get_checksum_srm(filepath,site):
 
 def get_checksum_daq(filepath,server):
     a32 = ""
-    cmd = "ssh -i %s -l %s %s %s %s"%(DAQ_KEYFILE,DAQ_USER,server,DAQ_ADLER32_CMD,filepath)
+    cmd = "%s %s %s"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,server),DAQ_ADLER32_CMD,filepath)
     for line in run_command(cmd):
         print "    %s"%line.rstrip()
         try:
@@ -225,7 +260,7 @@ def get_checksum_local(filepath):
 
 def get_checksum_kloe(filepath):
     a32 = ""
-    cmd = "ssh -i %s -l %s %s %s %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,KLOE_ADLER32_CMD,filepath)
+    cmd = "%s %s %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),KLOE_ADLER32_CMD,filepath)
     for line in run_command(cmd):
         print "    %s"%line.rstrip()
         try:
@@ -234,6 +269,41 @@ def get_checksum_kloe(filepath):
             a32 = ""
     return a32
 
+def get_daq_profile(server):
+
+    # Return "ongoing" if a run is taking data on DAQ server, "idle" otherwise
+    # If run status cannot be read, assume a run is on-going
+    cmd = "%s \'( for f in %s %s; do echo $(cat $f); done )\'"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,server),DAQ_CURRENT_RUN_FILE,DAQ_LAST_RUN_FILE)
+    lines = [ line.strip() for line in run_command(cmd) ]
+    if len(lines) != 2: return "ongoing"
+    if re.match("run_\d+_\d+_\d+",lines[0]) and lines[0] != lines[1]: return "ongoing"
+    return "idle"
+
+def stage_file(filename,filepath,site):
+
+    # Reserve space for a local copy of file in the staging area, waiting if it is full
+    # Return "" if no space became available within STAGING_TIMEOUT seconds
+    size = get_size_srm(filepath,site)
+    if size:
+        size = int(size)
+    else:
+        size = STAGING_DEFAULT_SIZE
+    return SA.reserve(filename,size,STAGING_TIMEOUT)
+
+def stream_file(filename,src_cmd,dst_cmd):
+
+    # Pipe source read into destination write computing adler32 on the fly
+    # Return "unavailable" if streaming is disabled or the source cannot be read this way
+    if not STREAM_COPY: return ("unavailable","")
+    print "%s > %s | %s"%(now_str(),src_cmd,dst_cmd)
+    (status,a32,size) = SC.copy(src_cmd,dst_cmd)
+    if status == "ok":
+        print "%s - File %s - Streamed %d bytes - ADLER32 %s"%(now_str(),filename,size,a32)
+    elif status == "unavailable":
+        print "%s - File %s - Streaming is not possible: falling back to standard copy"%(now_str(),filename)
+        a32 = ""
+    return (status,a32)
+
 def check_file(filename,site,sdir):
     if (site == "LNF" or site == "LNF2" or site == "CNAF" or site == "CNAF2"):
         return check_file_srm(filename,site)
@@ -364,37 +434,50 @@ def copy_file_srm_daq(filename,src_site,daq_server):
 
     # Create destination directory on DAQ server
     dst_dir = os.path.dirname(dst_filepath)
-    cmd = "ssh -i %s -l %s %s mkdir -p %s"%(DAQ_KEYFILE,DAQ_USER,daq_server,dst_dir)
+    cmd = "%s mkdir -p %s"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,daq_server),dst_dir)
     for line in run_command(cmd): print "    %s"%line.rstrip()
 
-    # Copy file from SRM to local tmp file
-    tmp_file = "/tmp/%s"%filename
-    cmd = "gfal-copy -t 3600 -T 3600 -p %s%s file://%s"%(SRM[src_site],src_filepath,tmp_file)
-    for line in run_command(cmd):
-        print "    %s"%line.rstrip()
-        if ( re.match("^gfal-copy error: ",line) or re.match("^Command timed out",line) ): copy_failed = True
-
-    if copy_failed:
-        print "%s - File %s - ***ERROR*** gfal-copy returned error status while copying from %s to local file"%(now_str(),filename,src_site)
-        cmd = "rm -f %s"%tmp_file
+    # Stream file from SRM to DAQ server
+    src_cmd = "gfal-cat -t 3600 %s%s"%(SRM[src_site],src_filepath)
+    dst_cmd = "%s \'( cat > %s )\'"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,daq_server),dst_filepath)
+    (status,a32_stream) = stream_file(filename,src_cmd,dst_cmd)
+    if status == "error":
+        print "%s - File %s - ***ERROR*** streaming copy failed while copying from %s to DAQ(%s)"%(now_str(),filename,src_site,daq_server)
+        cmd = "%s rm -f %s"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,daq_server),dst_filepath)
         for line in run_command(cmd): print "    %s"%line.rstrip()
         return "error"
 
-    # Now send local copy to DAQ server using good old scp
-    cmd = "scp -i %s %s %s@%s:%s"%(DAQ_KEYFILE,tmp_file,DAQ_USER,daq_server,dst_filepath)
-    for line in run_command(cmd): print "    %s"%line.rstrip()
+    if status == "unavailable":
 
-    # Clean up local temporary file
-    cmd = "rm -f %s"%tmp_file
-    for line in run_command(cmd): print "    %s"%line.rstrip()
+        # Copy file from SRM to local tmp file in the staging area
+        tmp_file = stage_file(filename,src_filepath,src_site)
+        if not tmp_file:
+            print "%s - File %s - ***ERROR*** no space available in staging area %s"%(now_str(),filename,STAGING_DIR)
+            return "error"
+        cmd = "gfal-copy -t 3600 -T 3600 -p %s%s file://%s"%(SRM[src_site],src_filepath,tmp_file)
+        for line in run_command(cmd):
+            print "    %s"%line.rstrip()
+            if ( re.match("^gfal-copy error: ",line) or re.match("^Command timed out",line) ): copy_failed = True
+
+        if copy_failed:
+            print "%s - File %s - ***ERROR*** gfal-copy returned error status while copying from %s to local file"%(now_str(),filename,src_site)
+            SA.release(tmp_file)
+            return "error"
+
+        # Now send local copy to DAQ server using good old scp
+        cmd = "%s %s %s@%s:%s"%(SH.get_scp(DAQ_KEYFILE,DAQ_USER,daq_server),tmp_file,DAQ_USER,daq_server,dst_filepath)
+        for line in run_command(cmd): print "    %s"%line.rstrip()
+
+        # Clean up local temporary file
+        SA.release(tmp_file)
 
     # Compare source and destination
     (dum0,dum1,size_src,a32_src) = check_file(filename,src_site,"")
     (dum0,dum1,size_dst,a32_dst) = check_file(filename,"DAQ",daq_server)
     print "%s - File %s - Final check - Src: %s %s - Dst: %s %s"%(now_str(),filename,size_src,a32_src,size_dst,a32_dst)
-    if ( size_src != size_dst or a32_src == "" or a32_dst == "" or a32_src != a32_dst ):
+    if ( size_src != size_dst or a32_src == "" or a32_dst == "" or a32_src != a32_dst or (a32_stream and a32_stream != a32_src) ):
         print "%s - File %s - ***ERROR*** file copies do not match while copying from %s to DAQ(%s)"%(now_str(),filename,src_site,daq_server)
-        cmd = "ssh -i %s -l %s %s rm -f %s"%(DAQ_KEYFILE,DAQ_USER,daq_server,dst_filepath)
+        cmd = "%s rm -f %s"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,daq_server),dst_filepath)
         for line in run_command(cmd): print "    %s"%line.rstrip()
         return "error"
 
@@ -410,43 +493,57 @@ def copy_file_srm_kloe(filename,src_site):
 
     # Create destination directory on KLOE disk
     dst_dir = os.path.dirname(dst_filepath)
-    cmd = "ssh -i %s -l %s %s mkdir -p %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,dst_dir)
+    cmd = "%s mkdir -p %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),dst_dir)
     for line in run_command(cmd): print "    %s"%line.rstrip()
 
-    # Copy file from SRM to local tmp file
-    tmp_file = "/tmp/%s"%filename
-    cmd = "gfal-copy -t 3600 -T 3600 -p %s%s file://%s"%(SRM[src_site],src_filepath,tmp_file)
-    for line in run_command(cmd):
-        print "    %s"%line.rstrip()
-        if ( re.match("^gfal-copy error: ",line) or re.match("^Command timed out",line) ): copy_failed = True
-
-    if copy_failed:
-        print "%s - File %s - ***ERROR*** gfal-copy returned error status while copying from %s to local file"%(now_str(),filename,src_site)
-        for line in run_command("rm -f %s"%tmp_file): print "    %s"%line.rstrip()
+    # Stream file from SRM to KLOE temporary directory
+    tmp_file_kloe = "%s/%s"%(KLOE_TMPDIR,filename)
+    src_cmd = "gfal-cat -t 3600 %s%s"%(SRM[src_site],src_filepath)
+    dst_cmd = "%s \'( cat > %s )\'"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),tmp_file_kloe)
+    (status,a32_stream) = stream_file(filename,src_cmd,dst_cmd)
+    if status == "error":
+        print "%s - File %s - ***ERROR*** streaming copy failed while copying from %s to KLOE"%(now_str(),filename,src_site)
+        cmd = "%s rm -f %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),tmp_file_kloe)
+        for line in run_command(cmd): print "    %s"%line.rstrip()
         return "error"
 
-    # Now send local copy to KLOE temporary directory using good old scp
-    tmp_file_kloe = "%s/%s"%(KLOE_TMPDIR,filename)
-    cmd = "scp -i %s %s %s@%s:%s"%(KLOE_KEYFILE,tmp_file,KLOE_USER,KLOE_SERVER,tmp_file_kloe)
-    for line in run_command(cmd): print "    %s"%line.rstrip()
+    if status == "unavailable":
 
-    # Clean up local temporary file
-    cmd = "rm -f %s"%tmp_file
-    for line in run_command(cmd): print "    %s"%line.rstrip()
+        # Copy file from SRM to local tmp file in the staging area
+        tmp_file = stage_file(filename,src_filepath,src_site)
+        if not tmp_file:
+            print "%s - File %s - ***ERROR*** no space available in staging area %s"%(now_str(),filename,STAGING_DIR)
+            return "error"
+        cmd = "gfal-copy -t 3600 -T 3600 -p %s%s file://%s"%(SRM[src_site],src_filepath,tmp_file)
+        for line in run_command(cmd):
+            print "    %s"%line.rstrip()
+            if ( re.match("^gfal-copy error: ",line) or re.match("^Command timed out",line) ): copy_failed = True
+
+        if copy_failed:
+            print "%s - File %s - ***ERROR*** gfal-copy returned error status while copying from %s to local file"%(now_str(),filename,src_site)
+            SA.release(tmp_file)
+            return "error"
+
+        # Now send local copy to KLOE temporary directory using good old scp
+        cmd = "%s %s %s@%s:%s"%(SH.get_scp(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),tmp_file,KLOE_USER,KLOE_SERVER,tmp_file_kloe)
+        for line in run_command(cmd): print "    %s"%line.rstrip()
+
+        # Clean up local temporary file
+        SA.release(tmp_file)
 
     # Verify checksum
     (dum0,dum1,size_src,a32_src) = check_file(filename,src_site,"")
     size_dst = get_size_kloe_disk(tmp_file_kloe)
     a32_dst = get_checksum_kloe(tmp_file_kloe)
     print "%s - File %s - Final check - Src: %s %s - Dst: %s %s"%(now_str(),filename,size_src,a32_src,size_dst,a32_dst)
-    if ( size_src != size_dst or a32_src == "" or a32_dst == "" or a32_src != a32_dst ):
+    if ( size_src != size_dst or a32_src == "" or a32_dst == "" or a32_src != a32_dst or (a32_stream and a32_stream != a32_src) ):
         print "%s - File %s - ***ERROR*** file copies do not match while copying from %s to KLOE"%(now_str(),filename,src_site)
-        cmd = "ssh -i %s -l %s %s rm -f %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,tmp_file_kloe)
+        cmd = "%s rm -f %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),tmp_file_kloe)
         for line in run_command(cmd): print "    %s"%line.rstrip()
         return "error"
 
     # Move file from temporary directory to daq data directory
-    cmd = "ssh -i %s -l %s %s mv %s %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,tmp_file_kloe,dst_filepath)
+    cmd = "%s mv %s %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),tmp_file_kloe,dst_filepath)
     for line in run_command(cmd): print "    %s"%line.rstrip()
 
     return "ok"
@@ -516,7 +613,7 @@ def copy_file_daq_daq(filename,src_server,dst_server):
     print "%s - File %s - Starting copy from DAQ(%s) to DAQ(%s)"%(now_str(),filename,src_server,dst_server)
 
     filepath = get_path_daq(filename)
-    cmd = "scp -3 -i %s %s@%s%s %s@%s%s"%(DAQ_KEYFILE,DAQ_USER,src_server,filepath,DAQ_USER,dst_server,filepath)
+    cmd = "%s -3 %s@%s%s %s@%s%s"%(SH.get_scp(DAQ_KEYFILE,DAQ_USER,src_server),DAQ_USER,src_server,filepath,DAQ_USER,dst_server,filepath)
     for line in run_command(cmd): print "    %s"%line.rstrip()
 
     # Compare source and destination
@@ -525,7 +622,7 @@ def copy_file_daq_daq(filename,src_server,dst_server):
     print "%s - File %s - Final check - Src: %s %s - Dst: %s %s"%(now_str(),filename,size_src,a32_src,size_dst,a32_dst)
     if ( size_src != size_dst or a32_src == "" or a32_dst == "" or a32_src != a32_dst ):
         print "%s - File %s - ***ERROR*** file copies do not match while copying from DAQ(%s) to DAQ(%s)"%(now_str(),filename,src_server,dst_server)
-        cmd = "ssh -i %s -l %s %s rm -f %s"%(DAQ_KEYFILE,DAQ_USER,dst_server,dst_filepath)
+        cmd = "%s rm -f %s"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,dst_server),dst_filepath)
         for line in run_command(cmd): print "    %s"%line.rstrip()
         return "error"
 
@@ -537,16 +634,28 @@ def copy_file_daq_kloe(filename,daq_server):
 
     src_filepath = get_path_daq(filename)
     dst_filepath = get_path_kloe(filename)
-    cmd = "scp -3 -i %s %s@%s%s %s@%s%s"%(DAQ_KEYFILE,DAQ_USER,daq_server,src_filepath,KLOE_USER,KLOE_SERVER,dst_filepath)
-    for line in run_command(cmd): print "    %s"%line.rstrip()
+
+    # Stream file from DAQ server to KLOE. If not possible, relay it with scp -3
+    src_cmd = "%s cat %s"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,daq_server),src_filepath)
+    dst_cmd = "%s \'( cat > %s )\'"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),dst_filepath)
+    (status,a32_stream) = stream_file(filename,src_cmd,dst_cmd)
+    if status == "error":
+        print "%s - File %s - ***ERROR*** streaming copy failed while copying from DAQ(%s) to KLOE"%(now_str(),filename,daq_server)
+        cmd = "%s rm -f %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),dst_filepath)
+        for line in run_command(cmd): print "    %s"%line.rstrip()
+        return "error"
+
+    if status == "unavailable":
+        cmd = "%s -3 %s@%s%s %s@%s%s"%(SH.get_scp(DAQ_KEYFILE,DAQ_USER,daq_server),DAQ_USER,daq_server,src_filepath,KLOE_USER,KLOE_SERVER,dst_filepath)
+        for line in run_command(cmd): print "    %s"%line.rstrip()
 
     # Compare source and destination
     (dum0,dum1,size_src,a32_src) = check_file(filename,"DAQ",daq_server)
     (dum0,dum1,size_dst,a32_dst) = check_file(filename,"KLOE","")
     print "%s - File %s - Final check - Src: %s %s - Dst: %s %s"%(now_str(),filename,size_src,a32_src,size_dst,a32_dst)
-    if ( size_src != size_dst or a32_src == "" or a32_dst == "" or a32_src != a32_dst ):
+    if ( size_src != size_dst or a32_src == "" or a32_dst == "" or a32_src != a32_dst or (a32_stream and a32_stream != a32_src) ):
         print "%s - File %s - ***ERROR*** file copies do not match while copying from DAQ(%s) to KLOE"%(now_str(),filename,daq_server)
-        cmd = "ssh -i %s -l %s %s rm -f %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,dst_filepath)
+        cmd = "%s rm -f %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),dst_filepath)
         for line in run_command(cmd): print "    %s"%line.rstrip()
         return "error"
 
@@ -560,7 +669,7 @@ def copy_file_daq_local(filename,daq_server,dst_dir):
     dst_filepath = get_path_local(filename,dst_dir)
     cmd = "mkdir -p %s"%os.path.dirname(dst_filepath)
     for line in run_command(cmd): print "    %s"%line.rstrip()
-    cmd = "scp -i %s %s@%s:%s %s"%(DAQ_KEYFILE,DAQ_USER,daq_server,src_filepath,dst_filepath)
+    cmd = "%s %s@%s:%s %s"%(SH.get_scp(DAQ_KEYFILE,DAQ_USER,daq_server),DAQ_USER,daq_server,src_filepath,dst_filepath)
     for line in run_command(cmd): print "    %s"%line.rstrip()
 
     # Compare source and destination
@@ -611,7 +720,7 @@ def copy_file_local_daq(filename,src_dir,daq_server):
 
     src_filepath = get_path_local(filename,dst_dir)
     dst_filepath = get_path_daq(filename)
-    cmd = "scp -i %s %s %s@%s%s"%(DAQ_KEYFILE,src_filepath,DAQ_USER,daq_server,dst_filepath)
+    cmd = "%s %s %s@%s%s"%(SH.get_scp(DAQ_KEYFILE,DAQ_USER,daq_server),src_filepath,DAQ_USER,daq_server,dst_filepath)
     for line in run_command(cmd): print "    %s"%line.rstrip()
 
     # Compare source and destination
@@ -620,7 +729,7 @@ def copy_file_local_daq(filename,src_dir,daq_server):
     print "%s - File %s - Final check - Src: %s %s - Dst: %s %s"%(now_str(),filename,size_src,a32_src,size_dst,a32_dst)
     if ( size_src != size_dst or a32_dst == "" or (a32_src != "" and a32_src != a32_dst) ):
         print "%s - File %s - ***ERROR*** file copies do not match while copying from LOCAL(%s) to DAQ(%s)"%(now_str(),filename,src_dir,daq_server)
-        cmd = "ssh -i %s -l %s %s rm -f %s"%(DAQ_KEYFILE,DAQ_USER,daq_server,dst_filepath)
+        cmd = "%s rm -f %s"%(SH.get_ssh(DAQ_KEYFILE,DAQ_USER,daq_server),dst_filepath)
         for line in run_command(cmd): print "    %s"%line.rstrip()
         return "error"
 
@@ -632,7 +741,7 @@ def copy_file_local_kloe(filename,src_dir):
 
     src_filepath = get_path_local(filename,src_dir)
     dst_filepath = get_path_kloe(filename)
-    cmd = "scp -i %s %s %s@%s%s"%(KLOE_KEYFILE,src_filepath,KLOE_USER,KLOE_SERVER,dst_filepath)
+    cmd = "%s %s %s@%s%s"%(SH.get_scp(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),src_filepath,KLOE_USER,KLOE_SERVER,dst_filepath)
     for line in run_command(cmd): print "    %s"%line.rstrip()
 
     # Compare source and destination
@@ -641,7 +750,7 @@ def copy_file_local_kloe(filename,src_dir):
     print "%s - File %s - Final check - Src: %s %s - Dst: %s %s"%(now_str(),filename,size_src,a32_src,size_dst,a32_dst)
     if ( size_src != size_dst or a32_dst == "" or (a32_src != "" and a32_src != a32_dst) ):
         print "%s - File %s - ***ERROR*** file copies do not match while copying from LOCAL(%s) to KLOE"%(now_str(),filename,src_dir)
-        cmd = "ssh -i %s -l %s %s rm -f %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,dst_filepath)
+        cmd = "%s rm -f %s"%(SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER),dst_filepath)
         for line in run_command(cmd): print "    %s"%line.rstrip()
         return "error"
 
@@ -671,6 +780,7 @@ def copy_file_local_local(filename,src_dir,dst_dir):
 def main(argv):
 
     global VERBOSE
+    global STREAM_COPY
 
     filename = ""
     src_site = SRC_DEFAULT
@@ -679,9 +789,11 @@ def main(argv):
     dst_site = DST_DEFAULT
     dst_string = ""
     dst_dir = ""
+    profile = ""
+    bandwidth = None
 
     try:
-        opts,args = getopt.getopt(argv,"F:S:D:s:d:vh")
+        opts,args = getopt.getopt(argv,"F:S:D:s:d:LP:B:vh")
     except getopt.GetoptError as err:
         end_error("ERROR - %s"%err)
 
@@ -703,6 +815,17 @@ def main(argv):
             src_dir = arg
         elif opt == '-d':
             dst_dir = arg
+        elif opt == '-L':
+            STREAM_COPY = False
+        elif opt == '-P':
+            if (not arg in ("ongoing","idle")):
+                end_error("ERROR - Invalid bandwidth profile %s"%arg)
+            profile = arg
+        elif opt == '-B':
+            try:
+                bandwidth = int(arg)
+            except ValueError:
+                end_error("ERROR - Invalid bandwidth %s"%arg)
         elif opt == '-v':
             VERBOSE += 1
 
@@ -758,6 +881,9 @@ def main(argv):
     print
     print "%s === TransferFile %s from %s to %s ==="%(now_str(),filename,src_string,dst_string)
 
+    # Make sure a valid VOMS proxy is available
+    PH.renew_voms_proxy()
+
     # Check if file exists at source site
     (src_status,src_file_path,src_file_size,src_file_chksum) = check_file(filename,src_site,src_dir)
     if src_status == "error":
@@ -780,7 +906,31 @@ def main(argv):
             print "WARNING - file %s exists at destination site %s but has wrong checksum - S: %s - D: %s"%(filename,dst_string,src_file_chksum,dst_file_chksum)
         sys.exit()
 
-    if copy_file(filename,src_site,src_dir,dst_site,dst_dir) == "ok":
+    # Wait until the bandwidth allowed on this link is available
+    # Link is identified as the CDR servers do, e.g. DAQ_l1padme3_LNF
+    src_link = src_site
+    if (src_site == "DAQ"): src_link += "_%s"%src_dir
+    dst_link = dst_site
+    if (dst_site == "DAQ"): dst_link += "_%s"%dst_dir
+    BW = BandwidthLimiter(BANDWIDTH_DIR,"%s_%s"%(src_link,dst_link),"%s_%s"%(src_site,dst_site))
+    if not profile:
+        profile = "idle"
+        if (src_site == "DAQ"):
+            profile = get_daq_profile(src_dir)
+        elif (dst_site == "DAQ"):
+            profile = get_daq_profile(dst_dir)
+    BW.set_profile(profile)
+    if bandwidth is not None: BW.set_limit(profile,bandwidth)
+    BW.acquire(int(src_file_size))
+
+    # Parallel copies on the link (by all TransferFile jobs and CDR servers) are limited by the profile
+    slot = BW.acquire_slot()
+    try:
+        result = copy_file(filename,src_site,src_dir,dst_site,dst_dir)
+    finally:
+        BW.release_slot(slot)
+
+    if result == "ok":
         print "%s - File %s - Copy from %s to %s successful"%(now_str(),filename,src_string,dst_string)
     else:
         print "%s - File %s - Copy from %s to %s failed"%(now_str(),filename,src_string,dst_string)
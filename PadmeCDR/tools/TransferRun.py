@@ -19,6 +19,16 @@ SCRIPT_DIR,SCRIPT_FILE = os.path.split(os.path.abspath(thisscript))
 # Define correct path to TranferFile script
 TRANSFERFILE = "%s/TransferFile.py"%SCRIPT_DIR
 
+# Renew VOMS proxy before starting parallel copies, so that they find a valid proxy
+sys.path.insert(0,"%s/../code"%SCRIPT_DIR)
+from ProxyHandler import ProxyHandler
+PH = ProxyHandler()
+PH.long_proxy_file = "%s/run/long_proxy"%os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+
+# Number of parallel copies depends on data taking when copying from/to a DAQ data server
+from BandwidthLimiter import BandwidthLimiter
+BANDWIDTH_DIR = "%s/run"%os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+
 # User running CDR
 CDR_USER = os.environ['USER']
 
@@ -29,6 +39,8 @@ SITE_LIST = [ "LNF", "LNF2", "CNAF", "CNAF2", "LOCAL", "DAQ", "KLOE" ]
 DAQ_USER = "daq"
 DAQ_KEYFILE = "/home/%s/.ssh/id_rsa_cdr"%CDR_USER
 DAQ_SERVERS = [ "l1padme3", "l1padme4" ]
+DAQ_CURRENT_RUN_FILE = "/home/daq/DAQ/run/current_run"
+DAQ_LAST_RUN_FILE = "/home/daq/DAQ/run/last_run"
 
 # SRM addresses
 SRM = {
@@ -52,13 +64,14 @@ VERBOSE = 0
 PARALLEL_DELAY = "0.1s"
 
 def print_help():
-    print '%s -R run_name [-S src_site] [-D dst_site] [-s src_dir]  [-d dst_dir] [-j jobs] [-h]'%SCRIPT_NAME
+    print '%s -R run_name [-S src_site] [-D dst_site] [-s src_dir]  [-d dst_dir] [-j jobs] [-B bw] [-h]'%SCRIPT_NAME
     print '  -R run_name     Name of run to transfer'
     print '  -S src_site     Source site. Default: %s'%SRC_DEFAULT
     print '  -D dst_site     Destination site. Default: %s'%DST_DEFAULT
     print '  -s src_dir      Path to data directory if source is LOCAL, name of data server if source is DAQ.'
     print '  -d dst_dir      Path to data directory if destination is LOCAL, name of data server if destination is DAQ.'
-    print '  -j jobs         Number of parallel jobs to use. Default: %s'%JOBS_DEFAULT
+    print '  -j jobs         Number of parallel jobs to use. Default: %s (less while DAQ is taking data)'%JOBS_DEFAULT
+    print '  -B bw           Maximum bandwidth in MB/s for this link (0 means no limit). Default: depends on route and on data taking'
     print '  -h              Show this help message and exit'
     print '  Available sites:   %s'%SITE_LIST
     print '  Available DAQ servers: %s'%DAQ_SERVERS
@@ -142,6 +155,16 @@ def get_file_list_daq(run,server):
     file_list.sort()
     return file_list
 
+def get_daq_profile(server):
+
+    # Return "ongoing" if a run is taking data on DAQ server, "idle" otherwise
+    # If run status cannot be read, assume a run is on-going
+    cmd = "ssh -i %s -l %s %s \'( for f in %s %s; do echo $(cat $f); done )\'"%(DAQ_KEYFILE,DAQ_USER,server,DAQ_CURRENT_RUN_FILE,DAQ_LAST_RUN_FILE)
+    lines = [ line.strip() for line in run_command(cmd) ]
+    if len(lines) != 2: return "ongoing"
+    if re.match("run_\d+_\d+_\d+",lines[0]) and lines[0] != lines[1]: return "ongoing"
+    return "idle"
+
 def main(argv):
 
     run = ""
@@ -152,10 +175,11 @@ def main(argv):
     year = ""
     src_srm = ""
     dst_srm = ""
-    jobs = JOBS_DEFAULT
+    jobs = ""
+    bandwidth = ""
 
     try:
-        opts,args = getopt.getopt(argv,"R:S:D:s:d:j:h")
+        opts,args = getopt.getopt(argv,"R:S:D:s:d:j:B:h")
     except getopt.GetoptError as err:
         end_error("ERROR - %s"%err)
 
@@ -177,6 +201,8 @@ def main(argv):
             dst_dir = arg
         elif opt == '-j':
             jobs = arg
+        elif opt == '-B':
+            bandwidth = arg
 
     if (not run): end_error("ERROR - No run name specified")
 
@@ -250,7 +276,26 @@ def main(argv):
 
     print "%s - Start copying run %s (%d/%d files)"%(now_str(),run,len(file_list),len(src_file_list))
 
-    cmd = "parallel --delay %s -j %s %s -F {} -S %s -D %s"%(PARALLEL_DELAY,jobs,TRANSFERFILE,src_site,dst_site)
+    # Throttle copies from/to DAQ data servers while a run is taking data
+    # Profile is checked once and passed to all copies. Parallel copies on the link are limited
+    # by the profile across all processes using it (CDR servers included): jobs above the limit
+    # wait in TransferFile for a free copy slot.
+    profile = "idle"
+    if (src_site == "DAQ"):
+        profile = get_daq_profile(src_dir)
+    elif (dst_site == "DAQ"):
+        profile = get_daq_profile(dst_dir)
+    src_link = src_site
+    if (src_site == "DAQ"): src_link += "_%s"%src_dir
+    dst_link = dst_site
+    if (dst_site == "DAQ"): dst_link += "_%s"%dst_dir
+    BW = BandwidthLimiter(BANDWIDTH_DIR,"%s_%s"%(src_link,dst_link),"%s_%s"%(src_site,dst_site))
+    BW.set_profile(profile)
+    if not jobs: jobs = "%d"%BW.get_jobs(int(JOBS_DEFAULT))
+
+    PH.renew_voms_proxy()
+    cmd = "parallel --delay %s -j %s %s -F {} -S %s -D %s -P %s"%(PARALLEL_DELAY,jobs,TRANSFERFILE,src_site,dst_site,profile)
+    if bandwidth: cmd += " -B %s"%bandwidth
     if src_dir: cmd += " -s %s"%src_dir
     if dst_dir: cmd += " -d %s"%dst_dir
     cmd += " :::"
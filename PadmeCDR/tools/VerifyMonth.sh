@@ -2,10 +2,11 @@
 
 # Prepare a variable with usage guidelines
 read -r -d '' usage <<EOF
-Usage: $0 -m month [-S src_site] [-D dst_site] [-j jobs] [-h]
+Usage: $0 -m month [-S src_site] [-D dst_site] [-j jobs] [-c] [-C days] [-h]
 Available source sites: CNAF CNAF2 LNF LNF2
 Available destination sites: CNAF CNAF2 LNF LNF2 KLOE
 Default: verify CNAF vs LNF
+-c enables checksum verification, -C trusts cached checksums computed less than days ago
 EOF
 
 # Find where this script is really located: needed to find the corresponding VerifyRun.py script
@@ -42,7 +43,8 @@ src_site="CNAF"
 dst_site="LNF"
 month=""
 jobs=20
-while getopts ":m:S:D:j:h" o; do
+verify_opts=""
+while getopts ":m:S:D:j:cC:h" o; do
     case "${o}" in
         m)
             month=${OPTARG}
@@ -56,6 +58,12 @@ while getopts ":m:S:D:j:h" o; do
         j)
             jobs=${OPTARG}
             ;;
+        c)
+            verify_opts="$verify_opts -c"
+            ;;
+        C)
+            verify_opts="$verify_opts -C ${OPTARG}"
+            ;;
         h)
             echo "$usage"
 	    exit 0
@@ -110,12 +118,12 @@ if [ ${#run_list[@]} -eq 0 ]; then
     echo "WARNING - No runs found on source site ${src_site} for month ${month}."
 else
     if [[ $dst_site != "KLOE" ]]; then
-	parallel $VERIFYRUN -R {} -S $src_site -D $dst_site ::: "${run_list[@]}"
+	parallel $VERIFYRUN -R {} -S $src_site -D $dst_site $verify_opts ::: "${run_list[@]}"
     else
 	# KLOE site has problems with multiple ssh accesses: do not use parallel
 	for run in "${run_list[@]}"
 	do
-	    $VERIFYRUN -R $run -S $src_site -D $dst_site
+	    $VERIFYRUN -R $run -S $src_site -D $dst_site $verify_opts
 	done
     fi
 fi
@@ -7,6 +7,25 @@ import time
 import getopt
 import subprocess
 
+# Get some info about running script
+thisscript = sys.argv[0]
+SCRIPT_PATH,SCRIPT_NAME = os.path.split(thisscript)
+# Solve all symbolic links to reach installation directory
+while os.path.islink(thisscript): thisscript = os.readlink(thisscript)
+SCRIPT_DIR,SCRIPT_FILE = os.path.split(os.path.abspath(thisscript))
+
+# Use ssh handler from PadmeCDR code: all commands sent to the same remote account share one connection
+sys.path.insert(0,"%s/../code"%SCRIPT_DIR)
+from SSHHandler import SSHHandler
+from ChecksumHandler import ChecksumHandler
+from ChecksumCache import ChecksumCache
+SH = SSHHandler(60)
+CH = ChecksumHandler(SH)
+
+# Checksums are shared with the CDR servers and with other tools through a persistent cache
+CDR_DIR = os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+CC = ChecksumCache("%s/run"%CDR_DIR)
+
 # List of available sites
 SITE_LIST = [ "LNF", "LNF2", "CNAF", "CNAF2", "KLOE" , "DAQ", "LOCAL" ]
 
@@ -33,12 +52,14 @@ LNF_SRM = "davs://atlasse.lnf.infn.it:443/dpm/lnf.infn.it/home/vo.padme.org"
 LNF2_SRM = "davs://atlasse.lnf.infn.it:443/dpm/lnf.infn.it/home/vo.padme.org_scratch"
 CNAF_SRM = "srm://storm-fe-archive.cr.cnaf.infn.it:8444/srm/managerv2?SFN=/padmeTape"
 CNAF2_SRM = "srm://storm-fe-archive.cr.cnaf.infn.it:8444/srm/managerv2?SFN=/padme"
+SRM_LIST = { "LNF": LNF_SRM, "LNF2": LNF2_SRM, "CNAF": CNAF_SRM, "CNAF2": CNAF2_SRM }
 
 # Timeout for gfal-ls and gfal-sum commands (in seconds)
 GFAL_TIMEOUT = 600
+CH.gfal_timeout = GFAL_TIMEOUT
 
 def print_help():
-    print 'VerifyRun -R run_name [-S src_site] [-D dst_site] [-s src_dir] [-d dst_dir] [-Y year] [-c] [-v] [-h]'
+    print 'VerifyRun -R run_name [-S src_site] [-D dst_site] [-s src_dir] [-d dst_dir] [-Y year] [-c] [-C days] [-v] [-h]'
     print '  -R run_name     Name of run to verify'
     print '  -S src_site     Source site.'
     print '  -D dst_site     Destination site.'
@@ -46,6 +67,7 @@ def print_help():
     print '  -d dst_dir      Path to data directory if destination is LOCAL, name of data server if destination is DAQ.'
     print '  -Y year         Specify year of data taking. Default: year from run name'
     print '  -c              Enable checksum verification (very time consuming!)'
+    print '  -C days         Trust cached checksums computed less than days ago. Default: always compute checksums'
     print '  -v              Enable verbose mode (repeat to increase level)'
     print '  -h              Show this help message and exit'
     print '  Available sites:   %s'%SITE_LIST
@@ -56,30 +78,25 @@ def end_error(msg):
     print_help()
     sys.exit(2)
 
-def get_checksum_srm(file,year,srm):
-    a32 = ""
-    path = "/daq/%s/rawdata/%s"%(year,file)
-    cmd = "gfal-sum -t %d %s%s adler32"%(GFAL_TIMEOUT,srm,path);
-    for line in run_command(cmd):
-        m = re.match("^gfal-sum error: (\d+) \((.*)\) - ",line)
-        if (m):
-            err_code = m.group(1)
-            err_msg = m.group(2)
-            print line.rstrip()                
-            break
-        m = re.match("^\s*\S+\s+(\S+)\s*$",line.rstrip())
-        if (m): a32 = m.group(1)
-    return a32
+def get_checksums(site,server,run,year,file_list,file_size,max_age):
+
+    # Get checksum of all files of run in list. On DAQ servers a single remote command is used,
+    # on storage elements several gfal-sum commands are run in parallel
+    # Checksums found in the cache or being computed by another process are not computed again
+    path_list = [ "%s/%s"%(run,f) for f in file_list ]
+    path_size = {}
+    for f in file_list: path_size["%s/%s"%(run,f)] = file_size[f]
+    if (site == "DAQ"):
+        daq_ssh = SH.get_ssh(DAQ_KEYFILE,DAQ_USER,server,0,"-n")
+        checksums = CC.get_checksums("DAQ-%s"%server,path_list,CH.get_checksums_ssh,
+                                     (daq_ssh,DAQ_ADLER32_CMD,"/data/DAQ/%s/rawdata"%year),max_age,path_size)
+    else:
+        checksums = CC.get_checksums(site,path_list,CH.get_checksums_srm,
+                                     ("%s/daq/%s/rawdata"%(SRM_LIST[site],year),),max_age,path_size)
 
-def get_checksum_daq(file,year,server):
-    a32 = ""
-    path = "/data/DAQ/%s/rawdata/%s"%(year,file)
-    cmd = "ssh -n -i %s -l %s %s %s %s"%(DAQ_KEYFILE,DAQ_USER,server,DAQ_ADLER32_CMD,path)
-    for line in run_command(cmd):
-        try:
-            (a32,fdummy) = line.rstrip().split()
-        except:
-            a32 = ""
+    # Return checksums indexed by file name
+    a32 = {}
+    for path in checksums.keys(): a32[os.path.basename(path)] = checksums[path]
     return a32
 
 def get_file_list_daq(run,year,server):
@@ -87,7 +104,7 @@ def get_file_list_daq(run,year,server):
     file_size = {}
     missing = False
     run_dir = "/data/DAQ/%s/rawdata/%s"%(year,run)
-    daq_ssh = "ssh -n -i %s -l %s %s"%(DAQ_KEYFILE,DAQ_USER,server)
+    daq_ssh = SH.get_ssh(DAQ_KEYFILE,DAQ_USER,server,0,"-n")
     cmd = "%s \'( cd %s; ls -l )\'"%(daq_ssh,run_dir)
     for line in run_command(cmd):
         if ( re.match("^ls: cannot access ",line) ):
@@ -147,7 +164,7 @@ def get_file_list_kloe(run,year):
     file_size = {}
 
     run_dir = "/data/DAQ/%s/rawdata/%s"%(year,run)
-    kloe_ssh = "ssh -n -i %s -l %s %s"%(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER)
+    kloe_ssh = SH.get_ssh(KLOE_KEYFILE,KLOE_USER,KLOE_SERVER,4,"-n")
 
     # Get list of files on tape
     missing_tape = False
@@ -200,10 +217,11 @@ def main(argv):
     dst_dir = ""
     year = ""
     checksum = False
+    checksum_max_age = None
     verbose = 0
 
     try:
-        opts,args = getopt.getopt(argv,"R:S:D:s:d:Y:cvh")
+        opts,args = getopt.getopt(argv,"R:S:D:s:d:Y:cC:vh")
     except getopt.GetoptError as err:
         end_error("ERROR - %s"%err)
 
@@ -229,6 +247,11 @@ def main(argv):
             year = arg
         elif opt == '-c':
             checksum = True
+        elif opt == '-C':
+            try:
+                checksum_max_age = float(arg)*86400
+            except ValueError:
+                end_error("ERROR - Invalid number of days %s"%arg)
         elif opt == '-v':
             verbose += 1
 
@@ -357,6 +380,13 @@ def main(argv):
     file_list = list(set(src_file_list).union(set(dst_file_list)))
     file_list.sort()
 
+    # Get checksums of all files with the same size at both sites
+    if checksum:
+        check_list = [ f for f in src_file_list if (f in dst_file_list) and (src_file_size[f] == dst_file_size[f]) ]
+        if (verbose > 1): print "%s - Getting checksum of %d files at %s and %s"%(now_str(),len(check_list),src_string,dst_string)
+        src_checksums = get_checksums(src_site,src_dir,run,year,check_list,src_file_size,checksum_max_age)
+        dst_checksums = get_checksums(dst_site,dst_dir,run,year,check_list,dst_file_size,checksum_max_age)
+
     # Check file lists for differences
     if (verbose > 1): print "%s - Starting verification of run %s (%d files) between %s and %s"%(now_str(),run,len(file_list),src_string,dst_string)
     warnings = 0
@@ -391,31 +421,9 @@ def main(argv):
             # Verify checksum only if requested by the user
             if checksum:
 
-                # Get checksum at source site
-                src_checksum = ""
-                if (src_site == "DAQ"):
-                    src_checksum = get_checksum_daq("%s/%s"%(run,rawfile),year,src_dir)
-                elif (src_site == "LNF"):
-                    src_checksum = get_checksum_srm("%s/%s"%(run,rawfile),year,LNF_SRM)
-                elif (src_site == "LNF2"):
-                    src_checksum = get_checksum_srm("%s/%s"%(run,rawfile),year,LNF2_SRM)
-                elif (src_site == "CNAF"):
-                    src_checksum = get_checksum_srm("%s/%s"%(run,rawfile),year,CNAF_SRM)
-                elif (src_site == "CNAF2"):
-                    src_checksum = get_checksum_srm("%s/%s"%(run,rawfile),year,CNAF2_SRM)
-
-                # Get checksum at destination site
-                dst_checksum = ""
-                if (dst_site == "DAQ"):
-                    dst_checksum = get_checksum_daq("%s/%s"%(run,rawfile),year,dst_dir)
-                elif (dst_site == "LNF"):
-                    dst_checksum = get_checksum_srm("%s/%s"%(run,rawfile),year,LNF_SRM)
-                elif (dst_site == "LNF2"):
-                    dst_checksum = get_checksum_srm("%s/%s"%(run,rawfile),year,LNF2_SRM)
-                elif (dst_site == "CNAF"):
-                    dst_checksum = get_checksum_srm("%s/%s"%(run,rawfile),year,CNAF_SRM)
-                elif (dst_site == "CNAF2"):
-                    dst_checksum = get_checksum_srm("%s/%s"%(run,rawfile),year,CNAF2_SRM)
+                # Get checksums at source and destination sites
+                src_checksum = src_checksums.get(rawfile,"")
+                dst_checksum = dst_checksums.get(rawfile,"")
 
                 # Check if checksums are consistent
                 if (src_checksum == "" and dst_checksum == ""):
@@ -456,8 +464,10 @@ def main(argv):
 
 def run_command(command):
     #print "> %s"%command
-    p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
-    return iter(p.stdout.readline, b'')
+    with SH.session(command):
+        p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
+        for line in iter(p.stdout.readline, b''): yield line
+        p.wait()
 
 def now_str():
     return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime())
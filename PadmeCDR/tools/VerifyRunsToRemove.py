@@ -7,6 +7,25 @@ import time
 import getopt
 import subprocess
 
+# Get some info about running script
+thisscript = sys.argv[0]
+SCRIPT_PATH,SCRIPT_NAME = os.path.split(thisscript)
+# Solve all symbolic links to reach installation directory
+while os.path.islink(thisscript): thisscript = os.readlink(thisscript)
+SCRIPT_DIR,SCRIPT_FILE = os.path.split(os.path.abspath(thisscript))
+
+# Use ssh handler from PadmeCDR code: all commands sent to the same remote account share one connection
+sys.path.insert(0,"%s/../code"%SCRIPT_DIR)
+from SSHHandler import SSHHandler
+from ChecksumHandler import ChecksumHandler
+from ChecksumCache import ChecksumCache
+SH = SSHHandler(60)
+CH = ChecksumHandler(SH)
+
+# Checksums are shared with the CDR servers and with other tools through a persistent cache
+cdr_dir = os.getenv('PADME_CDR_DIR',"%s/.."%SCRIPT_DIR)
+CC = ChecksumCache("%s/run"%cdr_dir)
+
 # User running CDR
 cdr_user = os.environ['USER']
 
@@ -34,33 +53,24 @@ def set_year(year):
 
 def run_command(command):
     #print "> %s"%command
-    p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
-    return iter(p.stdout.readline,b'')
-
-def get_checksum_cnaf(rawfile):
-    a32 = ""
-    cmd = "gfal-sum %s/%s adler32"%(cnaf_srm,rawfile);
-    for line in run_command(cmd):
-        try:
-            (fdummy,a32) = line.rstrip().split()
-        except:
-            a32 = ""
-    return a32
-
-def get_checksum_daq(rawfile):
-    a32 = ""
-    cmd = "%s %s %s/%s"%(daq_ssh,daq_adler32_cmd,daq_path,rawfile)
-    for line in run_command(cmd):
-        try:
-            (a32,fdummy) = line.rstrip().split()
-        except:
-            a32 = ""
-    return a32
+    with SH.session(command):
+        p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
+        for line in iter(p.stdout.readline,b''): yield line
+        p.wait()
+
+def get_checksums_cnaf(rawfile_list,max_age):
+    # Run several gfal-sum commands in parallel for files not in the checksum cache
+    return CC.get_checksums("CNAF",rawfile_list,CH.get_checksums_srm,(cnaf_srm,),max_age)
+
+def get_checksums_daq(daq_server,rawfile_list,max_age):
+    # Compute all checksums not in the checksum cache with a single remote command
+    return CC.get_checksums("DAQ-%s"%daq_server,rawfile_list,CH.get_checksums_ssh,(daq_ssh,daq_adler32_cmd,daq_path),max_age)
 
 def print_help():
-    print 'VerifyRunsToRemove [-s server] [-c] [-Y year] [-h]'
+    print 'VerifyRunsToRemove [-s server] [-c] [-C days] [-Y year] [-h]'
     print '  -s server  Select a single DAQ data server to check. Defalut: check both servers'
-    print '  -c         Enable checksum verification of files (safer but VERY SLOW)'
+    print '  -c         Enable checksum verification of files (safer but slow)'
+    print '  -C days    Trust cached checksums computed less than days ago. Default: always compute checksums'
     print '  -Y year    Look for data from given year (default: current year)'
     print '  -v         Run in verbose mode (repeat to increase verbose output)'
     print '  -h         Show this help message and exit'
@@ -71,12 +81,13 @@ def main(argv):
     global daq_ssh
 
     try:
-        opts,args = getopt.getopt(argv,"Y:s:cvh")
+        opts,args = getopt.getopt(argv,"Y:s:cC:vh")
     except getopt.GetoptError:
         print_help()
         sys.exit(2)
 
     Checksum = False
+    Checksum_Max_Age = None
     Year = time.strftime("%Y",time.gmtime())
     Selected_Server = ""
     Verbose = 0
@@ -86,6 +97,13 @@ def main(argv):
             sys.exit()
         elif opt == '-c':
             Checksum = True
+        elif opt == '-C':
+            try:
+                Checksum_Max_Age = float(arg)*86400
+            except ValueError:
+                print "ERROR - Invalid number of days %s"%arg
+                print_help()
+                sys.exit(2)
         elif opt == '-v':
             Verbose += 1
         elif opt == '-s':
@@ -113,7 +131,7 @@ def main(argv):
         if (Selected_Server != "" and daq_server != Selected_Server): continue
 
         # SSH syntax to execute a command on the DAQ data server
-        daq_ssh = "ssh -n -i %s -l %s %s"%(daq_keyfile,daq_user,daq_server)
+        daq_ssh = SH.get_ssh(daq_keyfile,daq_user,daq_server,0,"-n")
 
         if Verbose: print "DEBUG - Checking server %s"%daq_server
 
@@ -170,9 +188,12 @@ def main(argv):
                 continue
 
             # Check if all files have correct adler32 checksum
+            rawfile_list = [ "%s/%s"%(run,rawfile) for rawfile in daq_list ]
+            checksums_daq = get_checksums_daq(daq_server,rawfile_list,Checksum_Max_Age)
+            checksums_cnaf = get_checksums_cnaf(rawfile_list,Checksum_Max_Age)
             for rawfile in daq_list:
-                chksum_daq = get_checksum_daq("%s/%s"%(run,rawfile))
-                chksum_cnaf = get_checksum_cnaf("%s/%s"%(run,rawfile))
+                chksum_daq = checksums_daq.get("%s/%s"%(run,rawfile),"")
+                chksum_cnaf = checksums_cnaf.get("%s/%s"%(run,rawfile),"")
                 if (Verbose>2): print "DEBUG - File %s Checksum DAQ: \'%s\' CNAF: \'%s\'"%(rawfile,chksum_daq,chksum_cnaf)
                 if ( chksum_daq == "" or chksum_cnaf == "" or chksum_daq != chksum_cnaf ):
                     # Checksum mismatch is BAD: issue a warning when found